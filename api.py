@@ -0,0 +1,214 @@
+"""Versioned JSON API: /api/v1.
+
+Responses are built straight from selected columns rather than ORM objects:
+each endpoint has a table of fields (the columns a field needs and how to
+turn them into JSON), and a request's `?fields=` picks which ones are
+selected and serialized (the timeline's fields come from the message
+cache instead, since its messages may be on several shards). Lists use
+cursor pagination (`?after=`,
+`?limit=`). Larger responses are compressed with brotli (if installed) or
+gzip, according to Accept-Encoding.
+"""
+
+import gzip
+import json
+from functools import lru_cache
+
+from flask import Blueprint, Response, request, g
+
+from models import db, User, Message
+from pagination import encode_cursor, decode_cursor, cursor_matches
+from shards import shards
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Default and largest page size for list endpoints.
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Responses smaller than this (in bytes) aren't worth compressing.
+COMPRESS_MIN_SIZE = 512
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+def _identity(value):
+    return value
+
+
+def _message_user(user_id, username, image_url):
+    return {'id': user_id, 'username': username, 'image_url': image_url}
+
+
+# field -> (columns it needs, function from those column values to JSON)
+MESSAGE_FIELDS = {
+    'id': ((Message.id,), _identity),
+    'text': ((Message.text,), _identity),
+    'timestamp': ((Message.timestamp,), _isoformat),
+    'user': ((Message.user_id, User.username, User.image_url), _message_user),
+}
+
+USER_FIELDS = {
+    'id': ((User.id,), _identity),
+    'username': ((User.username,), _identity),
+    'image_url': ((User.image_url,), _identity),
+    'header_image_url': ((User.header_image_url,), _identity),
+    'bio': ((User.bio,), _identity),
+    'location': ((User.location,), _identity),
+    'followers_count': ((User.followers_count,), _identity),
+}
+
+
+class Serializer:
+    """Columns to select for a set of fields, and how to serialize the rows.
+
+    Built once per distinct (field table, fields) and cached.
+    """
+
+    def __init__(self, table, fields):
+        self.columns = []
+        self.parts = []
+
+        for name in fields:
+            columns, build = table[name]
+            self.parts.append((name, len(self.columns), len(columns), build))
+            self.columns.extend(columns)
+
+        # models the columns come from, i.e. what the query has to join
+        self.models = {column.class_ for column in self.columns}
+
+    def __call__(self, row):
+        return {name: build(*row[start:start + size])
+                for name, start, size, build in self.parts}
+
+
+FIELD_TABLES = {
+    'message': MESSAGE_FIELDS,
+    'user': USER_FIELDS,
+}
+
+
+@lru_cache(maxsize=64)
+def _serializer(table_name, fields):
+    return Serializer(FIELD_TABLES[table_name], fields)
+
+
+def serializer_for(table_name):
+    """Get the serializer for the `?fields=` of the current request.
+
+    Unknown field names are ignored; no (known) fields means all of them.
+    """
+
+    table = FIELD_TABLES[table_name]
+    requested = set(request.args.get('fields', '').split(','))
+    fields = tuple(name for name in table if name in requested)
+
+    return _serializer(table_name, fields or tuple(table))
+
+
+def message_values(msg, columns):
+    """The values of `columns` for a CachedMessage, as a query would select them."""
+
+    return [getattr(msg.user if column.class_ is User else msg, column.key)
+            for column in columns]
+
+
+def json_response(payload, status=200):
+    """Serialize `payload` compactly and compress it if the client allows."""
+
+    body = json.dumps(payload, separators=(',', ':')).encode('UTF-8')
+    response = Response(body, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    accepted = request.accept_encodings
+
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body, quality=4))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+def error_response(status, message):
+    return json_response({'error': message}, status)
+
+
+def page_limit():
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+@api.route('/health')
+def health():
+    """Cheap liveness probe for load balancers."""
+
+    return json_response({'status': 'ok'})
+
+
+@api.route('/timeline')
+def timeline():
+    """Messages from the current user and who they follow, newest first."""
+
+    if not g.user:
+        return error_response(401, "Access unauthorized.")
+
+    serialize = serializer_for('message')
+
+    values = decode_cursor(request.args.get('after'), 1)
+    before = values[0] if cursor_matches(values, (int,)) else None
+
+    # followed users' messages may be spread over several shards
+    authors = shards.following(g.user) + [(g.user.id, g.user.shard)]
+    messages, next_before = shards.timeline_page(authors, page_limit(), before)
+
+    return json_response({
+        'messages': [serialize(message_values(msg, serialize.columns)) for msg in messages],
+        'next': encode_cursor([next_before]) if next_before is not None else None,
+    })
+
+
+@api.route('/users/<int:user_id>')
+def user_detail(user_id):
+    """A user's public profile."""
+
+    serialize = serializer_for('user')
+    row = (db.session
+           .query(*serialize.columns)
+           .filter(User.id == user_id, User.deleted_at.is_(None))
+           .first())
+
+    if row is None:
+        return error_response(404, "User not found.")
+
+    return json_response(serialize(row))
+
+
+@api.route('/messages/<int:message_id>')
+def message_detail(message_id):
+    """A single message."""
+
+    serialize = serializer_for('message')
+    row = (db.session
+           .query(*serialize.columns)
+           .select_from(Message)
+           .join(User, User.id == Message.user_id)
+           .filter(Message.id == message_id, User.deleted_at.is_(None))
+           .first())
+
+    if row is None:
+        return error_response(404, "Message not found.")
+
+    return json_response(serialize(row))
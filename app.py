@@ -1,47 +1,115 @@
-import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Blueprint, Flask, Response, abort, render_template, request, flash, redirect, session, g, url_for
 from sqlalchemy.exc import IntegrityError
 
+from api import api
+from assets import assets
+from cache import cache
+from config import load_config
+from deletions import mark_deleted
+from images import images
+from metrics import metrics
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm, UserChangePasswordForm
-from models import db, connect_db, User, Message, Likes
+from group_commit import message_writer
+from models import db, bcrypt, connect_db, User, Message, Likes, Follows, Notification, TrendingSnapshot, DIRECTORY_SORTS
+from notifications import notifications
+from profiler import profiler
+from profiles import profiles, load_profile, profile_user
+from rendering import render_profiler
+from replicas import replicas
+from sessions import sessions
+from shards import shards, MAIN
+from stream import broker, message_event, format_event, KEEPALIVE, RESUME_LIMIT
+from trending import trending, WINDOWS, DEFAULT_WINDOW, KINDS
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+class Views(Blueprint):
+    """A blueprint whose endpoints keep their plain names ('homepage', not 'views.homepage')."""
+
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+        endpoint = endpoint or view_func.__name__
+        self.record(lambda state: state.app.add_url_rule(rule, endpoint, view_func, **options))
+
+
+views = Views('views', __name__)
+
+
+def create_app(env=None):
+    """Build the app for `env` (see config.py).
+
+    Nothing connects to the database here: the engine and its pool are
+    made on first use, so an app created before a fork (gunicorn --preload)
+    doesn't share connections with its workers.
+    """
+
+    app = Flask(__name__)
+    load_config(app.config, env)
+
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    sessions.init_app(app)
+    replicas.init_app(app)
+    shards.init_app(app)
+    bcrypt.init_app(app)
+    notifications.init_app(app)
+    message_writer.init_app(app)
+    assets.init_app(app)
+    images.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    render_profiler.init_app(app)
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+
+    return app
+
+
+_app = None
+
+
+def __getattr__(name):
+    """Build the default app the first time `app.app` is imported."""
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+    global _app
 
-connect_db(app)
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    if _app is None:
+        _app = create_app()
+
+    return _app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@views.before_app_request
+def start_request_timer():
+    """Start timing the request for /metrics."""
+
+    metrics.start_request()
+
+
+@views.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = User.query.filter_by(id=session[CURR_USER_KEY], deleted_at=None).first()
 
     else:
         g.user = None
 
 def do_login(user):
-    """Log in user."""
+    """Log in user, under a new session id."""
 
+    sessions.rotate()
     session[CURR_USER_KEY] = user.id
 
 
@@ -52,7 +120,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -88,7 +156,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -108,7 +176,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -122,44 +190,58 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@views.route('/users')
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, a
+    'sort' param (see DIRECTORY_SORTS) and an 'after' cursor for the
+    next page.
     """
 
     search = request.args.get('q')
+    sort = request.args.get('sort')
+
+    if sort not in DIRECTORY_SORTS:
+        sort = DIRECTORY_SORTS[0]
 
-    if not search:
-        users = User.query.all()
+    users, next_cursor = User.directory_page(
+        sort=sort, search=search, after=request.args.get('after'))
+
+    if g.user:
+        edges = User.follow_edges([g.user.id], [user.id for user in users])
+        viewer_following = {followed_id for (follower_id, followed_id) in edges
+                            if follower_id == g.user.id}
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        viewer_following = set()
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, search=search,
+                           sort=sort, sorts=DIRECTORY_SORTS,
+                           next_cursor=next_cursor,
+                           viewer_following=viewer_following)
 
 
-@app.route('/users/<int:user_id>')
+@views.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    # header, stats and latest messages in one (cached) bundle
+    if g.user:
+        bundle, viewer_follows = load_profile(user_id, g.user.id)
+    else:
+        bundle, viewer_follows = load_profile(user_id)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    
-    likes = Likes.query.filter_by(user_id=user_id).count()
+    if bundle is None:
+        abort(404)
+
+    header, messages = bundle
 
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    return render_template('users/show.html', user=profile_user(header),
+                           messages=messages, likes=header.likes_count,
+                           viewer_follows=viewer_follows)
 
 
-@app.route('/users/<int:user_id>/following')
+@views.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -167,11 +249,10 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for('homepage'))
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return render_follows_page(user_id, 'following', 'users/following.html')
 
 
-@app.route('/users/<int:user_id>/followers')
+@views.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -179,11 +260,41 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for('homepage'))
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    return render_follows_page(user_id, 'followers', 'users/followers.html')
+
+
+def render_follows_page(user_id, direction, template):
+    """Render one page of a user's followers or following.
+
+    The header and stats come from the cached profile bundle, and follow
+    state for the whole page (mutual badges and the viewer's
+    follow/unfollow buttons) is looked up in one query.
+    """
 
+    bundle, viewer_follows = load_profile(user_id, g.user.id)
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+    if bundle is None:
+        abort(404)
+
+    user = profile_user(bundle[0])
+    after = request.args.get('after', type=int)
+
+    cards, next_cursor = User.follows_page(user_id, direction, after=after)
+
+    card_ids = [card.id for card in cards]
+    edges = User.follow_edges({user.id, g.user.id}, card_ids)
+
+    mutual = {card_id for card_id in card_ids
+              if (user.id, card_id) in edges and (card_id, user.id) in edges}
+    viewer_following = {followed_id for (follower_id, followed_id) in edges
+                        if follower_id == g.user.id}
+
+    return render_template(template, user=user, cards=cards,
+                           mutual=mutual, viewer_following=viewer_following,
+                           viewer_follows=viewer_follows, next_cursor=next_cursor)
+
+
+@views.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -191,14 +302,18 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for('homepage'))
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = User.query.filter_by(id=follow_id, deleted_at=None).first_or_404()
     g.user.following.append(followed_user)
+    followed_user.followers_count = User.followers_count + 1
+    profiles.bump(g.user.id, follow_id)
     db.session.commit()
 
+    notifications.notify(follow_id, 'follow', g.user.id)
+
     return redirect(url_for('show_following', user_id=g.user.id))
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@views.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -206,27 +321,53 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for('homepage'))
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+
+    removed = (Follows.query
+                      .filter_by(user_following_id=g.user.id, user_being_followed_id=follow_id)
+                      .delete(synchronize_session=False))
+
+    # (a repeated unfollow finds nothing to remove, and mustn't count again)
+    if removed == 1:
+        followed_user.followers_count = User.followers_count - 1
+    profiles.bump(g.user.id, follow_id)
     db.session.commit()
 
     return redirect(url_for('show_following', user_id=g.user.id))
 
-@app.route('/users/<int:user_id>/likes', methods=['GET', 'POST'])
+@views.route('/users/<int:user_id>/likes', methods=['GET', 'POST'])
 def show_likes(user_id):
+    """Show the messages a user liked, most recently liked first.
+
+    Can take an 'after' param: the cursor for the next page.
+    """
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect(url_for('homepage'))
-    
-    likes = [like.message_id for like in Likes.query.filter_by(user_id=user_id).all()]
 
-    messages = Message.query.filter(Message.id.in_(likes)).order_by(Message.timestamp.desc()).limit(100).all()
+    message_ids, next_cursor = Likes.feed_page(user_id, request.args.get('after'))
+    messages = cache.get_messages(message_ids)
 
-    return render_template('users/likes.html', messages=messages, likes=likes)
+    # the viewer's like buttons, for this page only
+    if user_id == g.user.id:
+        likes = set(message_ids)
+    else:
+        likes = Likes.liked_among(g.user.id, message_ids)
+
+    # the viewer's stats, from their (cached) profile bundle
+    bundle, _ = load_profile(g.user.id, g.user.id)
+    viewer = profile_user(bundle[0])
 
-@app.route('/users/add_like/<int:message_id>', methods=['POST'])
+    return render_template('users/likes.html', messages=messages, likes=likes,
+                           user_id=user_id, next_cursor=next_cursor, viewer=viewer)
+
+@views.route('/users/add_like/<int:message_id>', methods=['POST'])
 def message_like(message_id):
-    user_message = Message.query.get_or_404(message_id)
+    # the message may be on any shard, or archived
+    user_message = cache.get_message(message_id)
+    if user_message is None:
+        abort(404)
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -235,31 +376,33 @@ def message_like(message_id):
     if g.user.id == user_message.user_id:
         flash('You cannot like your own post', 'warning')
         return redirect(url_for('homepage')) 
-    try:
-        new_like = Likes(user_id=g.user.id, message_id=message_id)
-
-        db.session.add(new_like)
-        db.session.commit()
 
-        return redirect(url_for('homepage'))
-    except IntegrityError:
+    if not Likes.add(g.user.id, message_id):
         flash('Post already liked', 'danger')
         return redirect(url_for('homepage'))
+
+    profiles.bump(g.user.id)
+    db.session.commit()
+
+    trending.record_like(message_id)
+    notifications.notify(user_message.user_id, 'like', g.user.id, message_id)
+    trending.maybe_snapshot()
+
+    return redirect(url_for('homepage'))
     
-@app.route('/users/remove_like/<int:message_id>', methods=['POST'])
+@views.route('/users/remove_like/<int:message_id>', methods=['POST'])
 def message_remove_like(message_id):
-    user_message = Message.query.get_or_404(message_id)
-
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect(url_for('homepage'))
 
-    g.user.likes.remove(user_message)
+    Likes.remove(g.user.id, message_id)
+    profiles.bump(g.user.id)
     db.session.commit()
 
     return redirect(url_for('homepage'))
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@views.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -283,7 +426,9 @@ def profile():
             cur_u.header_image_url = form.header_image_url.data
             cur_u.bio = form.bio.data
 
+            profiles.bump(cur_u.id)
             db.session.commit()
+            cache.invalidate_user(cur_u.id)
 
             return redirect(url_for('users_show', user_id=cur_u.id))
         flash('Incorrect username or password', 'danger')
@@ -291,7 +436,7 @@ def profile():
 
     return render_template('users/edit.html', form=form, user_id=cur_u.id)
 
-@app.route('/users/profile/password-change', methods=['GET','POST'])
+@views.route('/users/profile/password-change', methods=['GET','POST'])
 def change_password():
     ''' Update password for current user.'''
     if not g.user:
@@ -310,13 +455,16 @@ def change_password():
             cur_u.change_password(form.new_password.data)
             db.session.commit()
 
+            # log out everywhere else, in case the old password was known
+            sessions.revoke_user(cur_u.id)
+
             return redirect(url_for('users_show', user_id=cur_u.id))
         flash('Incorrect password', 'danger')
         return redirect(url_for('change_password'))
     return render_template('users/change-password.html', form=form)
 
 
-@app.route('/users/delete', methods=["POST"])
+@views.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -326,8 +474,20 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # the follows rows go with the user, so take them out of the counts now
+    followed_ids = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == g.user.id))
+    (User.query
+         .filter(User.id.in_(followed_ids))
+         .update({User.followers_count: User.followers_count - 1},
+                 synchronize_session=False))
+
+    # hide the account now; deletions.py removes its rows in the background
+    mark_deleted(g.user)
+    profiles.bump(g.user.id)
     db.session.commit()
+    cache.invalidate_user(g.user.id)
 
     return redirect(url_for('signup'))
 
@@ -335,7 +495,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -349,24 +509,43 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        # a move of this user waits until the message is in
+        # (the message writer bumps the profile, in the message's commit)
+        if shards.hold_user(g.user) == MAIN:
+            msg = message_writer.post(g.user, form.text.data)
+        else:
+            msg = shards.post_message(g.user, form.text.data)
+            profiles.bump(g.user.id)
+            db.session.commit()
+
+        cache.put_message(msg)
+        trending.record_message(msg)
+
+        # notifications can only point at messages on the primary so far
+        if g.user.shard == MAIN:
+            notifications.notify_mentions(msg)
+        broker.publish(*message_event(msg, msg.sort_key))
+        trending.maybe_snapshot()
 
         return redirect(url_for('users_show', user_id=g.user.id))
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@views.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    # the message may be on any shard, or archived
+    msg = cache.get_message(message_id)
+
+    if msg is None:
+        abort(404)
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@views.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -374,18 +553,146 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for('homepage'))
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    if shards.hold_user(g.user) == MAIN:
+        msg = Message.query.get(message_id)
+        db.session.delete(msg)
+        user_id = msg.user_id
+    else:
+        if not shards.delete_message(g.user, message_id):
+            abort(404)
+        user_id = g.user.id
+
+    Message.delete_refs([message_id])
+    profiles.bump(user_id)
     db.session.commit()
 
+    cache.invalidate_message(message_id)
+
     return redirect(url_for('users_show', user_id=g.user.id))
 
 
+##############################################################################
+# Live timeline
+
+
+@views.route('/stream/timeline')
+def stream_timeline():
+    """Stream new messages from followed users as Server-Sent Events.
+
+    Honors the Last-Event-ID header that EventSource sends on reconnect,
+    replaying what was missed from the broker or, failing that, the DB.
+    """
+
+    if not g.user:
+        return Response("Access unauthorized.", status=401)
+
+    following = shards.following(g.user) + [(g.user.id, g.user.shard)]
+    authors = {user_id for user_id, _ in following}
+
+    subscriber = broker.subscribe(authors)
+    backlog = []
+
+    # event ids are sort keys (see stream.py)
+    last_id = request.headers.get('Last-Event-ID', type=int)
+
+    if last_id is not None:
+        backlog = broker.replay(authors, last_id)
+
+        if backlog is None:
+            backlog = [message_event(msg, sort_key)
+                       for sort_key, msg in shards.newer(following, last_id, RESUME_LIMIT)]
+
+    # don't hold a DB connection for the life of the stream
+    db.session.close()
+
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+
+            replayed = set()
+            for event_id, author_id, data in backlog:
+                replayed.add(event_id)
+                yield format_event(event_id, data)
+
+            while not subscriber.evicted:
+                pending = subscriber.get(KEEPALIVE)
+
+                if not pending:
+                    yield ": keepalive\n\n"
+
+                for event_id, author_id, data in pending:
+                    if event_id not in replayed:
+                        yield format_event(event_id, data)
+
+        finally:
+            broker.unsubscribe(subscriber)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+##############################################################################
+# Notifications
+
+
+@views.route('/notifications')
+def show_notifications():
+    """Show the current user's notifications, most recent first.
+
+    Can take an 'after' cursor for the next page. Viewing the inbox marks
+    everything in it read.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect(url_for('homepage'))
+
+    rows, next_cursor = Notification.inbox_page(
+        g.user.id, after=request.args.get('after'))
+
+    if g.user.unread_notifications:
+        Notification.mark_all_read(g.user.id)
+        db.session.commit()
+
+    return render_template('notifications.html', notifications=rows,
+                           next_cursor=next_cursor)
+
+
+##############################################################################
+# Trending
+
+
+@views.route('/trending')
+def show_trending():
+    """Show trending hashtags, mentions and messages.
+
+    Can take a 'window' param (one of WINDOWS). Served from the in-memory
+    counters; if this process hasn't counted anything yet (e.g. it just
+    started), falls back to the last snapshot in the DB.
+    """
+
+    window = request.args.get('window')
+
+    if window not in WINDOWS:
+        window = DEFAULT_WINDOW
+
+    top = {kind: trending.top(window, kind) or TrendingSnapshot.latest(window, kind)
+           for kind in KINDS}
+
+    message_ids = [int(key) for key, score in top['message']]
+
+    messages = cache.get_messages(message_ids)
+
+    return render_template('trending.html', window=window, windows=WINDOWS,
+                           hashtags=top['hashtag'], mentions=top['mention'],
+                           messages=messages)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@views.route('/')
 def homepage():
     """Show homepage:
 
@@ -394,13 +701,18 @@ def homepage():
     """
 
     if g.user:
-        following = [user.id for user in g.user.following] + [g.user.id]
+        # followed users' messages may be spread over several shards
+        following = shards.following(g.user)
+        messages = shards.timeline(following + [(g.user.id, g.user.shard)], 100)
 
-        messages = Message.query.filter(Message.user_id.in_(following)).order_by(Message.timestamp.desc()).limit(100).all()
+        # the viewer's like buttons, for this page only
+        likes = Likes.liked_among(g.user.id, [msg.id for msg in messages])
 
-        likes = [like.message_id for like in Likes.query.filter_by(user_id=g.user.id).all()]
+        # the viewer's stats, from their (cached) profile bundle
+        bundle, _ = load_profile(g.user.id, g.user.id)
+        viewer = profile_user(bundle[0])
 
-        return render_template('home.html', messages=messages, likes=likes)
+        return render_template('home.html', messages=messages, likes=likes, viewer=viewer)
 
     else:
         return render_template('home-anon.html')
@@ -413,12 +725,23 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@views.after_app_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request, except assets and images."""
+
+    if request.endpoint in ('asset', 'image'):
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
     return req
+
+
+@views.after_app_request
+def record_request_metrics(resp):
+    """Record the request's endpoint, status, time and SQL statements for /metrics."""
+
+    metrics.end_request(request.endpoint, request.method, resp.status_code)
+    return resp
@@ -0,0 +1,566 @@
+"""ASGI entry point: async read-heavy routes alongside the Flask app.
+
+GET requests for the homepage, user profiles, single messages and user
+search are served by coroutines that query through a pooled async driver
+(asyncpg), so a slow query parks a coroutine instead of tying up a worker
+thread; independent queries for a page run concurrently. Everything else
+(forms, writes, pages needing flashed messages, the API, ...) is passed
+through to the existing Flask app, run in a thread pool.
+
+run like:
+
+   uvicorn asgi:application --workers 4
+
+The pages render the same templates as the sync routes. Set
+ASYNC_DATABASE_URL to point the pool somewhere other than
+SQLALCHEMY_DATABASE_URI.
+"""
+
+import asyncio
+import io
+import os
+import re
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from flask import render_template, g
+
+from app import app, CURR_USER_KEY
+from models import DIRECTORY_PAGE_SIZE, DIRECTORY_SORTS
+from pagination import encode_cursor
+from profiles import Count
+from shards import MAIN
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+# Size of the async connection pool.
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 20
+
+# Threads available to run pass-through requests on the Flask app.
+WSGI_THREADS = 16
+
+
+##############################################################################
+# Databases
+
+
+class AsyncPostgres:
+    """Pooled asyncpg connections."""
+
+    def __init__(self, dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+
+    async def connect(self):
+        if asyncpg is None:
+            raise RuntimeError("The async serving mode needs asyncpg installed")
+
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=self.min_size, max_size=self.max_size)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def fetch(self, sql, *args):
+        return await self.pool.fetch(sql, *args)
+
+    async def fetchrow(self, sql, *args):
+        return await self.pool.fetchrow(sql, *args)
+
+
+sqlite3.register_converter(
+    'DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+
+
+class LatencySQLite:
+    """Stand-in for AsyncPostgres on a SQLite file, with injected latency.
+
+    Every query waits `latency` seconds (without blocking the event loop)
+    before running, to mimic a round trip to a remote database. At most
+    `max_size` queries are in flight at once, like a pool. For tests and
+    benchmarks.
+    """
+
+    PLACEHOLDER_RE = re.compile(r'\$(\d+)')
+
+    def __init__(self, path, latency=0.0, max_size=POOL_MAX_SIZE):
+        self.path = path
+        self.latency = latency
+        self.max_size = max_size
+        self.local = threading.local()
+        self.executor = None
+        self.slots = None
+
+    async def connect(self):
+        self.executor = ThreadPoolExecutor(self.max_size)
+        self.slots = asyncio.Semaphore(self.max_size)
+
+    async def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def _run(self, sql, args):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(
+                self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+            conn.row_factory = sqlite3.Row
+
+        # asyncpg's $n placeholders -> sqlite's positional ?s
+        order = [int(n) - 1 for n in self.PLACEHOLDER_RE.findall(sql)]
+        sql = self.PLACEHOLDER_RE.sub('?', sql)
+
+        return conn.execute(sql, [args[i] for i in order]).fetchall()
+
+    async def fetch(self, sql, *args):
+        async with self.slots:
+            await asyncio.sleep(self.latency)
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, self._run, sql, args)
+
+    async def fetchrow(self, sql, *args):
+        rows = await self.fetch(sql, *args)
+        return rows[0] if rows else None
+
+
+##############################################################################
+# Queries
+#
+# Plain SQL that runs on both Postgres and SQLite.
+
+USER_SQL = """
+    SELECT id, username, image_url, header_image_url, bio, location,
+           unread_notifications, followers_count, shard,
+           (SELECT count(*) FROM messages
+             WHERE messages.user_id = users.id) AS messages_count,
+           (SELECT count(*) FROM follows
+             WHERE follows.user_following_id = users.id) AS following_count,
+           (SELECT count(*) FROM likes
+             WHERE likes.user_id = users.id) AS likes_count
+      FROM users
+     WHERE id = $1 AND deleted_at IS NULL
+"""
+
+FOLLOWING_SQL = """
+    SELECT f.user_being_followed_id, u.shard
+      FROM follows f
+      JOIN users u ON u.id = f.user_being_followed_id
+     WHERE f.user_following_id = $1
+"""
+
+TIMELINE_SQL = """
+    SELECT m.id, m.text, m.timestamp, u.id, u.username, u.image_url,
+           EXISTS (SELECT 1 FROM likes
+                    WHERE likes.user_id = $1 AND likes.message_id = m.id) AS liked
+      FROM messages m
+      JOIN users u ON u.id = m.user_id
+     WHERE (m.user_id = $1
+            OR m.user_id IN (SELECT user_being_followed_id FROM follows
+                              WHERE user_following_id = $1))
+       AND u.deleted_at IS NULL
+     ORDER BY m.sort_key DESC
+     LIMIT 100
+"""
+
+USER_MESSAGES_SQL = """
+    SELECT id, text, timestamp
+      FROM messages
+     WHERE user_id = $1
+     ORDER BY sort_key DESC
+     LIMIT 100
+"""
+
+MESSAGE_SQL = """
+    SELECT m.id, m.text, m.timestamp, u.id, u.username, u.image_url
+      FROM messages m
+      JOIN users u ON u.id = m.user_id
+     WHERE m.id = $1 AND u.deleted_at IS NULL
+"""
+
+SEARCH_SQL = """
+    SELECT id, username, image_url, header_image_url, bio, followers_count
+      FROM users
+     WHERE username LIKE $1 AND deleted_at IS NULL
+     ORDER BY username
+     LIMIT $2
+"""
+
+
+def user_from_row(row, following_ids=()):
+    """Build a template-ready user from a USER_SQL row."""
+
+    following_ids = frozenset(following_ids)
+
+    return SimpleNamespace(
+        id=row['id'],
+        username=row['username'],
+        image_url=row['image_url'],
+        header_image_url=row['header_image_url'],
+        bio=row['bio'],
+        location=row['location'],
+        unread_notifications=row['unread_notifications'],
+        messages_count=row['messages_count'],
+        following_count=row['following_count'],
+        followers_count=row['followers_count'],
+        likes_count=row['likes_count'],
+        messages=Count(row['messages_count']),
+        following=Count(row['following_count']),
+        followers=Count(row['followers_count']),
+        likes=Count(row['likes_count']),
+        is_following=lambda other: other.id in following_ids,
+    )
+
+
+def message_from_row(row):
+    """Build a template-ready message from a TIMELINE_SQL/MESSAGE_SQL row."""
+
+    message_id, text, timestamp, user_id, username, image_url = tuple(row)[:6]
+
+    return SimpleNamespace(
+        id=message_id, text=text, timestamp=timestamp,
+        user=SimpleNamespace(id=user_id, username=username,
+                             image_url=image_url))
+
+
+##############################################################################
+# ASGI app
+
+
+class Request:
+    """The parts of an ASGI HTTP scope the async routes need."""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.args = {key: values[0] for key, values
+                     in parse_qs(self.query_string).items()}
+        self.headers = {key.decode('latin-1').lower(): value.decode('latin-1')
+                        for key, value in scope.get('headers', [])}
+        self.cookies = {}
+
+        for part in self.headers.get('cookie', '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name:
+                self.cookies[name] = value
+
+
+class AsyncWarbler:
+    """Serves the async routes and hands every other request to Flask."""
+
+    def __init__(self, flask_app, database):
+        self.flask_app = flask_app
+        self.database = database
+        self.executor = ThreadPoolExecutor(WSGI_THREADS)
+        self.routes = [
+            (re.compile(r'^/$'), self.homepage),
+            (re.compile(r'^/users$'), self.search_users),
+            (re.compile(r'^/users/(\d+)$'), self.users_show),
+            (re.compile(r'^/messages/(\d+)$'), self.messages_show),
+        ]
+        self.connected = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] == 'GET':
+            await self.ensure_connected()
+
+            for pattern, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match:
+                    response = await handler(Request(scope), *match.groups())
+                    if response is not None:
+                        await self.send_html(send, *response)
+                        return
+                    break
+
+        await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            event = await receive()
+
+            if event['type'] == 'lifespan.startup':
+                await self.ensure_connected()
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                if self.connected:
+                    await self.database.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def ensure_connected(self):
+        if self.connected is None:
+            self.connected = asyncio.ensure_future(self.database.connect())
+        await asyncio.shield(self.connected)
+
+    def session(self, request):
+        """Open the Flask session from the request's cookie, wherever it's kept.
+
+        Only reads it: any change is made by a Flask request.
+        """
+
+        return self.flask_app.session_interface.open_session(
+            self.flask_app, request) or {}
+
+    def render(self, request, viewer, template, **context):
+        with self.flask_app.test_request_context(
+                request.path, query_string=request.query_string):
+            g.user = viewer
+            # (the viewer's stats are on it too: home.html reads them as `viewer`)
+            return render_template(template, viewer=viewer, **context)
+
+    async def send_html(self, send, status, body):
+        body = body.encode('UTF-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'text/html; charset=utf-8'),
+                (b'content-length', str(len(body)).encode()),
+                (b'cache-control', b'public, max-age=0'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def load_viewer(self, request):
+        """Get (session, viewer user or None, viewer's followed ids).
+
+        The viewer gets a `shards` attribute: the shards holding their and
+        their followed users' messages.
+
+        Returns None if the request should be handled by Flask instead: the
+        session has flashed messages waiting, which only Flask can consume.
+        """
+
+        session = self.session(request)
+
+        if '_flashes' in session:
+            return None
+
+        user_id = session.get(CURR_USER_KEY)
+
+        if user_id is None:
+            return session, None, set()
+
+        row, following = await asyncio.gather(
+            self.database.fetchrow(USER_SQL, user_id),
+            self.database.fetch(FOLLOWING_SQL, user_id))
+
+        if row is None:
+            return session, None, set()
+
+        following_ids = {followed_id for followed_id, _ in following}
+        viewer = user_from_row(row, following_ids)
+        viewer.shards = {row['shard']} | {shard for _, shard in following}
+
+        return session, viewer, following_ids
+
+    ##########################################################################
+    # Routes; each returns (status, html), or None to defer to Flask
+
+    async def homepage(self, request):
+        loaded = await self.load_viewer(request)
+
+        if loaded is None:
+            return None
+
+        session, viewer, following_ids = loaded
+
+        if viewer is None:
+            return 200, self.render(request, None, 'home-anon.html')
+
+        # TIMELINE_SQL only reads main; Flask gathers the other shards
+        if viewer.shards != {MAIN}:
+            return None
+
+        timeline = await self.database.fetch(TIMELINE_SQL, viewer.id)
+
+        return 200, self.render(
+            request, viewer, 'home.html',
+            messages=[message_from_row(row) for row in timeline],
+            likes={row[0] for row in timeline if row['liked']})
+
+    async def users_show(self, request, user_id):
+        user_id = int(user_id)
+        loaded, row, messages = await asyncio.gather(
+            self.load_viewer(request),
+            self.database.fetchrow(USER_SQL, user_id),
+            self.database.fetch(USER_MESSAGES_SQL, user_id))
+
+        # a user on another shard has their messages there
+        if loaded is None or row is None or row['shard'] != MAIN:
+            return None
+
+        user = user_from_row(row)
+
+        return 200, self.render(
+            request, loaded[1], 'users/show.html', user=user,
+            messages=[SimpleNamespace(id=message_id, text=text,
+                                      timestamp=timestamp)
+                      for message_id, text, timestamp in messages],
+            likes=len(user.likes))
+
+    async def messages_show(self, request, message_id):
+        loaded, row = await asyncio.gather(
+            self.load_viewer(request),
+            self.database.fetchrow(MESSAGE_SQL, int(message_id)))
+
+        if loaded is None or row is None:
+            return None
+
+        return 200, self.render(request, loaded[1], 'messages/show.html',
+                                message=message_from_row(row))
+
+    async def search_users(self, request):
+        search = request.args.get('q')
+
+        # only the first page of a plain username search is served here
+        if not search or 'after' in request.args or 'sort' in request.args:
+            return None
+
+        loaded, users = await asyncio.gather(
+            self.load_viewer(request),
+            self.database.fetch(SEARCH_SQL, f"%{search}%", DIRECTORY_PAGE_SIZE + 1))
+
+        if loaded is None:
+            return None
+
+        next_cursor = None
+
+        if len(users) > DIRECTORY_PAGE_SIZE:
+            # the same cursor User.directory_page() uses for its username sort
+            users = users[:DIRECTORY_PAGE_SIZE]
+            next_cursor = encode_cursor([users[-1]['username']])
+
+        return 200, self.render(
+            request, loaded[1], 'users/index.html',
+            users=[SimpleNamespace(id=row['id'], username=row['username'],
+                                   image_url=row['image_url'],
+                                   header_image_url=row['header_image_url'],
+                                   bio=row['bio'],
+                                   followers_count=row['followers_count'])
+                   for row in users],
+            search=search, sort=DIRECTORY_SORTS[0], sorts=DIRECTORY_SORTS,
+            next_cursor=next_cursor, viewer_following=loaded[2])
+
+    ##########################################################################
+    # Pass-through to Flask
+
+    async def call_wsgi(self, scope, receive, send):
+        """Run the Flask app for this request on the thread pool."""
+
+        body = b''
+        more = True
+
+        while more:
+            event = await receive()
+            body += event.get('body', b'')
+            more = event.get('more_body', False)
+
+        environ = wsgi_environ(scope, body)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'),
+                                   value.encode('latin-1'))
+                                  for name, value in headers]
+
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(
+            self.executor, self.flask_app, environ, start_response)
+        chunks = iter(result)
+        done = object()
+
+        try:
+            chunk = await loop.run_in_executor(self.executor, next, chunks, done)
+
+            await send({'type': 'http.response.start',
+                        'status': started['status'],
+                        'headers': started['headers']})
+
+            # stream chunk by chunk, so e.g. /stream/timeline still streams
+            while chunk is not done:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+                chunk = await loop.run_in_executor(
+                    self.executor, next, chunks, done)
+
+            await send({'type': 'http.response.body', 'body': b''})
+
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+
+
+def wsgi_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP scope."""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    return environ
+
+
+def create_application(database=None):
+    """Build the ASGI app, by default on an asyncpg pool."""
+
+    if database is None:
+        dsn = os.environ.get('ASYNC_DATABASE_URL',
+                             app.config['SQLALCHEMY_DATABASE_URI'])
+        database = AsyncPostgres(dsn)
+
+    return AsyncWarbler(app, database)
+
+
+application = create_application()
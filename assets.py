@@ -0,0 +1,283 @@
+"""Static asset pipeline.
+
+The stylesheets and scripts base.html needs are vendored under
+static/vendor/ at pinned versions, rather than pulled from a CDN, and
+built into two bundles, app.css and app.js. The build (`python assets.py`)
+writes them, and every file they or the templates reference, to
+ASSETS_DIR:
+
+- CSS is minified; the vendored scripts are already minified and only
+  have their source map comments dropped;
+- every file is named by a hash of its content (app.3f9c2a1b7d4e.css), and
+  url(...)s in the CSS are rewritten to the hashed names;
+- text files get .gz and (if brotli is installed) .br variants, compressed
+  once here rather than on every request;
+- manifest.json maps logical names to hashed ones. It's written last, so a
+  server never reads a manifest naming files that aren't there yet.
+
+/assets/ serves the hashed files with a one-year immutable Cache-Control,
+since a changed file gets a new name, picking the precompressed variant
+the browser accepts. Without a build (e.g. in development) the templates
+link the source files under /static/ instead.
+"""
+
+import glob
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+from flask import abort, current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# Bundles and their sources, in order, relative to STATIC_DIR.
+BUNDLES = {
+    'app.css': (
+        'vendor/bootstrap-4.6.2/bootstrap.min.css',
+        'vendor/fontawesome-6.6.0/css/fontawesome.min.css',
+        'vendor/fontawesome-6.6.0/css/solid.min.css',
+        'stylesheets/style.css',
+    ),
+    'app.js': (
+        'vendor/jquery-3.5.1/jquery.min.js',
+        'vendor/popper-1.16.1/popper.min.js',
+        'vendor/bootstrap-4.6.2/bootstrap.min.js',
+    ),
+}
+
+# Files the templates link to directly, besides the bundles.
+FILES = ('favicon.ico', 'images/*')
+
+MANIFEST = 'manifest.json'
+
+HASH_LENGTH = 12
+
+# A year: hashed files never change, so browsers needn't revalidate them.
+MAX_AGE = 365 * 24 * 60 * 60
+
+COMPRESSIBLE = ('.css', '.js', '.ico', '.svg')
+
+# Precompressed variants as (suffix, Content-Encoding), most preferred first.
+ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'))
+
+TOKEN_RE = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|/\*.*?\*/)''', re.S)
+URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+EXTERNAL_RE = re.compile(r'^(data:|[a-z]+:|//|#)', re.I)
+SOURCE_MAP_RE = re.compile(r'^\s*(//|/\*)# sourceMappingURL=.*$', re.M)
+
+
+##############################################################################
+# Build
+
+
+def _squeeze(css):
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}')
+
+
+def minify_css(css):
+    """Drop comments (except /*! licences */) and needless whitespace."""
+
+    out = []
+    plain = ''
+
+    for i, token in enumerate(TOKEN_RE.split(css)):
+        if not i % 2:
+            plain += token
+        elif token.startswith('/*') and not token.startswith('/*!'):
+            continue
+        else:
+            out.extend([_squeeze(plain), token])
+            plain = ''
+
+    out.append(_squeeze(plain))
+    return ''.join(out).strip()
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.partial'
+    with open(partial, 'wb') as out:
+        out.write(data)
+    os.replace(partial, path)
+
+
+def compress(data):
+    """Get {encoding: bytes} for each variant smaller than `data`."""
+
+    variants = {'gzip': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+
+    return {encoding: packed for encoding, packed in variants.items()
+            if len(packed) < len(data)}
+
+
+def build(out_dir, static_dir=STATIC_DIR):
+    """Build every bundle and file into `out_dir`; returns the manifest."""
+
+    files = {}
+    encoded = {}
+
+    def add(name, data):
+        root, ext = posixpath.splitext(name)
+        hashed = f"{root}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+        path = os.path.join(out_dir, hashed)
+
+        # a hashed name always has the same content, so an earlier build's
+        # file (written after its variants) can be kept as is
+        if not os.path.exists(path):
+            variants = compress(data) if ext in COMPRESSIBLE else {}
+            for suffix, encoding in ENCODINGS:
+                if encoding in variants:
+                    _write(path + suffix, variants[encoding])
+            _write(path, data)
+
+        files[name] = hashed
+        encoded[hashed] = [encoding for suffix, encoding in ENCODINGS
+                           if os.path.exists(path + suffix)]
+        return hashed
+
+    def add_file(name):
+        if name not in files:
+            with open(os.path.join(static_dir, name), 'rb') as source:
+                add(name, source.read())
+        return files[name]
+
+    def rewrite_urls(css, source):
+        def replace(match):
+            url = match.group(2).strip()
+            if EXTERNAL_RE.match(url):
+                return match.group(0)
+
+            name = re.split(r'[?#]', url)[0]
+            if name.startswith('/static/'):
+                name = name[len('/static/'):]
+            else:
+                name = posixpath.normpath(posixpath.join(posixpath.dirname(source), name))
+
+            # bundles sit at the top of out_dir, so the hashed name is the url
+            return f"url({add_file(name)})"
+
+        return URL_RE.sub(replace, css)
+
+    for pattern in FILES:
+        for path in sorted(glob.glob(os.path.join(static_dir, pattern))):
+            add_file(os.path.relpath(path, static_dir).replace(os.sep, '/'))
+
+    for name, sources in BUNDLES.items():
+        parts = []
+        for source in sources:
+            with open(os.path.join(static_dir, source), encoding='UTF-8') as f:
+                text = f.read()
+            if name.endswith('.css'):
+                parts.append(rewrite_urls(minify_css(text), source))
+            else:
+                parts.append(SOURCE_MAP_RE.sub('', text).strip())
+
+        add(name, ('\n' if name.endswith('.css') else ';\n').join(parts).encode('UTF-8'))
+
+    manifest = {'files': files, 'encoded': encoded}
+    _write(os.path.join(out_dir, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('UTF-8'))
+
+    return manifest
+
+
+##############################################################################
+# Serving
+
+
+class Assets:
+    """Links to and serves the built assets."""
+
+    def __init__(self):
+        self.manifest = None
+
+    def init_app(self, app):
+        """Add the /assets/ route and the asset_url()/asset_urls() template globals."""
+
+        app.config.setdefault('ASSETS_DIR', os.path.join(app.root_path, 'assets'))
+        app.add_url_rule('/assets/<path:filename>', 'asset', self.send)
+        app.add_template_global(self.url, 'asset_url')
+        app.add_template_global(self.urls, 'asset_urls')
+
+    def load(self):
+        """Get the build's manifest (empty if assets haven't been built)."""
+
+        if self.manifest is None:
+            try:
+                with open(os.path.join(current_app.config['ASSETS_DIR'], MANIFEST)) as f:
+                    self.manifest = json.load(f)
+            except FileNotFoundError:
+                self.manifest = {'files': {}, 'encoded': {}}
+
+        return self.manifest
+
+    def reload(self):
+        """Forget the manifest, e.g. after a build or changing ASSETS_DIR."""
+
+        self.manifest = None
+
+    def url(self, name):
+        """URL for a file under static/, hashed if it's been built."""
+
+        hashed = self.load()['files'].get(name)
+        if hashed is None:
+            return url_for('static', filename=name)
+        return url_for('asset', filename=hashed)
+
+    def urls(self, bundle):
+        """URLs to link for `bundle`: the built file, or else its sources."""
+
+        hashed = self.load()['files'].get(bundle)
+        if hashed is None:
+            return [url_for('static', filename=source) for source in BUNDLES[bundle]]
+        return [url_for('asset', filename=hashed)]
+
+    def send(self, filename):
+        """Serve a hashed file, precompressed if the client accepts it."""
+
+        encodings = self.load()['encoded'].get(filename)
+        if encodings is None:
+            abort(404)
+
+        suffix, encoding = next(((suffix, encoding) for suffix, encoding in ENCODINGS
+                                 if encoding in encodings
+                                 and request.accept_encodings[encoding]),
+                                ('', None))
+
+        response = send_from_directory(
+            current_app.config['ASSETS_DIR'], filename + suffix,
+            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            conditional=True,
+            cache_timeout=MAX_AGE)
+
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if encodings:
+            response.vary.add('Accept-Encoding')
+
+        response.headers['Cache-Control'] = f"public, max-age={MAX_AGE}, immutable"
+        return response
+
+
+assets = Assets()
+
+
+if __name__ == '__main__':
+    from app import app
+
+    manifest = build(app.config['ASSETS_DIR'])
+    print(f"built {len(manifest['files'])} assets into {app.config['ASSETS_DIR']}")
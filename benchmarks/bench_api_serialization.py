@@ -0,0 +1,76 @@
+"""JSON serialization vs. HTML rendering of a 100-message timeline.
+
+Times the API's column-tuple serializer + json_response() against rendering
+home.html for the same messages. Runs without a database: rows and model
+stand-ins are built in memory.
+
+run like:
+
+   python -m benchmarks.bench_api_serialization [iterations]
+"""
+
+import sys
+import timeit
+from datetime import datetime
+from types import SimpleNamespace
+
+from flask import g
+
+from api import serializer_for, json_response
+from app import app
+
+MESSAGES = 100
+ITERATIONS = 200
+
+
+def make_rows():
+    return [(i, f'warble number {i} ' * 4, datetime(2020, 1, 1, 12, i % 60),
+             i % 10, f'user{i % 10}', '/static/images/default-pic.png')
+            for i in range(MESSAGES)]
+
+
+def make_objects(rows):
+    return [SimpleNamespace(
+        id=message_id, text=text, timestamp=timestamp,
+        user=SimpleNamespace(id=user_id, username=username, image_url=image_url))
+        for message_id, text, timestamp, user_id, username, image_url in rows]
+
+
+def run(iterations=ITERATIONS):
+    rows = make_rows()
+    messages = make_objects(rows)
+    viewer = SimpleNamespace(id=1, username='viewer', image_url='', header_image_url='',
+                             messages=[], following=[], followers=[],
+                             unread_notifications=0)
+
+    with app.test_request_context('/api/v1/timeline',
+                                  headers={'Accept-Encoding': 'identity'}):
+        serialize = serializer_for('message')
+
+        def as_json():
+            return json_response({'messages': [serialize(row) for row in rows],
+                                  'next': None}).get_data()
+
+        json_size = len(as_json())
+        json_time = timeit.timeit(as_json, number=iterations)
+
+    with app.test_request_context('/'):
+        g.user = viewer
+        template = app.jinja_env.get_template('home.html')
+
+        def as_html():
+            return template.render(messages=messages, likes=[], g=g,
+                                   request=SimpleNamespace(endpoint='homepage'),
+                                   get_flashed_messages=lambda **kw: [])
+
+        html_size = len(as_html())
+        html_time = timeit.timeit(as_html, number=iterations)
+
+    for name, total, size in (('json', json_time, json_size),
+                              ('html', html_time, html_size)):
+        print(f"{name}: {iterations / total:8.0f} timelines/s, "
+              f"{total / iterations * 1e3:6.2f} ms each, {size} bytes")
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,125 @@
+"""Sync Flask vs. async ASGI homepage throughput under DB latency.
+
+Builds a throwaway SQLite database, then serves REQUESTS homepage views
+both ways with every query delayed by LATENCY seconds:
+
+- sync: the Flask app on a pool of THREADS threads (like gunicorn --threads);
+- async: asgi.AsyncWarbler on the latency-injecting SQLite stand-in, with
+  up to CONCURRENCY requests in flight.
+
+run like:
+
+   python -m benchmarks.bench_asgi [latency_ms] [requests]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{PATH}'
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from asgi import AsyncWarbler, LatencySQLite
+from models import db, User, Message, Follows
+
+LATENCY = 0.02
+REQUESTS = 200
+THREADS = 8
+CONCURRENCY = 100
+USERS = 50
+
+
+def seed():
+    db.create_all()
+    db.session.add_all([User(username=f'user{i}', email=f'user{i}@test.com',
+                             password='HASHED_PASSWORD')
+                        for i in range(USERS)])
+    db.session.commit()
+    db.session.add_all([Follows(user_being_followed_id=i, user_following_id=1)
+                        for i in range(2, USERS + 1)])
+    start = datetime(2020, 1, 1)
+    db.session.add_all([Message(text=f'warble {i}', user_id=i % USERS + 1,
+                                timestamp=start + timedelta(minutes=i))
+                        for i in range(1000)])
+    db.session.commit()
+
+
+def session_cookie(user_id):
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({CURR_USER_KEY: user_id})
+
+
+def bench_sync(latency, requests):
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def delay(*args):
+        time.sleep(latency)
+
+    cookie = session_cookie(1)
+
+    def one(_):
+        client = app.test_client()
+        client.set_cookie('localhost', 'session', cookie)
+        assert client.get('/').status_code == 200
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(THREADS) as pool:
+        list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    event.remove(db.engine, 'before_cursor_execute', delay)
+    return elapsed
+
+
+def bench_async(latency, requests):
+    application = AsyncWarbler(app, LatencySQLite(PATH, latency))
+    headers = [(b'cookie', f'session={session_cookie(1)}'.encode())]
+    slots = None
+
+    async def one():
+        scope = {'type': 'http', 'method': 'GET', 'path': '/',
+                 'query_string': b'', 'headers': headers}
+        status = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        async with slots:
+            await application(scope, receive, send)
+        assert status == [200]
+
+    async def run():
+        nonlocal slots
+        slots = asyncio.Semaphore(CONCURRENCY)
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+        await application.database.close()
+        return elapsed
+
+    return asyncio.run(run())
+
+
+def run(latency_ms=LATENCY * 1000, requests=REQUESTS):
+    latency = latency_ms / 1000
+
+    with app.app_context():
+        seed()
+        for name, bench in (('sync', bench_sync), ('async', bench_async)):
+            elapsed = bench(latency, requests)
+            print(f"{name:5}: {requests / elapsed:7.1f} req/s "
+                  f"({requests} homepage views, {latency_ms:.0f} ms per query)")
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,87 @@
+"""Message posting throughput with concurrent writers, with and without group commit.
+
+Each writer thread is a different user posting messages as fast as it can
+through the /messages/new route, so everything a post does is timed
+(holding the user against moves, the profile bump, caching, trending):
+
+- per-request: MESSAGE_GROUP_COMMIT off, a COMMIT per post;
+- grouped: MESSAGE_GROUP_COMMIT on, posts from all the threads committed
+  together by the writer thread.
+
+It needs Postgres and rebuilds the tables of the database it's given, so
+point it at a scratch one:
+
+   createdb warbler-bench
+   python -m benchmarks.bench_group_commit [writers] [posts_per_writer]
+"""
+
+import os
+import sys
+import threading
+import time
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message
+
+WRITERS = 16
+POSTS_PER_WRITER = 200
+
+
+def writer(user_id, posts, start):
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        start.wait()
+        for i in range(posts):
+            resp = client.post('/messages/new', data={'text': f'warble {i} from user {user_id}'})
+            assert resp.status_code == 302
+
+
+def run_mode(grouped, writers, posts):
+    """Time `writers` threads making `posts` posts each; returns posts/s."""
+
+    app.config['MESSAGE_GROUP_COMMIT'] = grouped
+    Message.query.delete()
+    db.session.commit()
+
+    start = threading.Barrier(writers + 1)
+    threads = [threading.Thread(target=writer, args=(user_id, posts, start))
+               for user_id in range(1, writers + 1)]
+
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    total = writers * posts
+    assert Message.query.count() == total
+    return total / elapsed
+
+
+def run(writers=WRITERS, posts=POSTS_PER_WRITER):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': writers + 2}
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([User(id=i, username=f'user{i}', email=f'user{i}@test.com',
+                                 password='HASHED_PASSWORD')
+                            for i in range(1, writers + 1)])
+        db.session.commit()
+
+        print(f"{writers} writers x {posts} posts")
+        for name, grouped in (('per-request', False), ('grouped', True)):
+            rate = run_mode(grouped, writers, posts)
+            print(f"{name:>12}: {rate:9.0f} posts/s")
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:3]))
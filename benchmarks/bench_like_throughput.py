@@ -0,0 +1,113 @@
+"""Like throughput with concurrent writers, by how duplicate likes are handled.
+
+Each writer thread is a different user liking random messages from a
+shared pool, so most messages are liked by several users and about half
+the attempts are repeats. Likes are stored two ways:
+
+- exception: the old message_like(), which adds a Likes row, commits and
+  rolls back on IntegrityError;
+- on-conflict: Likes.add(), an INSERT ... ON CONFLICT DO NOTHING.
+
+It needs Postgres (SQLite serialises writers) and rebuilds the tables of
+the database it's given, so point it at a scratch one:
+
+   createdb warbler-bench
+   python -m benchmarks.bench_like_throughput [writers] [likes_per_writer]
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app
+from models import db, User, Message, Likes
+
+WRITERS = 8
+LIKES_PER_WRITER = 1000
+MESSAGES = 1000
+
+
+def like_with_exception(user_id, message_id):
+    try:
+        db.session.add(Likes(user_id=user_id, message_id=message_id))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+
+def like_on_conflict(user_id, message_id):
+    stored = Likes.add(user_id, message_id)
+    db.session.commit()
+    return stored
+
+
+def writer(like, user_id, attempts, start, stored):
+    rng = random.Random(user_id)
+
+    with app.app_context():
+        start.wait()
+        count = 0
+        for _ in range(attempts):
+            count += like(user_id, rng.randint(1, MESSAGES))
+        stored.append(count)
+        db.session.remove()
+
+
+def run_mode(like, writers, attempts):
+    """Time `writers` threads making `attempts` likes each."""
+
+    Likes.query.delete()
+    db.session.commit()
+
+    start = threading.Barrier(writers + 1)
+    stored = []
+    threads = [threading.Thread(target=writer, args=(like, user_id, attempts, start, stored))
+               for user_id in range(1, writers + 1)]
+
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    total = writers * attempts
+    assert sum(stored) == Likes.query.count()
+    return total / elapsed, total - sum(stored)
+
+
+def run(writers=WRITERS, attempts=LIKES_PER_WRITER):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': writers + 1}
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        author = writers + 1
+        db.session.add_all([User(id=i, username=f'user{i}', email=f'user{i}@test.com',
+                                 password='HASHED_PASSWORD')
+                            for i in range(1, author + 1)])
+        db.session.commit()
+        db.session.execute(Message.__table__.insert(), [
+            {'id': i, 'text': f'warble {i}', 'user_id': author, 'sort_key': i}
+            for i in range(1, MESSAGES + 1)])
+        db.session.commit()
+
+        print(f"{writers} writers x {attempts} likes over {MESSAGES} messages")
+        for name, like in (('exception', like_with_exception),
+                           ('on-conflict', like_on_conflict)):
+            rate, repeats = run_mode(like, writers, attempts)
+            print(f"{name:>12}: {rate:9.0f} likes/s   ({repeats} repeats ignored)")
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,105 @@
+"""Likes page query cost as one user's likes grow from 10 to 1M.
+
+Builds a throwaway SQLite database and, at each size, times fetching the
+first page of the user's likes two ways:
+
+- in-list: the old show_likes(), which loads every liked message id and
+  sends them all back in an IN (...) list;
+- keyset: Likes.feed_page(), a join walking ix_likes_user_id_timestamp.
+
+run like:
+
+   python -m benchmarks.bench_likes_feed [max_likes]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{PATH}'
+
+from sqlalchemy.exc import OperationalError
+
+from app import app
+from models import db, User, Message, Likes
+
+SIZES = (10, 1000, 100000, 1000000)
+PAGE = 100
+REPEAT = 5
+
+
+def grow(have, size):
+    """Add messages (by user 2) and likes (by user 1) up to `size`."""
+
+    start = datetime(2020, 1, 1)
+
+    for low in range(have, size, 50000):
+        high = min(size, low + 50000)
+        db.session.execute(Message.__table__.insert(), [
+            {'id': i + 1, 'text': f'warble {i}', 'user_id': 2,
+             'timestamp': start + timedelta(seconds=i), 'sort_key': i + 1}
+            for i in range(low, high)])
+        db.session.execute(Likes.__table__.insert(), [
+            {'user_id': 1, 'message_id': i + 1,
+             'timestamp': start + timedelta(seconds=i)}
+            for i in range(low, high)])
+        db.session.commit()
+
+
+def in_list_page(user_id):
+    likes = [like.message_id for like in Likes.query.filter_by(user_id=user_id).all()]
+    return (db.session.query(Message.id)
+            .filter(Message.id.in_(likes))
+            .order_by(Message.sort_key.desc())
+            .limit(PAGE)
+            .all())
+
+
+def keyset_page(user_id):
+    return Likes.feed_page(user_id, limit=PAGE)
+
+
+def timed(fn):
+    """Best of REPEAT runs, in milliseconds (or the error it hit)."""
+
+    best = None
+
+    for _ in range(REPEAT):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        try:
+            fn(1)
+        except OperationalError as exc:
+            db.session.rollback()
+            return f"fails ({exc.orig})"
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+
+    return f"{best:9.2f} ms"
+
+
+def run(max_likes=SIZES[-1]):
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([User(id=i, username=f'user{i}', email=f'user{i}@test.com',
+                                 password='HASHED_PASSWORD')
+                            for i in (1, 2)])
+        db.session.commit()
+
+        have = 0
+        for size in SIZES:
+            if size > max_likes:
+                break
+
+            grow(have, size)
+            have = size
+
+            print(f"{size:>8} likes:  in-list {timed(in_list_page)}"
+                  f"   keyset {timed(keyset_page)}")
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:2]))
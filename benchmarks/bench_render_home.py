@@ -0,0 +1,99 @@
+"""home.html render cost with 100 messages, without the database.
+
+Renders the logged-in homepage template over and over with a fixed
+context (100 cached messages, as homepage() passes them), and reports:
+
+- cold: the first render in a fresh environment, compiling the templates
+  from source vs loading them from the bytecode cache;
+- warm: per-render time once the templates are loaded, with and without
+  the render profiler;
+- the profiler's per-template and per-block breakdown.
+
+run like:
+
+   python -m benchmarks.bench_render_home [renders]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from flask import g, render_template
+
+from app import app
+from cache import CachedMessage, UserRow
+from rendering import render_profiler, AtomicBytecodeCache
+
+RENDERS = 1000
+MESSAGES = 100
+
+
+def context():
+    start = datetime(2024, 1, 1)
+    authors = [UserRow(i, f'user{i}', f'https://randomuser.me/api/portraits/men/{i}.jpg')
+               for i in range(10)]
+    messages = [CachedMessage(i, f'warble number {i} about #things with @user{i % 10}',
+                              start - timedelta(minutes=i), i % 10, authors[i % 10])
+                for i in range(MESSAGES)]
+    user = SimpleNamespace(id=1, username='user1', image_url=authors[1].image_url,
+                           header_image_url='https://splashbase.example/header.jpg',
+                           messages_count=250, following_count=10,
+                           followers_count=42, unread_notifications=3)
+
+    return user, messages, {msg.id for msg in messages[::3]}
+
+
+def render(user, messages, likes):
+    g.user = user
+    return render_template('home.html', messages=messages, likes=likes, viewer=user)
+
+
+def cold(bytecode_cache, user, messages, likes):
+    """Time the first render after dropping every loaded template."""
+
+    app.jinja_env.bytecode_cache = bytecode_cache
+    app.jinja_env.cache.clear()
+    start = time.perf_counter()
+    render(user, messages, likes)
+    return (time.perf_counter() - start) * 1000
+
+
+def warm(renders, user, messages, likes):
+    start = time.perf_counter()
+    for _ in range(renders):
+        render(user, messages, likes)
+    return (time.perf_counter() - start) * 1e6 / renders
+
+
+def run(renders=RENDERS):
+    user, messages, likes = context()
+    cache = AtomicBytecodeCache(tempfile.mkdtemp())
+
+    with app.test_request_context('/'):
+        print(f"cold, compiled from source: {cold(None, user, messages, likes):7.2f} ms")
+        cold(cache, user, messages, likes)
+        print(f"cold, from bytecode cache:  {cold(cache, user, messages, likes):7.2f} ms")
+
+        render_profiler.enabled = False
+        warm(10, user, messages, likes)
+        print(f"warm, {renders} renders:        {warm(renders, user, messages, likes):7.1f} us each")
+
+        render_profiler.enabled = True
+        render_profiler.clear()
+        print(f"warm, profiled:             {warm(renders, user, messages, likes):7.1f} us each")
+        render_profiler.enabled = False
+
+        print()
+        print(f"{'template':<12} {'block':<12} {'count':>6} {'mean us':>9} {'max us':>9}")
+        for row in render_profiler.report():
+            print(f"{row.template:<12} {row.block or '(template)':<12} {row.count:>6}"
+                  f" {row.total * 1e6 / row.count:>9.1f} {row.max * 1e6:>9.1f}")
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,83 @@
+"""Per-request session cost: signed cookies vs the server-side stores.
+
+Opens and saves a logged-in user's session (their id and a CSRF token)
+the way Flask does around every request, for each session interface:
+
+- read: the session is opened and read, and not changed (most requests);
+- write: a message is flashed, so the session is saved again.
+
+It reports microseconds per request and the size of the session cookie.
+The Redis store is left out: it needs a server to talk to.
+
+run like:
+
+   python -m benchmarks.bench_sessions [requests]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from flask.sessions import SecureCookieSessionInterface
+
+from app import app, CURR_USER_KEY
+from sessions import MemoryStore, SQLiteStore, ServerSessionInterface
+
+REQUESTS = 20000
+
+
+def interfaces():
+    path = os.path.join(tempfile.mkdtemp(), 'sessions.sqlite3')
+
+    return (('signed cookie', SecureCookieSessionInterface()),
+            ('memory', ServerSessionInterface(MemoryStore(), CURR_USER_KEY)),
+            ('sqlite', ServerSessionInterface(SQLiteStore(path), CURR_USER_KEY)))
+
+
+def login_cookie(interface):
+    """The cookie a just-logged-in user sends back."""
+
+    session = interface.open_session(app, SimpleNamespace(cookies={}))
+    session[CURR_USER_KEY] = 12345
+    session['csrf_token'] = 'b3b1f4d0c6c54f0b8b5b7e2c1a9d8e7f6a5b4c3d'
+
+    response = app.response_class()
+    interface.save_session(app, session, response)
+
+    cookie = response.headers['Set-Cookie'].split(';')[0]
+    return cookie.split('=', 1)[1]
+
+
+def per_request(interface, cookie, requests, write):
+    request = SimpleNamespace(cookies={app.session_cookie_name: cookie})
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        session = interface.open_session(app, request)
+        assert session[CURR_USER_KEY] == 12345
+
+        if write:
+            session['_flashes'] = [('success', 'Successfully Logged out!')]
+
+        interface.save_session(app, session, app.response_class())
+
+    return (time.perf_counter() - start) * 1e6 / requests
+
+
+def run(requests=REQUESTS):
+    print(f"{requests} requests, a logged-in session")
+    print(f"{'':>14} {'read':>9} {'write':>9} {'cookie':>8}")
+
+    for name, interface in interfaces():
+        cookie = login_cookie(interface)
+        read = per_request(interface, cookie, requests, write=False)
+        write = per_request(interface, cookie, requests, write=True)
+        print(f"{name:>14} {read:7.2f}us {write:7.2f}us {len(cookie):6d} B")
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:2]))
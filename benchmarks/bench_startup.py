@@ -0,0 +1,111 @@
+"""Worker startup time: import to first response.
+
+Times how long a new worker takes before it can answer its first request
+(the anonymous homepage), split into importing app.py, create_app() and
+the first response, for:
+
+- cold: a fresh interpreter per worker, as gunicorn starts workers without
+  --preload, once per environment (production, and development with the
+  debug toolbar);
+- preload: one process imports and creates the app, then forks workers,
+  as gunicorn --preload does; each worker only pays for its first response.
+
+Templates load from a bytecode cache filled beforehand, as after
+`python rendering.py` on deploy. Nothing here writes to the database.
+
+run like:
+
+   python -m benchmarks.bench_startup [workers]
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+WORKERS = 8
+
+
+def first_response(app):
+    start = time.perf_counter()
+    resp = app.test_client().get('/')
+    assert resp.status_code == 200, resp.status
+    return time.perf_counter() - start
+
+
+def child(env):
+    """Start up the way a worker does; print the timings as JSON."""
+
+    start = time.perf_counter()
+    import app as module
+    imported = time.perf_counter()
+    app = module.create_app(env)
+    created = time.perf_counter()
+
+    print(json.dumps({'import': imported - start,
+                      'create_app': created - imported,
+                      'first response': first_response(app)}))
+
+
+def cold(env, workers):
+    runs = []
+    for _ in range(workers):
+        out = subprocess.run([sys.executable, '-m', 'benchmarks.bench_startup', '--child', env],
+                             check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(out))
+
+    return {step: statistics.median(run[step] for run in runs) for step in runs[0]}
+
+
+def preload(workers):
+    """Create the app once, then time each forked worker's first response."""
+
+    start = time.perf_counter()
+    from app import create_app
+    app = create_app('production')
+    loaded = time.perf_counter() - start
+
+    times = []
+    for _ in range(workers):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            os.write(write, str(first_response(app)).encode())
+            os._exit(0)
+
+        os.close(write)
+        with os.fdopen(read) as result:
+            times.append(float(result.read()))
+        os.waitpid(pid, 0)
+
+    return loaded, statistics.median(times)
+
+
+def run(workers=WORKERS):
+    os.environ['TEMPLATE_CACHE_DIR'] = tempfile.mkdtemp()
+    subprocess.run([sys.executable, 'rendering.py'], check=True, capture_output=True)
+
+    print(f"{'ms, median of ' + str(workers):<24} {'import':>8} {'create_app':>11}"
+          f" {'first resp':>11} {'total':>8}")
+    for env in ('production', 'development'):
+        timings = cold(env, workers)
+        print(f"{'cold, ' + env:<24} {timings['import'] * 1000:>8.1f}"
+              f" {timings['create_app'] * 1000:>11.1f} {timings['first response'] * 1000:>11.1f}"
+              f" {sum(timings.values()) * 1000:>8.1f}")
+
+    loaded, first = preload(workers)
+    print(f"{'preload, production':<24} {'(once)':>8} {loaded * 1000:>11.1f}"
+          f" {first * 1000:>11.1f} {first * 1000:>8.1f}")
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2])
+    else:
+        run(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,71 @@
+"""Fan-out latency of the live timeline broker.
+
+Opens SUBSCRIBERS subscriptions to one author, each drained by its own
+thread (standing in for a parked stream), publishes EVENTS messages and
+reports how long publish() takes and how long events take to reach
+subscribers.
+
+run like:
+
+   python -m benchmarks.bench_stream_fanout [subscribers] [events]
+"""
+
+import statistics
+import sys
+import threading
+import time
+
+from stream import Broker
+
+SUBSCRIBERS = 1000
+EVENTS = 50
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(subscribers=SUBSCRIBERS, events=EVENTS):
+    broker = Broker()
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Barrier(subscribers + 1)
+
+    def consume(subscriber):
+        seen = 0
+        local = []
+        while seen < events:
+            for event_id, author_id, sent_at in subscriber.get(1):
+                local.append(time.perf_counter() - sent_at)
+                seen += 1
+        with lock:
+            latencies.extend(local)
+        done.wait()
+
+    threads = [threading.Thread(target=consume, args=(broker.subscribe({1}),),
+                                daemon=True)
+               for _ in range(subscribers)]
+    for thread in threads:
+        thread.start()
+
+    publish_times = []
+    for event_id in range(events):
+        start = time.perf_counter()
+        broker.publish(event_id, 1, start)
+        publish_times.append(time.perf_counter() - start)
+        time.sleep(0.005)
+
+    done.wait()
+
+    print(f"{subscribers} subscribers, {events} events, "
+          f"{broker.evictions} evictions")
+    print(f"publish():  median {statistics.median(publish_times) * 1e3:.2f} ms, "
+          f"max {max(publish_times) * 1e3:.2f} ms")
+    print(f"delivery:   p50 {percentile(latencies, 50) * 1e3:.2f} ms, "
+          f"p99 {percentile(latencies, 99) * 1e3:.2f} ms, "
+          f"max {max(latencies) * 1e3:.2f} ms")
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,224 @@
+"""Read-through cache of messages and their authors.
+
+Timelines, likes pages and single-message pages all show the same popular
+messages over and over. Rather than loading a Message (and lazily its User)
+per row, routes fetch just the ids they need and hydrate them with
+`cache.get_messages(ids)`, which serves what it can from memory and loads
+all the misses in one IN query.
+
+Entries are plain tuples, not ORM objects, so they're cheap to keep and
+safe to share between requests. Messages and users are cached separately,
+so a profile edit only invalidates one user entry. Each cache is an LRU
+bounded by an estimate of its size in bytes, and entries also expire after
+a TTL, which bounds how stale another process's cache can be after a
+write (invalidation is per process).
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from models import db, User, Message
+from partitions import archived_messages
+from replicas import reading_replica
+
+# Byte budgets for the two caches, and how long (in seconds) an entry lives.
+MESSAGE_CACHE_BYTES = 32 * 1024 * 1024
+USER_CACHE_BYTES = 8 * 1024 * 1024
+CACHE_TTL = 60
+
+MessageRow = namedtuple('MessageRow', 'id text timestamp user_id')
+UserRow = namedtuple('UserRow', 'id username image_url')
+
+# What routes get back: a message with its author attached, shaped like a
+# Message for the templates (msg.user.username and so on).
+CachedMessage = namedtuple('CachedMessage', 'id text timestamp user_id user')
+
+
+def entry_size(entry):
+    """Rough size of a cached tuple in bytes."""
+
+    return sys.getsizeof(entry) + sum(sys.getsizeof(field) for field in entry)
+
+
+class LRUCache:
+    """Thread-safe LRU with a byte budget and per-entry TTL."""
+
+    def __init__(self, max_bytes, ttl=CACHE_TTL, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_many(self, keys):
+        """Get {key: value} for the keys that are cached and fresh."""
+
+        now = self.clock()
+        found = {}
+
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+
+                if entry is None:
+                    continue
+
+                value, size, expires = entry
+
+                if expires <= now:
+                    self._delete(key)
+                    continue
+
+                self.entries.move_to_end(key)
+                found[key] = value
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    def set(self, key, value, size=None):
+        """Cache `value`; `size` in bytes defaults to entry_size(value)."""
+
+        if size is None:
+            size = entry_size(value)
+
+        with self.lock:
+            self._delete(key)
+
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size, self.clock() + self.ttl)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._delete(oldest)
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+class ObjectCache:
+    """Message and user caches with multi-get hydration."""
+
+    def __init__(self, message_bytes=MESSAGE_CACHE_BYTES,
+                 user_bytes=USER_CACHE_BYTES, ttl=CACHE_TTL):
+        self.messages = LRUCache(message_bytes, ttl)
+        self.users = LRUCache(user_bytes, ttl)
+
+    def get_users(self, ids):
+        """Get {id: UserRow} for the given user ids, loading misses at once."""
+
+        ids = list(dict.fromkeys(ids))
+        found = self.users.get_many(ids)
+        missing = [user_id for user_id in ids if user_id not in found]
+
+        if missing:
+            rows = (db.session
+                    .query(User.id, User.username, User.image_url)
+                    .filter(User.id.in_(missing), User.deleted_at.is_(None))
+                    .all())
+
+            cacheable = not reading_replica(db.session)
+            for row in rows:
+                user = UserRow(*row)
+                if cacheable:
+                    self.users.set(user.id, user)
+                found[user.id] = user
+
+        return found
+
+    def get_messages(self, ids, load=None):
+        """Get CachedMessages for `ids`, in the same order.
+
+        Ids that don't exist, or whose author doesn't (or was deleted), are
+        left out. Misses are loaded with `load(ids)` if it's given (as
+        (id, text, timestamp, user_id) rows), else through db.session, which
+        reads from a replica during GET requests (see replicas.py), then
+        from the other shards and the archives. What's read from a replica
+        isn't cached.
+        """
+
+        ids = list(ids)
+        found = self.messages.get_many(ids)
+        missing = [message_id for message_id in ids if message_id not in found]
+
+        if missing:
+            rows = (load or self._load_messages)(missing)
+
+            cacheable = not reading_replica(db.session)
+            for row in rows:
+                message = MessageRow(*row)
+                if cacheable:
+                    self.messages.set(message.id, message)
+                found[message.id] = message
+
+        users = self.get_users(found[message_id].user_id
+                               for message_id in ids if message_id in found)
+
+        return [CachedMessage(*found[message_id], user=users[found[message_id].user_id])
+                for message_id in ids
+                if message_id in found and found[message_id].user_id in users]
+
+    def _load_messages(self, ids):
+        from shards import shards
+
+        rows = (db.session
+                .query(Message.id, Message.text, Message.timestamp,
+                       Message.user_id)
+                .filter(Message.id.in_(ids))
+                .all())
+
+        # the rest may be on other shards, or archived
+        if len(rows) < len(ids):
+            rows += shards.find_messages(set(ids) - {row.id for row in rows})
+        if len(rows) < len(ids):
+            rows += archived_messages(set(ids) - {row.id for row in rows})
+
+        return rows
+
+    def get_message(self, message_id):
+        """Get one CachedMessage, or None."""
+
+        messages = self.get_messages([message_id])
+        return messages[0] if messages else None
+
+    def put_message(self, msg):
+        """Cache a just-written Message, replacing any stale entry."""
+
+        self.messages.set(msg.id, MessageRow(msg.id, msg.text, msg.timestamp,
+                                             msg.user_id))
+
+    def invalidate_message(self, message_id):
+        self.messages.delete(message_id)
+
+    def invalidate_user(self, user_id):
+        self.users.delete(user_id)
+
+    def clear(self):
+        self.messages.clear()
+        self.users.clear()
+
+
+cache = ObjectCache()
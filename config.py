@@ -0,0 +1,135 @@
+"""App configuration for each environment.
+
+`create_app()` picks one of CONFIGS by name (its argument, else FLASK_ENV,
+else production), then applies overrides from environment variables:
+DATABASE_URL, REPLICA_DATABASE_URLS, SHARD_DATABASE_URLS, and any of
+ENV_SETTINGS set under its own name.
+"""
+
+import os
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///warbler'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    # Read-only replicas for GET requests (see replicas.py), and how long
+    # a user reads from the primary after writing.
+    SQLALCHEMY_REPLICA_URIS = ()
+    REPLICA_PIN_SECONDS = 5
+
+    # Shard databases besides the primary, by name (see shards.py).
+    SHARDS = {}
+
+    SECRET_KEY = "it's a secret"
+
+    # Where sessions are kept (see sessions.py): None for signed cookies,
+    # or 'memory', 'sqlite' or 'redis'.
+    SESSION_STORE = None
+    SESSION_SQLITE_PATH = os.path.join(ROOT, 'sessions.sqlite3')
+    SESSION_REDIS_URL = 'redis://localhost:6379/0'
+
+    # The debug toolbar is only installed where this is on.
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    MESSAGE_ARCHIVE_DIR = os.path.join(ROOT, 'archive')
+    ASSETS_DIR = os.path.join(ROOT, 'assets')
+    IMAGE_CACHE_DIR = os.path.join(ROOT, 'image_cache')
+    TEMPLATE_CACHE_DIR = os.path.join(ROOT, 'template_cache')
+    TEMPLATE_PROFILE = False
+
+    # Each worker's /metrics numbers go in a file here; None keeps them in memory.
+    METRICS_DIR = os.path.join(ROOT, 'metrics')
+
+    # Ids of the users allowed into /admin pages (not usernames: those can
+    # be changed, and taken by someone else).
+    ADMIN_USER_IDS = ()
+
+    # Sampled request profiles (see profiler.py): where they're kept, and
+    # what fraction of requests to profile without being asked.
+    PROFILE_DIR = os.path.join(ROOT, 'profiles')
+    PROFILE_SAMPLE_RATE = 0.0
+    PROFILE_MODE = 'wall'
+
+    # Commit new messages in groups (see group_commit.py), waiting up to
+    # this many seconds to fill a group.
+    MESSAGE_GROUP_COMMIT = False
+    MESSAGE_GROUP_WAIT = 0.002
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    DEBUG_TB_ENABLED = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///warbler-test'
+    WTF_CSRF_ENABLED = False
+    NOTIFICATIONS_ASYNC = False
+
+    # The cheapest bcrypt allows; tests sign up and log in a lot of users.
+    BCRYPT_LOG_ROUNDS = 4
+
+    METRICS_DIR = None
+
+
+class ProductionConfig(Config):
+    pass
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+# Settings an environment variable of the same name overrides.
+ENV_SETTINGS = ('SECRET_KEY', 'MESSAGE_ARCHIVE_DIR', 'ASSETS_DIR',
+                'IMAGE_CACHE_DIR', 'TEMPLATE_CACHE_DIR', 'METRICS_DIR',
+                'PROFILE_DIR', 'PROFILE_MODE', 'SESSION_STORE',
+                'SESSION_SQLITE_PATH', 'SESSION_REDIS_URL')
+
+
+def load_config(config, name=None):
+    """Fill a Flask `config` for environment `name`; returns the name used."""
+
+    name = name or os.environ.get('FLASK_ENV') or 'production'
+    config.from_object(CONFIGS[name])
+
+    if 'DATABASE_URL' in os.environ:
+        config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
+
+    if 'REPLICA_DATABASE_URLS' in os.environ:
+        urls = os.environ['REPLICA_DATABASE_URLS'].split(',')
+        config['SQLALCHEMY_REPLICA_URIS'] = tuple(url.strip() for url in urls if url.strip())
+
+    if 'SHARD_DATABASE_URLS' in os.environ:
+        pairs = (pair.split('=', 1) for pair in os.environ['SHARD_DATABASE_URLS'].split(',') if pair.strip())
+        config['SHARDS'] = {name.strip(): url.strip() for name, url in pairs}
+
+    for setting in ENV_SETTINGS:
+        if setting in os.environ:
+            config[setting] = os.environ[setting]
+
+    if 'TEMPLATE_PROFILE' in os.environ:
+        config['TEMPLATE_PROFILE'] = os.environ['TEMPLATE_PROFILE'] == '1'
+
+    if 'MESSAGE_GROUP_COMMIT' in os.environ:
+        config['MESSAGE_GROUP_COMMIT'] = os.environ['MESSAGE_GROUP_COMMIT'] == '1'
+
+    if 'MESSAGE_GROUP_WAIT' in os.environ:
+        config['MESSAGE_GROUP_WAIT'] = float(os.environ['MESSAGE_GROUP_WAIT'])
+
+    if 'PROFILE_SAMPLE_RATE' in os.environ:
+        config['PROFILE_SAMPLE_RATE'] = float(os.environ['PROFILE_SAMPLE_RATE'])
+
+    if 'ADMIN_USER_IDS' in os.environ:
+        config['ADMIN_USER_IDS'] = tuple(int(user_id) for user_id in os.environ['ADMIN_USER_IDS'].split(',')
+                                         if user_id.strip())
+
+    return name
@@ -0,0 +1,210 @@
+"""Purging deleted accounts in the background.
+
+Deleting a user with years of messages in one request is slow: cascading
+the user's messages, likes and follows can touch hundreds of thousands of
+rows. So `delete_user()` only calls `mark_deleted()`, which sets
+`User.deleted_at` (every read path skips deleted users from then on) and
+queues a DeletionJob.
+
+A worker then deletes the user's rows a chunk at a time, one transaction
+per chunk: their likes, their follows (both ways), the likes and
+notifications of their messages (which don't cascade, see
+Message.delete_refs()), their messages (on main, on every other shard and
+in the archives, see partitions.py) and finally the user row.
+The job's stage and count are updated in the same transaction as each
+chunk, so a worker that dies resumes where it stopped.
+
+Run the worker next to the app:
+
+    python deletions.py
+
+Run a single worker: jobs aren't locked against each other.
+"""
+
+import time
+from datetime import datetime
+
+from models import db, User, Message, MessageArchive, Likes, Follows, Notification, DeletionJob
+from partitions import archived_user_ids, remove_archived
+from shards import shards
+
+# Rows deleted per transaction.
+CHUNK_SIZE = 1000
+
+# Seconds the worker sleeps when there's nothing to do.
+POLL_INTERVAL = 5
+
+# The order rows are deleted in; each stage runs until it finds no rows.
+STAGES = ('likes', 'follows', 'message_likes', 'message_notifications', 'messages',
+          'shard_messages', 'archived_messages', 'user')
+
+
+def mark_deleted(user):
+    """Hide `user` and queue their rows for deletion (caller commits)."""
+
+    user.deleted_at = datetime.utcnow()
+    db.session.add(DeletionJob(user_id=user.id))
+
+
+def stage_rows(stage, user_id):
+    """The table and condition for the rows a stage deletes."""
+
+    if stage == 'likes':
+        return Likes.__table__, Likes.user_id == user_id
+
+    if stage == 'follows':
+        return Follows.__table__, db.or_(
+            Follows.user_following_id == user_id,
+            Follows.user_being_followed_id == user_id)
+
+    if stage in ('message_likes', 'message_notifications'):
+        model = Likes if stage == 'message_likes' else Notification
+        messages = db.select([Message.id]).where(Message.user_id == user_id)
+        return model.__table__, model.message_id.in_(messages)
+
+    if stage == 'messages':
+        return Message.__table__, Message.user_id == user_id
+
+    return User.__table__, User.id == user_id
+
+
+def delete_chunk(table, condition, size=CHUNK_SIZE, session=None):
+    """Delete up to `size` rows of `table` matching `condition`.
+
+    Deletes through `session` (db.session by default); returns how many
+    rows were deleted.
+    """
+
+    key = list(table.primary_key.columns)
+    chunk = db.select(key).where(condition).limit(size)
+
+    if len(key) == 1:
+        in_chunk = key[0].in_(chunk)
+    else:
+        in_chunk = db.tuple_(*key).in_(chunk)
+
+    return (session or db.session).execute(table.delete().where(in_chunk)).rowcount
+
+
+def delete_shard_messages(user_id, size=CHUNK_SIZE):
+    """Delete up to `size` of `user_id`'s messages on each shard but main.
+
+    Their likes and notifications (on main) are deleted and committed
+    first, so a retry still finds the messages. Returns how many messages
+    were deleted.
+    """
+
+    deleted = 0
+
+    for name in shards.names()[1:]:
+        session = shards.session(name)
+        message_ids = [message_id for (message_id,) in
+                       session.query(Message.id).filter_by(user_id=user_id).limit(size)]
+
+        if message_ids:
+            Message.delete_refs(message_ids)
+            db.session.commit()
+
+            deleted += delete_chunk(Message.__table__, Message.id.in_(message_ids), size, session)
+            session.commit()
+
+    return deleted
+
+
+def delete_archived_messages(user_id, size=CHUNK_SIZE):
+    """Delete `user_id`'s archived messages, an archive at a time, until `size` are gone.
+
+    Each archive is rewritten without them once their likes and
+    notifications are deleted and committed. Returns how many messages
+    were deleted.
+    """
+
+    deleted = 0
+
+    for archive in MessageArchive.query.order_by(MessageArchive.month).all():
+        message_ids = archived_user_ids(archive, user_id)
+
+        if message_ids:
+            Message.delete_refs(message_ids)
+            db.session.commit()
+
+            remove_archived(archive, message_ids)
+            deleted += len(message_ids)
+
+            if deleted >= size:
+                break
+
+    return deleted
+
+
+def delete_stage_chunk(stage, user_id, size=CHUNK_SIZE):
+    """Delete the next chunk of a stage's rows; returns how many."""
+
+    if stage == 'shard_messages':
+        return delete_shard_messages(user_id, size)
+
+    if stage == 'archived_messages':
+        return delete_archived_messages(user_id, size)
+
+    return delete_chunk(*stage_rows(stage, user_id), size=size)
+
+
+def run_job(job, chunk_size=CHUNK_SIZE, max_chunks=None):
+    """Work on `job` until it's done (or for `max_chunks` chunks).
+
+    Returns True once the job is done.
+    """
+
+    chunks = 0
+
+    while job.stage != 'done':
+        if max_chunks is not None and chunks >= max_chunks:
+            return False
+
+        deleted = delete_stage_chunk(job.stage, job.user_id, chunk_size)
+        chunks += 1
+
+        job.deleted_rows += deleted
+        job.updated_at = datetime.utcnow()
+
+        if deleted < chunk_size:
+            following = STAGES.index(job.stage) + 1
+            if following < len(STAGES):
+                job.stage = STAGES[following]
+            else:
+                job.stage = 'done'
+                job.finished_at = job.updated_at
+
+        db.session.commit()
+
+    return True
+
+
+def run_pending(chunk_size=CHUNK_SIZE):
+    """Finish every unfinished job, oldest first; returns how many ran."""
+
+    jobs = (DeletionJob.query
+            .filter(DeletionJob.stage != 'done')
+            .order_by(DeletionJob.id)
+            .all())
+
+    for job in jobs:
+        run_job(job, chunk_size)
+
+    return len(jobs)
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        while True:
+            try:
+                if not run_pending():
+                    time.sleep(POLL_INTERVAL)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Deleting accounts failed")
+                time.sleep(POLL_INTERVAL)
+            finally:
+                db.session.remove()
@@ -0,0 +1,172 @@
+"""Shared test setup: a database per test process, rollback per test, factories.
+
+Import this before app in a test module:
+
+    from fixtures import DatabaseTestCase, make_user, make_message
+    from app import app
+
+It picks the testing config (cheap bcrypt, no CSRF, notifications
+delivered inline) and a test database: TEST_DATABASE_URL, by default
+postgresql:///warbler-test. Under pytest-xdist (python -m pytest -n auto)
+each worker gets its own copy, warbler-test-gw0 and so on, created on first
+use. Its tables are dropped and created again when the first test module
+loads, so they always match the models.
+
+DatabaseTestCase runs each test inside a transaction that's rolled back
+afterwards. The app's commits and rollbacks only release and roll back
+SAVEPOINTs within it, so every test starts from an empty database without
+deleting anything. Code that talks to the database on its own connections
+(the asyncpg pool in asgi.py) can't see that transaction; its tests use
+CommittedTestCase, which truncates the tables instead.
+"""
+
+import itertools
+import os
+from copy import copy
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session
+
+DATABASE_URL = os.environ.get('TEST_DATABASE_URL', 'postgresql:///warbler-test')
+
+# pytest-xdist numbers its workers gw0, gw1, ...
+WORKER = os.environ.get('PYTEST_XDIST_WORKER')
+if WORKER:
+    DATABASE_URL = f'{DATABASE_URL}-{WORKER}'
+
+os.environ['DATABASE_URL'] = DATABASE_URL
+os.environ['FLASK_ENV'] = 'testing'
+
+from app import app
+from models import db, User, Message, Follows, Likes
+
+
+def create_database(url):
+    """Create the Postgres database `url` names, if it doesn't exist yet."""
+
+    url = make_url(url)
+    admin = copy(url)
+    admin.database = 'postgres'
+    engine = create_engine(admin, isolation_level='AUTOCOMMIT')
+
+    with engine.connect() as connection:
+        exists = connection.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                                    name=url.database).scalar()
+        if not exists:
+            connection.execute(f'CREATE DATABASE "{url.database}"')
+
+    engine.dispose()
+
+
+def truncate_all():
+    """Delete every row from every table, and commit.
+
+    Ids aren't restarted: the process caches (cache.py, profiles.py, ...)
+    outlive a test, and must not find a later test's rows under old ids.
+    """
+
+    names = ', '.join(f'"{table.name}"' for table in db.metadata.sorted_tables)
+    db.session.execute(f'TRUNCATE {names} CASCADE')
+    db.session.commit()
+
+
+def _restart_savepoint(session, transaction):
+    # the app committed or rolled back: start a new SAVEPOINT for what comes next
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+def _nested(session):
+    session.begin_nested()
+    return session
+
+
+class DatabaseTestCase(TestCase):
+    """A test case whose database changes are all rolled back afterwards."""
+
+    def setUp(self):
+        self.connection = db.engine.connect()
+        self.connection.begin()
+
+        factory = db.create_session({'bind': self.connection, 'binds': {}, 'query_cls': db.Query})
+        event.listen(factory, 'after_transaction_end', _restart_savepoint)
+
+        self._session = db.session
+        db.session = scoped_session(lambda: _nested(factory()))
+
+    def tearDown(self):
+        db.session.remove()
+        db.session = self._session
+
+        # closing the connection rolls back everything the test did
+        self.connection.close()
+
+
+class CommittedTestCase(TestCase):
+    """A test case whose data is really committed, and truncated afterwards."""
+
+    def tearDown(self):
+        db.session.rollback()
+        truncate_all()
+
+
+##############################################################################
+# Factories: each adds a row with made-up defaults, flushes it (so it has
+# an id) and returns it; commit as the test needs.
+
+_sequence = itertools.count(1)
+
+
+def make_user(username=None, password=None, **fields):
+    """Add a user; with `password`, signed up with that (hashed) password."""
+
+    n = next(_sequence)
+    username = username or f'user{n}'
+    fields.setdefault('email', f'{username}@test.com')
+
+    if password:
+        user = User.signup(username, fields.pop('email'), password, fields.pop('image_url', None))
+        for name, value in fields.items():
+            setattr(user, name, value)
+    else:
+        user = User(username=username, password='HASHED_PASSWORD', **fields)
+        db.session.add(user)
+
+    db.session.flush()
+    return user
+
+
+def make_message(user, text=None, **fields):
+    """Add a message by `user`."""
+
+    message = Message(text=text or f'warble {next(_sequence)}', user_id=user.id, **fields)
+    db.session.add(message)
+    db.session.flush()
+    return message
+
+
+def make_follow(follower, followed):
+    """Make `follower` follow `followed`."""
+
+    follow = Follows(user_following_id=follower.id, user_being_followed_id=followed.id)
+    db.session.add(follow)
+    db.session.flush()
+    return follow
+
+
+def make_like(user, message):
+    """Make `user` like `message`."""
+
+    like = Likes(user_id=user.id, message_id=message.id)
+    db.session.add(like)
+    db.session.flush()
+    return like
+
+
+create_database(DATABASE_URL)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
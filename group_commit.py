@@ -0,0 +1,177 @@
+"""Group commit for new messages.
+
+With MESSAGE_GROUP_COMMIT on, `message_writer.post()` doesn't insert and
+commit on the request's thread. It queues the message for a writer thread,
+which collects the messages of concurrent requests for up to
+MESSAGE_GROUP_WAIT seconds (or GROUP_SIZE of them), inserts them
+with one multi-row INSERT ... RETURNING, bumps their authors' profile
+versions (see profiles.py) with one UPDATE and commits once. Under a burst of
+posts that's one commit, and one wait for the disk, per group instead of
+per message.
+
+Each caller still blocks until its own message is committed, and gets
+either the message (with its id) or the error its row caused: if the
+group's insert fails, its rows are inserted again one at a time, each in a
+SAVEPOINT, so a bad row only fails its own request. An error in the commit
+itself fails the whole group.
+
+With it off (the default, and in the tests) each message is inserted and
+committed on the calling thread.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, Message
+from profiles import profiles
+from sequencer import sequencer
+
+# Most messages inserted in one transaction.
+GROUP_SIZE = 200
+
+# How long (in seconds) the writer waits to fill a group once it has one message.
+GROUP_WAIT = 0.002
+
+# Most messages waiting before post() blocks on the writer.
+QUEUE_SIZE = 10000
+
+# How long (in seconds) post() waits for its group to be committed.
+POST_TIMEOUT = 10
+
+
+def insert_group(rows):
+    """Insert message `rows` (dicts of Message columns), bump their authors' profiles and commit.
+
+    Returns a result for each row, in order: its id, or the exception
+    inserting it raised. Errors from the commit itself are raised.
+    """
+
+    table = Message.__table__
+    returning = (table.c.sort_key, table.c.id)
+
+    try:
+        inserted = db.session.execute(table.insert().values(rows).returning(*returning))
+        ids = dict(inserted.fetchall())
+        results = [ids[row['sort_key']] for row in rows]
+
+    except DBAPIError:
+        # find out which rows are at fault, and keep the others
+        db.session.rollback()
+        results = []
+
+        for row in rows:
+            try:
+                with db.session.begin_nested():
+                    inserted = db.session.execute(table.insert().values(row).returning(table.c.id))
+                    results.append(inserted.scalar())
+            except DBAPIError as exc:
+                results.append(exc)
+
+    profiles.bump(*{row['user_id'] for row in rows})
+    db.session.commit()
+    return results
+
+
+class MessageWriter:
+    """Posts messages, committing those of concurrent requests together."""
+
+    def __init__(self, group_size=GROUP_SIZE, maxsize=QUEUE_SIZE):
+        self.group_size = group_size
+        self.pending = queue.Queue(maxsize)
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """Set the MESSAGE_GROUP_COMMIT and MESSAGE_GROUP_WAIT defaults for `app`."""
+
+        app.config.setdefault('MESSAGE_GROUP_COMMIT', False)
+        app.config.setdefault('MESSAGE_GROUP_WAIT', GROUP_WAIT)
+
+    def post(self, user, text):
+        """Add and commit a message by `user`; returns the Message.
+
+        Raises whatever inserting the message raised.
+        """
+
+        if not current_app.config['MESSAGE_GROUP_COMMIT']:
+            msg = Message(text=text)
+            user.messages.append(msg)
+            profiles.bump(user.id)
+            db.session.commit()
+            return msg
+
+        row = {'text': text, 'user_id': user.id, 'timestamp': datetime.utcnow()}
+        row['sort_key'] = sequencer.key_for(row['timestamp'], db.engine)
+
+        future = Future()
+        self._ensure_worker()
+        self.pending.put((row, future))
+        message_id = future.result(timeout=POST_TIMEOUT)
+
+        # the row is committed: add it to this session as it is, without loading it
+        msg = Message(id=message_id, **row)
+        make_transient_to_detached(msg)
+        db.session.add(msg)
+        set_committed_value(msg, 'user', user)
+        return msg
+
+    def _ensure_worker(self):
+        # Started lazily, so each forked worker process gets its own thread.
+        if self.worker and self.worker.is_alive():
+            return
+
+        with self.lock:
+            if self.worker and self.worker.is_alive():
+                return
+
+            self.worker = threading.Thread(target=self._run,
+                                           args=(current_app._get_current_object(),),
+                                           name='group-commit', daemon=True)
+            self.worker.start()
+
+    def _next_group(self, wait):
+        group = [self.pending.get()]
+        deadline = time.monotonic() + wait
+
+        while len(group) < self.group_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                group.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return group
+
+    def _run(self, app):
+        while True:
+            group = self._next_group(app.config['MESSAGE_GROUP_WAIT'])
+
+            with app.app_context():
+                try:
+                    results = insert_group([row for row, _ in group])
+                except Exception as exc:
+                    db.session.rollback()
+                    for _, future in group:
+                        future.set_exception(exc)
+                    continue
+                finally:
+                    db.session.remove()
+
+            for (_, future), result in zip(group, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+message_writer = MessageWriter()
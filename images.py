@@ -0,0 +1,420 @@
+"""Resizing proxy for user avatars and header images.
+
+`image_url` and `header_image_url` are whatever URLs users typed in, often
+full-size photos on other sites. Templates link them through
+`image_url(url, size)` instead, which points at /images/<size>/<token>;
+the token is the source URL signed with the app's secret key, so the proxy
+only ever fetches URLs the app itself rendered.
+
+The first request for a URL fetches it once and stores the original under
+its content hash; each size is rendered from that (WebP for browsers that
+say they accept it, JPEG otherwise) and stored next to it. So two users
+with the same picture share one original and one set of variants. The
+cache directory is capped at IMAGE_CACHE_BYTES: hits touch their file, and
+when the cap is passed the least recently used files are deleted.
+
+Responses are cached by browsers for IMAGE_MAX_AGE. If a source can't be
+fetched or isn't an image, the browser is redirected to it instead.
+
+`HTTPFetcher` only fetches from public addresses. Each request, redirects
+included, resolves its host once, checks every address and connects to
+the checked one (with the URL's Host header and TLS server name), so a
+second lookup can't be answered with a private address instead.
+
+`LocalFetcher` reads "remote" images from a directory, for running offline
+(the tests use it).
+"""
+
+import functools
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import threading
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+from functools import lru_cache
+
+from flask import abort, current_app, redirect, request, send_file, url_for
+from itsdangerous import URLSafeSerializer, BadSignature
+
+
+Size = namedtuple('Size', 'width height crop')
+
+# What the templates show, at twice their CSS size for high-DPI screens.
+SIZES = {
+    'thumb': Size(96, 96, True),        # timeline and navbar avatars
+    'avatar': Size(400, 400, True),     # user card and profile avatars
+    'card': Size(600, 300, False),      # user card header images
+    'hero': Size(1600, 900, False),     # profile header image
+}
+
+FORMATS = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+QUALITY = 80
+
+# Byte budget of the on-disk cache; eviction goes down to LOW_WATER of it.
+IMAGE_CACHE_BYTES = 512 * 1024 * 1024
+LOW_WATER = 0.9
+
+# Browser cache lifetime (seconds). A user changing their picture changes
+# its URL, so this can be long.
+IMAGE_MAX_AGE = 30 * 24 * 60 * 60
+
+# Largest source image fetched, and how long to wait for it.
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+FETCH_TIMEOUT = 5
+
+# Proxied URLs remembered by image_url().
+URL_CACHE_SIZE = 4096
+
+
+class FetchError(Exception):
+    """A source image couldn't be fetched."""
+
+
+class HTTPFetcher:
+    """Fetch images from http(s) URLs on public hosts."""
+
+    def __init__(self, timeout=FETCH_TIMEOUT, max_bytes=MAX_SOURCE_BYTES):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        # no proxies: connections go straight to the address resolve() checked
+        self.opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({}), _PinnedHTTPHandler(self),
+            _PinnedHTTPSHandler(self), _CheckedRedirects(self))
+
+    def resolve(self, host):
+        """Get an address of `host` to connect to.
+
+        Refuses hosts with any loopback, private or link-local address.
+        """
+
+        try:
+            addresses = [info[4][0] for info in socket.getaddrinfo(host, None)]
+        except (socket.gaierror, UnicodeError) as exc:
+            raise FetchError(f"can't resolve {host}") from exc
+
+        for address in addresses:
+            if not ipaddress.ip_address(address.split('%')[0]).is_global:
+                raise FetchError(f"{host} isn't a public host")
+
+        return addresses[0]
+
+    def check_url(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise FetchError(f"can't fetch {url}")
+
+    def fetch(self, url):
+        self.check_url(url)
+
+        try:
+            with self.opener.open(url, timeout=self.timeout) as response:
+                data = response.read(self.max_bytes + 1)
+        except (OSError, ValueError) as exc:
+            raise FetchError(f"can't fetch {url}") from exc
+
+        if len(data) > self.max_bytes:
+            raise FetchError(f"{url} is too large")
+
+        return data
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """An HTTPConnection to `address` rather than to whatever `host` resolves to next."""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """An HTTPSConnection to `address`, verifying the certificate for `host`."""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+class _PinnedHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, fetcher):
+        super().__init__()
+        self.fetcher = fetcher
+
+    def http_open(self, req):
+        address = self.fetcher.resolve(urllib.parse.urlsplit(req.full_url).hostname)
+        return self.do_open(functools.partial(_PinnedHTTPConnection, address=address), req)
+
+
+class _PinnedHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, fetcher):
+        super().__init__()
+        self.fetcher = fetcher
+
+    def https_open(self, req):
+        address = self.fetcher.resolve(urllib.parse.urlsplit(req.full_url).hostname)
+        return self.do_open(functools.partial(_PinnedHTTPSConnection, address=address), req,
+                            context=self._context)
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    """Only follow redirects to URLs the fetcher would fetch itself."""
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        self.fetcher.check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class LocalFetcher:
+    """Fetch "remote" images from files under `root`.
+
+    http://example.com/a/b.jpg is read from <root>/example.com/a/b.jpg.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.fetches = 0
+
+    def fetch(self, url):
+        parts = urllib.parse.urlsplit(url)
+        path = os.path.abspath(os.path.join(self.root, parts.netloc, parts.path.lstrip('/')))
+
+        if not path.startswith(self.root + os.sep):
+            raise FetchError(f"can't fetch {url}")
+
+        self.fetches += 1
+        try:
+            with open(path, 'rb') as source:
+                return source.read()
+        except OSError as exc:
+            raise FetchError(f"can't fetch {url}") from exc
+
+
+class DiskCache:
+    """Files under `root`, deleted least recently used first past `max_bytes`."""
+
+    def __init__(self, root, max_bytes=IMAGE_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = None
+        self.lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def get(self, name):
+        """Get the path of `name`, or None if it isn't cached."""
+
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def read(self, name):
+        path = self.get(name)
+        if path is None:
+            return None
+        with open(path, 'rb') as cached:
+            return cached.read()
+
+    def put(self, name, data):
+        """Store `data` as `name`; returns its path."""
+
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{threading.get_ident()}.partial"
+        with open(partial, 'wb') as out:
+            out.write(data)
+        os.replace(partial, path)
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.files())
+            else:
+                self.size += len(data)
+
+            if self.size > self.max_bytes:
+                self.evict()
+
+        return path
+
+    def files(self):
+        """(path, size, last used) for every cached file."""
+
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        """Delete the least recently used files, down to LOW_WATER of the budget."""
+
+        files = sorted(self.files(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in files)
+
+        for path, size, _ in files:
+            if self.size <= self.max_bytes * LOW_WATER:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+def render(data, size, fmt):
+    """Resize image bytes to `size` and encode them as `fmt`."""
+
+    # imported here so that workers which never resize don't load Pillow
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+
+        if size.crop:
+            image = ImageOps.fit(image, (size.width, size.height), Image.LANCZOS)
+        else:
+            image.thumbnail((size.width, size.height), Image.LANCZOS)
+
+        if fmt == 'jpeg' or image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB' if fmt == 'jpeg' else 'RGBA')
+
+        out = io.BytesIO()
+        if fmt == 'jpeg':
+            image.save(out, 'JPEG', quality=QUALITY, optimize=True, progressive=True)
+        else:
+            image.save(out, 'WEBP', quality=QUALITY, method=4)
+
+    return out.getvalue()
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _sharded(kind, digest):
+    return f"{kind}/{digest[:2]}/{digest}"
+
+
+# Signing is most of the cost of a page's avatars, and the same few
+# hundred URLs are linked over and over, so recent ones are kept.
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def _proxied_url(script_root, secret_key, size, source):
+    token = URLSafeSerializer(secret_key, salt='images').dumps(source)
+    return url_for('image', size=size, token=token)
+
+
+class ImageProxy:
+    """Serves resized, cached copies of user images."""
+
+    def __init__(self, fetcher=None):
+        self.fetcher = fetcher or HTTPFetcher()
+        self.cache = None
+
+    def init_app(self, app):
+        """Add the /images/ route and the image_url() template global."""
+
+        app.config.setdefault('IMAGE_CACHE_DIR', os.path.join(app.root_path, 'image_cache'))
+        app.config.setdefault('IMAGE_CACHE_BYTES', IMAGE_CACHE_BYTES)
+        app.add_url_rule('/images/<size>/<token>', 'image', self.send)
+        app.add_template_global(self.url, 'image_url')
+
+    def disk(self):
+        root = current_app.config['IMAGE_CACHE_DIR']
+        if self.cache is None or self.cache.root != root:
+            self.cache = DiskCache(root, current_app.config['IMAGE_CACHE_BYTES'])
+        return self.cache
+
+    def serializer(self):
+        return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='images')
+
+    def url(self, source, size):
+        """URL of `source` resized to `size`.
+
+        Paths on this site (like the default avatar) are returned as is.
+        """
+
+        if not source or source.startswith('/'):
+            return source
+
+        return _proxied_url(request.script_root, current_app.config['SECRET_KEY'], size, source)
+
+    def original(self, source):
+        """Get the bytes of `source`, fetching it only if it isn't cached."""
+
+        disk = self.disk()
+        pointer = _sharded('urls', _digest(source.encode('UTF-8')))
+        digest = disk.read(pointer)
+
+        if digest is not None:
+            data = disk.read(_sharded('originals', digest.decode('ascii')))
+            if data is not None:
+                return digest.decode('ascii'), data
+
+        data = self.fetcher.fetch(source)
+        digest = _digest(data)
+        disk.put(_sharded('originals', digest), data)
+        disk.put(pointer, digest.encode('ascii'))
+
+        return digest, data
+
+    def variant(self, source, size, fmt):
+        """Get the path of `source` resized to SIZES[size] as `fmt`."""
+
+        disk = self.disk()
+        digest, data = self.original(source)
+        name = f"{_sharded('variants', digest)}-{size}.{fmt}"
+
+        path = disk.get(name)
+        if path is None:
+            path = disk.put(name, render(data, SIZES[size], fmt))
+
+        return path
+
+    def send(self, size, token):
+        if size not in SIZES:
+            abort(404)
+
+        try:
+            source = self.serializer().loads(token)
+        except BadSignature:
+            abort(404)
+
+        accepts_webp = any(value == 'image/webp' and quality
+                           for value, quality in request.accept_mimetypes)
+        fmt = 'webp' if accepts_webp else 'jpeg'
+
+        from PIL import Image
+
+        try:
+            path = self.variant(source, size, fmt)
+        except (FetchError, OSError, Image.DecompressionBombError):
+            return redirect(source)
+
+        response = send_file(path, mimetype=FORMATS[fmt], conditional=True,
+                             cache_timeout=IMAGE_MAX_AGE)
+        response.vary.add('Accept')
+        response.headers['Cache-Control'] = f"public, max-age={IMAGE_MAX_AGE}"
+        return response
+
+
+images = ImageProxy()
@@ -0,0 +1,436 @@
+"""Request, database and cache metrics, served at /metrics for Prometheus.
+
+Every worker process keeps its numbers in its own memory-mapped file,
+METRICS_DIR/<pid>.db, so recording a request never waits on another
+process: it's a handful of in-place float updates under a lock that only
+this process's threads share. /metrics reads every file in the directory
+and adds them up, so whichever gunicorn worker answers the scrape reports
+totals for all of them. Gauges (pool and cache sizes) only count processes
+that are still running; counters keep what exited workers recorded.
+
+Without a METRICS_DIR (as in tests) the numbers live in anonymous memory
+and /metrics only reports the current process.
+
+Counters carry on across restarts unless the directory is emptied first:
+
+    python metrics.py && gunicorn ...
+
+Recorded per request, by endpoint: a count by method and status, a latency
+histogram and the number of SQL statements run. Cache hit/miss counts,
+connection pool gauges and, with TEMPLATE_PROFILE on, the render time
+histograms of rendering.py are copied in at most once per GAUGE_INTERVAL.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import Response, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import cache
+from models import db
+from profiles import profiles
+from rendering import render_profiler, RENDER_BUCKETS
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKET_LABELS = tuple(format(bound, 'g') for bound in BUCKETS) + ('+Inf',)
+RENDER_BUCKET_LABELS = tuple(format(bound, 'g') for bound in RENDER_BUCKETS) + ('+Inf',)
+
+# How often, in seconds, a worker copies its cache and pool numbers in.
+GAUGE_INTERVAL = 1.0
+
+# (name, type, help) for every metric family, in the order they're served.
+FAMILIES = (
+    ('warbler_requests_total', 'counter', 'Requests handled, by endpoint, method and status.'),
+    ('warbler_request_duration_seconds', 'histogram', 'Time spent handling requests, by endpoint.'),
+    ('warbler_db_statements_total', 'counter', 'SQL statements run while handling requests, by endpoint.'),
+    ('warbler_template_render_seconds', 'histogram', 'Time spent rendering templates, by template and block.'),
+    ('warbler_cache_hits_total', 'counter', 'Cache lookups that found a fresh entry.'),
+    ('warbler_cache_misses_total', 'counter', 'Cache lookups that had to load from the database.'),
+    ('warbler_cache_hit_ratio', 'gauge', 'Hits over lookups, across all workers since they started.'),
+    ('warbler_cache_bytes', 'gauge', 'Estimated size of the cache entries held.'),
+    ('warbler_db_pool_size', 'gauge', 'Connections the pools keep open.'),
+    ('warbler_db_pool_checked_out', 'gauge', 'Pooled connections in use.'),
+    ('warbler_db_pool_idle', 'gauge', 'Pooled connections waiting to be used.'),
+    ('warbler_db_pool_overflow', 'gauge', 'Connections open beyond the pool size.'),
+)
+
+GAUGES = {name for name, kind, _ in FAMILIES if kind == 'gauge'}
+
+# The bucket labels of each histogram.
+HISTOGRAM_BUCKETS = {
+    'warbler_request_duration_seconds': BUCKET_LABELS,
+    'warbler_template_render_seconds': RENDER_BUCKET_LABELS,
+}
+
+# The caches whose hit rates are reported, by label.
+CACHES = {
+    'messages': cache.messages,
+    'users': cache.users,
+    'profiles': profiles.bundles,
+}
+
+HEADER = struct.Struct('<Q')        # bytes of the file in use
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+INITIAL_SIZE = 64 * 1024
+
+
+def read_values(data):
+    """Yield (key, value, offset of the value) for each entry in a values file."""
+
+    used = HEADER.unpack_from(data, 0)[0]
+    position = HEADER.size
+
+    while position < used:
+        length = KEY_LENGTH.unpack_from(data, position)[0]
+        start = position + KEY_LENGTH.size
+        name, labels = json.loads(bytes(data[start:start + length]))
+        offset = position + _padded(KEY_LENGTH.size + length)
+
+        yield (name, tuple(map(tuple, labels))), VALUE.unpack_from(data, offset)[0], offset
+        position = offset + VALUE.size
+
+
+def _padded(size):
+    # values stay 8-byte aligned, so they're written in one go
+    return (size + 7) // 8 * 8
+
+
+class ValueFile:
+    """Float values by key, in a memory-mapped file that only one process writes.
+
+    Keys are (name, labels) with labels a tuple of (label, value) pairs.
+    New entries are written in full before the used-bytes header is moved
+    past them, so other processes reading the file never see half of one.
+    Not thread-safe: callers hold their own lock.
+    """
+
+    def __init__(self, path=None, size=INITIAL_SIZE):
+        self.path = path
+        self.offsets = {}
+
+        if path is None:
+            self.file = None
+            self.map = mmap.mmap(-1, size)
+        else:
+            self.file = open(path, 'a+b')
+            if os.fstat(self.file.fileno()).st_size < size:
+                self.file.truncate(size)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+
+        self.used = HEADER.unpack_from(self.map, 0)[0]
+        if self.used:
+            # a reused pid's file: carry on from its values
+            for key, value, offset in read_values(self.map):
+                self.offsets[key] = offset
+        else:
+            self.used = HEADER.size
+            HEADER.pack_into(self.map, 0, self.used)
+
+    def inc(self, key, amount=1.0):
+        offset = self._offset(key)
+        VALUE.pack_into(self.map, offset, VALUE.unpack_from(self.map, offset)[0] + amount)
+
+    def set(self, key, value):
+        VALUE.pack_into(self.map, self._offset(key), value)
+
+    def items(self):
+        return [(key, value) for key, value, _ in read_values(self.map)]
+
+    def close(self):
+        self.map.close()
+        if self.file:
+            self.file.close()
+
+    def _offset(self, key):
+        offset = self.offsets.get(key)
+        if offset is None:
+            offset = self._append(key)
+        return offset
+
+    def _append(self, key):
+        name, labels = key
+        encoded = json.dumps([name, labels]).encode('UTF-8')
+        offset = self.used + _padded(KEY_LENGTH.size + len(encoded))
+        end = offset + VALUE.size
+
+        if end > len(self.map):
+            self._grow(max(end, 2 * len(self.map)))
+
+        KEY_LENGTH.pack_into(self.map, self.used, len(encoded))
+        start = self.used + KEY_LENGTH.size
+        self.map[start:start + len(encoded)] = encoded
+        VALUE.pack_into(self.map, offset, 0.0)
+
+        self.used = end
+        HEADER.pack_into(self.map, 0, self.used)
+        self.offsets[key] = offset
+        return offset
+
+    def _grow(self, size):
+        if self.file is None:
+            bigger = mmap.mmap(-1, size)
+            bigger[:len(self.map)] = self.map[:]
+            self.map.close()
+        else:
+            self.map.close()
+            self.file.truncate(size)
+            bigger = mmap.mmap(self.file.fileno(), 0)
+
+        self.map = bigger
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect(directory, values=None):
+    """Add up the values from every process's file in `directory`.
+
+    With no directory, just `values` (this process's) are used. Gauges
+    from processes that have exited are left out.
+    """
+
+    totals = defaultdict(float)
+
+    if directory is None:
+        sources = [(values.items() if values else [], True)]
+    else:
+        sources = []
+        for filename in os.listdir(directory):
+            pid, ext = os.path.splitext(filename)
+            if ext != '.db' or not pid.isdigit():
+                continue
+            with open(os.path.join(directory, filename), 'rb') as f:
+                data = f.read()
+            if len(data) >= HEADER.size:
+                sources.append(([(key, value) for key, value, _ in read_values(data)],
+                                _alive(int(pid))))
+
+    for items, alive in sources:
+        for (name, labels), value in items:
+            if alive or name not in GAUGES:
+                totals[name, labels] += value
+
+    return totals
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    return '{' + ','.join(f'{label}="{escape(value)}"' for label, value in labels) + '}'
+
+
+def render(totals):
+    """Format collected totals in the Prometheus text format."""
+
+    by_name = defaultdict(list)
+    for (name, labels), value in totals.items():
+        by_name[name].append((labels, value))
+
+    # hit ratios come from the summed counts, not from each process
+    for hits_labels, hits in by_name['warbler_cache_hits_total']:
+        misses = totals.get(('warbler_cache_misses_total', hits_labels), 0.0)
+        if hits + misses:
+            by_name['warbler_cache_hit_ratio'].append((hits_labels, hits / (hits + misses)))
+
+    lines = []
+    for name, kind, help in FAMILIES:
+        if kind == 'histogram':
+            samples = _histogram(name, by_name)
+        else:
+            samples = [(name, labels, value) for labels, value in sorted(by_name[name])]
+
+        if samples:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{sample}{_labels(labels)} {value!r}' for sample, labels, value in samples)
+
+    return '\n'.join(lines) + '\n'
+
+
+def _histogram(name, by_name):
+    """Cumulative bucket, sum and count samples; buckets are stored per bucket."""
+
+    buckets = defaultdict(dict)
+    for labels, value in by_name[name + '_bucket']:
+        buckets[labels[:-1]][labels[-1][1]] = value
+
+    sums = dict(by_name[name + '_sum'])
+    samples = []
+
+    for labels in sorted(buckets):
+        running = 0.0
+        for le in HISTOGRAM_BUCKETS[name]:
+            running += buckets[labels].get(le, 0.0)
+            samples.append((name + '_bucket', labels + (('le', le),), running))
+        samples.append((name + '_sum', labels, sums.get(labels, 0.0)))
+        samples.append((name + '_count', labels, running))
+
+    return samples
+
+
+class Metrics:
+    """Per-process recording into a ValueFile, and the /metrics route."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.values = None
+        self.pid = None
+        self.directory = None
+        self.gauges_updated = 0.0
+        self.clock = time.perf_counter
+
+    def init_app(self, app):
+        """Add the /metrics route and start counting SQL statements."""
+
+        app.config.setdefault('METRICS_DIR', os.path.join(app.root_path, 'metrics'))
+        app.add_url_rule('/metrics', 'metrics', self.send)
+
+        if not event.contains(Engine, 'before_cursor_execute', _count_statement):
+            event.listen(Engine, 'before_cursor_execute', _count_statement)
+
+    def file(self):
+        """This process's ValueFile, opened again after a fork or a new METRICS_DIR."""
+
+        directory = current_app.config['METRICS_DIR']
+
+        if self.values is None or self.pid != os.getpid() or self.directory != directory:
+            self.pid = os.getpid()
+            self.directory = directory
+            path = None
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, f'{self.pid}.db')
+            self.values = ValueFile(path)
+            self.gauges_updated = 0.0
+
+        return self.values
+
+    def start_request(self):
+        self.local.start = self.clock()
+        self.local.statements = 0
+
+    def end_request(self, endpoint, method, status):
+        """Record a finished request."""
+
+        start = getattr(self.local, 'start', None)
+        if start is None:
+            return
+
+        now = self.clock()
+        elapsed = now - start
+        statements = self.local.statements
+        self.local.start = None
+
+        endpoint = endpoint or 'none'
+        by_endpoint = (('endpoint', endpoint),)
+        bucket = BUCKET_LABELS[bisect_left(BUCKETS, elapsed)]
+
+        with self.lock:
+            values = self.file()
+            values.inc(('warbler_requests_total',
+                        (('endpoint', endpoint), ('method', method), ('status', str(status)))))
+            values.inc(('warbler_request_duration_seconds_bucket', by_endpoint + (('le', bucket),)))
+            values.inc(('warbler_request_duration_seconds_sum', by_endpoint), elapsed)
+            values.inc(('warbler_db_statements_total', by_endpoint), statements)
+
+            if now - self.gauges_updated >= GAUGE_INTERVAL:
+                self.gauges_updated = now
+                self._copy_gauges(values)
+
+    def _copy_gauges(self, values):
+        for label, lru in CACHES.items():
+            by_cache = (('cache', label),)
+            values.set(('warbler_cache_hits_total', by_cache), lru.hits)
+            values.set(('warbler_cache_misses_total', by_cache), lru.misses)
+            values.set(('warbler_cache_bytes', by_cache), lru.size)
+
+        pool = db.engine.pool
+        if hasattr(pool, 'checkedout'):
+            values.set(('warbler_db_pool_size', ()), pool.size())
+            values.set(('warbler_db_pool_checked_out', ()), pool.checkedout())
+            values.set(('warbler_db_pool_idle', ()), pool.checkedin())
+            values.set(('warbler_db_pool_overflow', ()), max(pool.overflow(), 0))
+
+        # the whole template's render is the block named ''
+        family = 'warbler_template_render_seconds'
+        for (template, block), (counts, total) in render_profiler.histograms().items():
+            by_block = (('template', template), ('block', block or ''))
+            for le, count in zip(RENDER_BUCKET_LABELS, counts):
+                values.set((family + '_bucket', by_block + (('le', le),)), count)
+            values.set((family + '_sum', by_block), total)
+
+    def report(self):
+        """Get the totals across processes, as served at /metrics."""
+
+        with self.lock:
+            values = self.file()
+            self._copy_gauges(values)
+            return collect(self.directory, values)
+
+    def send(self):
+        return Response(render(self.report()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def clear(self):
+        """Start this process's numbers again from nothing."""
+
+        with self.lock:
+            if self.values is not None:
+                self.values.close()
+                if self.values.path:
+                    os.remove(self.values.path)
+            self.values = None
+
+
+metrics = Metrics()
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    # only statements run while a request is being timed are counted
+    local = metrics.local
+    if getattr(local, 'start', None) is not None:
+        local.statements += 1
+
+
+def clear_directory(directory):
+    """Delete every process's values file from `directory`."""
+
+    if not os.path.isdir(directory):
+        return 0
+
+    removed = 0
+    for filename in os.listdir(directory):
+        if filename.endswith('.db'):
+            os.remove(os.path.join(directory, filename))
+            removed += 1
+
+    return removed
+
+
+if __name__ == '__main__':
+    from config import Config
+
+    directory = os.environ.get('METRICS_DIR', Config.METRICS_DIR)
+    print(f"removed {clear_directory(directory)} metrics files from {directory}")
@@ -0,0 +1,9 @@
+-- Index the "who does X follow" direction of follows, so the following
+-- listing can keyset-paginate without scanning the whole table.
+--
+-- run like:
+--
+--    psql warbler < migrations/001_follows_following_index.sql
+
+CREATE INDEX IF NOT EXISTS ix_follows_user_following_id
+    ON follows (user_following_id, user_being_followed_id);
@@ -0,0 +1,17 @@
+-- Denormalized follower counts, so the /users directory can sort by
+-- popularity off an index instead of counting follows per request.
+--
+-- run like:
+--
+--    psql warbler < migrations/002_users_followers_count.sql
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE users
+   SET followers_count = (SELECT count(*)
+                            FROM follows
+                           WHERE follows.user_being_followed_id = users.id);
+
+CREATE INDEX IF NOT EXISTS ix_users_followers_count
+    ON users (followers_count, id);
@@ -0,0 +1,18 @@
+-- Periodic snapshots of the in-memory trending counters (trending.py).
+--
+-- run like:
+--
+--    psql warbler < migrations/003_trending_snapshots.sql
+
+CREATE TABLE IF NOT EXISTS trending_snapshots (
+    id SERIAL PRIMARY KEY,
+    taken_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    "window" TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    score DOUBLE PRECISION NOT NULL,
+    rank INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_trending_snapshots_taken_at
+    ON trending_snapshots (taken_at);
@@ -0,0 +1,22 @@
+-- Notifications inbox (notifications.py) and per-user unread counters.
+--
+-- run like:
+--
+--    psql warbler < migrations/004_notifications.sql
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS unread_notifications INTEGER NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS notifications (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    actor_id INTEGER REFERENCES users (id) ON DELETE SET NULL,
+    message_id INTEGER REFERENCES messages (id) ON DELETE CASCADE,
+    actor_count INTEGER NOT NULL,
+    read BOOLEAN NOT NULL,
+    updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_notifications_user_id_updated_at
+    ON notifications (user_id, updated_at, id);
@@ -0,0 +1,21 @@
+-- Soft-deleted accounts and the jobs that purge them (deletions.py).
+--
+-- The purge relies on the ON DELETE CASCADE foreign keys from messages,
+-- likes, follows and notifications to users and messages.
+--
+-- run like:
+--
+--    psql warbler < migrations/005_soft_delete_users.sql
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITHOUT TIME ZONE;
+
+CREATE TABLE IF NOT EXISTS deletion_jobs (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL UNIQUE,
+    stage TEXT NOT NULL,
+    deleted_rows INTEGER NOT NULL,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    updated_at TIMESTAMP WITHOUT TIME ZONE,
+    finished_at TIMESTAMP WITHOUT TIME ZONE
+);
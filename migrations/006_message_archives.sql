@@ -0,0 +1,17 @@
+-- Monthly message routing and the archive tier (partitions.py).
+--
+-- run like:
+--
+--    psql warbler < migrations/006_message_archives.sql
+
+CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp
+    ON messages (user_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS message_archives (
+    id SERIAL PRIMARY KEY,
+    month DATE NOT NULL UNIQUE,
+    filename TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    min_id INTEGER NOT NULL,
+    max_id INTEGER NOT NULL
+);
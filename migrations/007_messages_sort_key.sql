@@ -0,0 +1,20 @@
+-- Time-sortable message keys (sequencer.py).
+--
+-- run like:
+--
+--    psql warbler < migrations/007_messages_sort_key.sql
+--    python sequencer.py
+--    psql warbler -c 'ALTER TABLE messages ALTER COLUMN sort_key SET NOT NULL'
+--
+-- (deploy the app before the backfill, so new messages get keys too.)
+
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS sort_key BIGINT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS messages_sort_key_key
+    ON messages (sort_key);
+
+CREATE INDEX IF NOT EXISTS ix_messages_user_id_sort_key
+    ON messages (user_id, sort_key);
+
+DROP INDEX IF EXISTS ix_messages_user_id_timestamp;
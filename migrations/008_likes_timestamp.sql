@@ -0,0 +1,24 @@
+-- When each like was made, for the keyset-paginated likes page.
+--
+-- Existing likes can't know when they were made; they're given their
+-- message's timestamp, so they at least sort by message age.
+--
+-- run like:
+--
+--    psql warbler < migrations/008_likes_timestamp.sql
+
+ALTER TABLE likes
+    ADD COLUMN IF NOT EXISTS timestamp TIMESTAMP WITHOUT TIME ZONE;
+
+UPDATE likes
+   SET timestamp = messages.timestamp
+  FROM messages
+ WHERE messages.id = likes.message_id
+   AND likes.timestamp IS NULL;
+
+ALTER TABLE likes
+    ALTER COLUMN timestamp SET DEFAULT (now() AT TIME ZONE 'utc'),
+    ALTER COLUMN timestamp SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS ix_likes_user_id_timestamp
+    ON likes (user_id, timestamp, message_id);
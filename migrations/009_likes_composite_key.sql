@@ -0,0 +1,32 @@
+-- Key likes by (user_id, message_id), so any number of users can like a
+-- message but each only once, and index message_id for "who liked this".
+--
+-- Drops the surrogate id and the unique constraint on message_id (which
+-- allowed a single like per message). Any duplicate (user_id, message_id)
+-- pairs are collapsed to the earliest like first.
+--
+-- run like:
+--
+--    psql warbler < migrations/009_likes_composite_key.sql
+
+BEGIN;
+
+DELETE FROM likes a
+ USING likes b
+ WHERE a.user_id = b.user_id
+   AND a.message_id = b.message_id
+   AND (a.timestamp, a.id) > (b.timestamp, b.id);
+
+DELETE FROM likes
+ WHERE user_id IS NULL OR message_id IS NULL;
+
+ALTER TABLE likes
+    DROP CONSTRAINT IF EXISTS likes_message_id_key,
+    DROP CONSTRAINT IF EXISTS likes_pkey,
+    DROP COLUMN IF EXISTS id,
+    ADD PRIMARY KEY (user_id, message_id);
+
+CREATE INDEX IF NOT EXISTS ix_likes_message_id
+    ON likes (message_id);
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- Which shard holds each user's messages and follows (shards.py).
+--
+-- Everyone starts on the primary, 'main'.
+--
+-- run like:
+--
+--    psql warbler < migrations/010_users_shard.sql
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS shard VARCHAR(30) NOT NULL DEFAULT 'main';
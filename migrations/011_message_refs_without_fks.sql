@@ -0,0 +1,20 @@
+-- Keep likes and notifications of messages that leave the messages table
+-- for an archive (partitions.py) or a shard (shards.py): drop their foreign
+-- keys to messages. The app deletes them along with deleted messages.
+--
+-- run like:
+--
+--    psql warbler < migrations/011_message_refs_without_fks.sql
+
+BEGIN;
+
+ALTER TABLE likes
+    DROP CONSTRAINT IF EXISTS likes_message_id_fkey;
+
+ALTER TABLE notifications
+    DROP CONSTRAINT IF EXISTS notifications_message_id_fkey;
+
+CREATE INDEX IF NOT EXISTS ix_notifications_message_id
+    ON notifications (message_id);
+
+COMMIT;
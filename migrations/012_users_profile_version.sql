@@ -0,0 +1,8 @@
+-- Profile cache versions (profiles.py), shared by every app process.
+--
+-- run like:
+--
+--    psql warbler < migrations/012_users_profile_version.sql
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS profile_version INTEGER NOT NULL DEFAULT 0;
@@ -1,12 +1,35 @@
 """SQLAlchemy models for Warbler."""
 
+import re
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
+
+from pagination import encode_cursor, decode_cursor, cursor_matches, cursor_time, CURSOR_TIME_FORMAT
+from replicas import RoutingSQLAlchemy
+from sequencer import message_sort_key
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+HASHTAG_RE = re.compile(r'(?<![\w#])#(\w+)')
+MENTION_RE = re.compile(r'(?<![\w@])@(\w+)')
+
+# How many user cards to show per page on followers/following listings.
+FOLLOWS_PAGE_SIZE = 24
+
+# How many notifications to show per page in the /notifications inbox.
+NOTIFICATIONS_PAGE_SIZE = 30
+
+# How many liked messages to show per page on /users/<id>/likes.
+LIKES_PAGE_SIZE = 50
+
+# How many user cards to show per page in the /users directory.
+DIRECTORY_PAGE_SIZE = 24
+
+# Sort orders offered by the /users directory; the first is the default.
+DIRECTORY_SORTS = ('username', 'newest', 'popular')
 
 
 class Follows(db.Model):
@@ -26,28 +49,126 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key already serves "who follows X"; this covers the
+    # reverse direction, "who does X follow".
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
-
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
+    # No foreign key: archived messages (partitions.py) and messages on
+    # shards (shards.py) aren't in this `messages` table, and their likes
+    # are kept. Message.delete_refs() stands in for the cascade.
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
     )
 
+    # When the like was made; the likes page is ordered by it.
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # The primary key serves "has X liked Y"; message_id on its own covers
+    # "who liked Y" (and deleting a message's likes).
+    __table_args__ = (
+        db.Index('ix_likes_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Like `message_id` as `user_id`, unless they already have.
+
+        A single INSERT ... ON CONFLICT DO NOTHING, so concurrent double
+        clicks can't fail; returns whether a new like was stored.
+        """
+
+        values = {'user_id': user_id, 'message_id': message_id,
+                  'timestamp': datetime.utcnow()}
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            stmt = postgresql.insert(cls.__table__).values(values).on_conflict_do_nothing()
+        else:
+            # SQLite (tests, benchmarks) spells it INSERT OR IGNORE
+            stmt = cls.__table__.insert().prefix_with('OR IGNORE').values(values)
+
+        return db.session.execute(stmt).rowcount == 1
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Unlike `message_id` as `user_id`; returns whether there was a like."""
+
+        return (cls.query
+                   .filter_by(user_id=user_id, message_id=message_id)
+                   .delete(synchronize_session=False)) == 1
+
+    @classmethod
+    def feed_page(cls, user_id, after=None, limit=LIKES_PAGE_SIZE):
+        """Get one page of the messages `user_id` liked, most recent like first.
+
+        Walks ix_likes_user_id_timestamp from the cursor, joining to each
+        message's author to skip deleted accounts, so a page costs the same
+        however many likes the user has. Likes of messages that aren't in
+        the table (archived, or on a shard) are kept.
+
+        Returns (message_ids, next_cursor); next_cursor is None on the last
+        page.
+        """
+
+        query = (db.session
+                 .query(cls.message_id, cls.timestamp)
+                 .outerjoin(Message, Message.id == cls.message_id)
+                 .outerjoin(User, User.id == Message.user_id)
+                 .filter(cls.user_id == user_id, User.deleted_at.is_(None)))
+
+        values = decode_cursor(after, 2)
+
+        if cursor_matches(values, (str, int)) and cursor_time(values[0]):
+            query = query.filter(db.tuple_(cls.timestamp, cls.message_id)
+                                 < db.tuple_(cursor_time(values[0]), values[1]))
+
+        rows = (query
+                .order_by(cls.timestamp.desc(), cls.message_id.desc())
+                .limit(limit + 1)
+                .all())
+
+        next_cursor = None
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(
+                [rows[-1].timestamp.strftime(CURSOR_TIME_FORMAT), rows[-1].message_id])
+
+        return [row.message_id for row in rows], next_cursor
+
+    @classmethod
+    def liked_among(cls, user_id, message_ids):
+        """Get which of `message_ids` (one page's worth) `user_id` has liked."""
+
+        if not message_ids:
+            return set()
+
+        return {message_id for (message_id,) in
+                db.session.query(cls.message_id)
+                          .filter(cls.user_id == user_id,
+                                  cls.message_id.in_(message_ids))}
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,25 +215,77 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized so the directory can rank by popularity off an index;
+    # kept up to date by the follow routes, rebuilt by
+    # refresh_followers_count().
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Number of unread rows in notifications; reset when the inbox is read.
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the account is deleted. The user and everything they made
+    # are hidden from then on; deletions.py removes the rows later.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # The shard holding the user's messages and follows (see shards.py).
+    shard = db.Column(
+        db.String(30),
+        nullable=False,
+        default='main',
+        server_default='main',
+    )
+
+    # Moved on by profiles.bump() whenever the profile page changes, so
+    # every process can tell its cached copy is stale (see profiles.py).
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    __table_args__ = (
+        db.Index('ix_users_followers_count', 'followers_count', 'id'),
+    )
+
+    # passive_deletes: the DB cascades these, so deleting a user never
+    # loads their messages, follows or likes into the session.
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        primaryjoin='Likes.user_id == User.id',
+        secondaryjoin='foreign(Likes.message_id) == Message.id',
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -121,14 +294,87 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self.follows_exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return self.follows_exists(self.id, other_user.id)
+
+    @staticmethod
+    def follows_exists(follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?
+
+        Works off ids, so `other_user` in the methods above can be anything
+        with an `id` (e.g. a cached user), and doesn't load either list.
+        """
+
+        query = Follows.query.filter_by(user_following_id=follower_id,
+                                        user_being_followed_id=followed_id)
+        return db.session.query(query.exists()).scalar()
+
+    @classmethod
+    def follows_page(cls, user_id, direction, after=None,
+                     limit=FOLLOWS_PAGE_SIZE):
+        """Get one page of user cards for `user_id`'s followers/following.
+
+        `direction` is either 'followers' or 'following'. Only the columns a
+        card needs are selected, and pages are keyset-paginated on the other
+        half of the follows primary key, so a page costs the same no matter
+        how many follows the user has.
+
+        Returns (cards, next_cursor); next_cursor is None on the last page.
+        """
+
+        if direction == 'followers':
+            own_col = Follows.user_being_followed_id
+            other_col = Follows.user_following_id
+        else:
+            own_col = Follows.user_following_id
+            other_col = Follows.user_being_followed_id
+
+        query = (db.session
+                 .query(cls.id, cls.username, cls.image_url,
+                        cls.header_image_url, cls.bio)
+                 .join(Follows, other_col == cls.id)
+                 .filter(own_col == user_id, cls.deleted_at.is_(None)))
+
+        if after is not None:
+            query = query.filter(other_col > after)
+
+        cards = query.order_by(other_col).limit(limit + 1).all()
+
+        if len(cards) > limit:
+            return cards[:limit], cards[limit - 1].id
+
+        return cards, None
+
+    @classmethod
+    def follow_edges(cls, user_ids, other_ids):
+        """Get follow relationships between two sets of user ids.
+
+        Returns a set of (follower_id, followed_id) pairs covering both
+        directions, fetched in a single query. Used to work out mutual
+        follows and follow buttons for a whole page of cards at once.
+        """
+
+        user_ids = list(user_ids)
+        other_ids = list(other_ids)
+
+        if not user_ids or not other_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_following_id,
+                       Follows.user_being_followed_id)
+                .filter(db.or_(
+                    db.and_(Follows.user_following_id.in_(user_ids),
+                            Follows.user_being_followed_id.in_(other_ids)),
+                    db.and_(Follows.user_being_followed_id.in_(user_ids),
+                            Follows.user_following_id.in_(other_ids))))
+                .all())
+
+        return set(rows)
     
     def change_password(self, new_password):
         if not new_password:
@@ -138,6 +384,71 @@ class User(db.Model):
 
         self.password = hashed_password
 
+    @classmethod
+    def directory_page(cls, sort='username', search=None, after=None,
+                       limit=DIRECTORY_PAGE_SIZE):
+        """Get one page of user cards for the /users directory.
+
+        `sort` is one of DIRECTORY_SORTS; `after` is the cursor from the
+        previous page. Only the columns a card needs are selected.
+
+        Returns (cards, next_cursor); next_cursor is None on the last page.
+        """
+
+        # sort -> (key columns, descending); each is backed by an index
+        # (username's unique index, the primary key, and
+        # ix_users_followers_count), so every page is a range scan.
+        sorts = {
+            'username': ([cls.username], False),
+            'newest': ([cls.id], True),
+            'popular': ([cls.followers_count, cls.id], True),
+        }
+
+        keys, descending = sorts.get(sort, sorts[DIRECTORY_SORTS[0]])
+
+        query = db.session.query(cls.id, cls.username, cls.image_url,
+                                 cls.header_image_url, cls.bio,
+                                 cls.followers_count)
+        query = query.filter(cls.deleted_at.is_(None))
+
+        if search:
+            query = query.filter(cls.username.like(f"%{search}%"))
+
+        values = decode_cursor(after, len(keys))
+
+        if cursor_matches(values, [key.type.python_type for key in keys]):
+            if len(keys) == 1:
+                key, bound = keys[0], values[0]
+            else:
+                key, bound = db.tuple_(*keys), db.tuple_(*values)
+            query = query.filter(key < bound if descending else key > bound)
+
+        order = [key.desc() if descending else key for key in keys]
+        cards = query.order_by(*order).limit(limit + 1).all()
+
+        if len(cards) > limit:
+            last = cards[limit - 1]
+            return cards[:limit], encode_cursor(
+                [getattr(last, key.key) for key in keys])
+
+        return cards, None
+
+    @classmethod
+    def refresh_followers_count(cls):
+        """Recompute every user's followers_count from the follows table.
+
+        Use after bulk-loading follows (e.g. seeding) or to repair drift.
+        """
+
+        counts = (db.session
+                  .query(db.func.count(Follows.user_following_id))
+                  .filter(Follows.user_being_followed_id == cls.id)
+                  .correlate(cls)
+                  .as_scalar())
+
+        cls.query.update({cls.followers_count: counts},
+                         synchronize_session=False)
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -179,7 +490,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -207,7 +518,16 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+    )
+
+    # Time-sortable unique key (see sequencer.py); timelines order and
+    # paginate on it. Must come after timestamp, which its default reads.
+    sort_key = db.Column(
+        db.BigInteger,
+        nullable=False,
+        unique=True,
+        default=message_sort_key,
     )
 
     user_id = db.Column(
@@ -216,8 +536,291 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # profile pages and the month windows in partitions.py are range scans
+    __table_args__ = (
+        db.Index('ix_messages_user_id_sort_key', 'user_id', 'sort_key'),
+    )
+
     user = db.relationship('User')
 
+    def hashtags(self):
+        """Get the distinct hashtags in this message, lowercased, without '#'."""
+
+        return sorted({tag.lower() for tag in HASHTAG_RE.findall(self.text)})
+
+    def mentions(self):
+        """Get the distinct usernames @mentioned in this message."""
+
+        return sorted(set(MENTION_RE.findall(self.text)))
+
+    @classmethod
+    def delete_refs(cls, message_ids):
+        """Delete the likes and notifications of messages being deleted (caller commits).
+
+        They have no foreign key to messages, so the database doesn't
+        cascade to them. `message_ids` is a list or a subquery.
+        """
+
+        for model in (Likes, Notification):
+            (model.query
+                 .filter(model.message_id.in_(message_ids))
+                 .delete(synchronize_session=False))
+
+
+class Notification(db.Model):
+    """Something that happened to a user: a mention, a follow or a like.
+
+    Repeated events of the same kind on the same target (e.g. many likes on
+    one message, or many new followers) are grouped into one unread row;
+    `actor_id` is the most recent actor and `actor_count` how many there
+    were in total.
+    """
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='SET NULL'),
+    )
+
+    # No foreign key, like Likes.message_id.
+    message_id = db.Column(
+        db.Integer,
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_notifications_user_id_updated_at',
+                 'user_id', 'updated_at', 'id'),
+        db.Index('ix_notifications_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def inbox_page(cls, user_id, after=None, limit=NOTIFICATIONS_PAGE_SIZE):
+        """Get one page of `user_id`'s notifications, most recent first.
+
+        Each row carries the actor's username and image and the message
+        text, so the inbox renders without further queries.
+
+        Returns (rows, next_cursor); next_cursor is None on the last page.
+        """
+
+        query = (db.session
+                 .query(cls.id, cls.kind, cls.actor_id, cls.actor_count,
+                        cls.message_id, cls.read, cls.updated_at,
+                        User.username.label('actor_username'),
+                        User.image_url.label('actor_image_url'),
+                        Message.text.label('message_text'))
+                 .outerjoin(User, User.id == cls.actor_id)
+                 .outerjoin(Message, Message.id == cls.message_id)
+                 .filter(cls.user_id == user_id))
+
+        values = decode_cursor(after, 2)
+
+        if cursor_matches(values, (str, int)) and cursor_time(values[0]):
+            query = query.filter(db.tuple_(cls.updated_at, cls.id)
+                                 < db.tuple_(cursor_time(values[0]), values[1]))
+
+        rows = (query
+                .order_by(cls.updated_at.desc(), cls.id.desc())
+                .limit(limit + 1)
+                .all())
+
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            return rows[:limit], encode_cursor(
+                [last.updated_at.strftime(CURSOR_TIME_FORMAT), last.id])
+
+        return rows, None
+
+    @classmethod
+    def mark_all_read(cls, user_id):
+        """Mark all of `user_id`'s notifications read and zero their counter."""
+
+        (cls.query
+            .filter_by(user_id=user_id, read=False)
+            .update({cls.read: True}, synchronize_session=False))
+
+        (User.query
+             .filter_by(id=user_id)
+             .update({User.unread_notifications: 0},
+                     synchronize_session=False))
+
+
+class TrendingSnapshot(db.Model):
+    """One ranked entry from a periodic snapshot of trending.py's state."""
+
+    __tablename__ = 'trending_snapshots'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    taken_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        index=True,
+    )
+
+    window = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    key = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    @classmethod
+    def latest(cls, window, kind):
+        """Get the (key, score) pairs for `window`/`kind` from the newest snapshot."""
+
+        taken_at = db.session.query(db.func.max(cls.taken_at)).scalar()
+
+        if taken_at is None:
+            return []
+
+        rows = (db.session
+                .query(cls.key, cls.score)
+                .filter_by(taken_at=taken_at, window=window, kind=kind)
+                .order_by(cls.rank)
+                .all())
+
+        return [(key, score) for key, score in rows]
+
+
+class DeletionJob(db.Model):
+    """Progress of purging one deleted account (see deletions.py)."""
+
+    __tablename__ = 'deletion_jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Not a foreign key: the job outlives the user row it deletes.
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+        unique=True,
+    )
+
+    # Which kind of rows is being deleted now; 'done' when finished.
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+        default='likes',
+    )
+
+    deleted_rows = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+
+
+class MessageArchive(db.Model):
+    """A month of messages moved to an archive file (see partitions.py)."""
+
+    __tablename__ = 'message_archives'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    month = db.Column(
+        db.Date,
+        nullable=False,
+        unique=True,
+    )
+
+    filename = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    rows = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # so a message can be found by id without opening every archive
+    min_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    max_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -227,3 +830,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+
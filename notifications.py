@@ -0,0 +1,196 @@
+"""Batched delivery of notifications.
+
+Routes call `notifications.notify(...)` after committing; that only puts an
+event on an in-process queue. A background worker takes events off the
+queue a batch at a time, groups them, and writes each batch in one
+transaction:
+
+- events for the same (recipient, kind, message) are coalesced, and merged
+  into that recipient's existing unread notification for it if there is one,
+  so 10k likes on one message is one row with actor_count=10000;
+- each recipient's unread counter is bumped once per batch.
+
+With NOTIFICATIONS_ASYNC off (as in the tests), events are delivered right
+away on the calling thread instead.
+"""
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app
+
+from models import db, User, Notification
+
+# Most events the worker writes in one transaction.
+BATCH_SIZE = 500
+
+# How long (in seconds) the worker waits to fill a batch once it has one event.
+BATCH_WAIT = 0.05
+
+# Most events held in memory before notify() blocks on the worker.
+QUEUE_SIZE = 10000
+
+
+def deliver(events):
+    """Write a batch of (user_id, kind, actor_id, message_id, at) events.
+
+    Commits the session.
+    """
+
+    # (user_id, kind, message_id) -> [latest actor_id, count, latest time]
+    groups = OrderedDict()
+
+    for user_id, kind, actor_id, message_id, at in events:
+        group = groups.setdefault((user_id, kind, message_id), [actor_id, 0, at])
+        group[0] = actor_id
+        group[1] += 1
+        group[2] = at
+
+    user_ids = list({user_id for (user_id, _, _) in groups})
+    kinds = list({kind for (_, kind, _) in groups})
+    message_ids = list({message_id for (_, _, message_id) in groups
+                        if message_id is not None})
+
+    existing = (Notification.query
+                .filter(Notification.user_id.in_(user_ids),
+                        Notification.kind.in_(kinds),
+                        Notification.read.is_(False),
+                        db.or_(Notification.message_id.in_(message_ids or [0]),
+                               Notification.message_id.is_(None)))
+                .all())
+
+    unread = {(n.user_id, n.kind, n.message_id): n for n in existing}
+    new_rows = []
+    new_counts = {}
+
+    for key, (actor_id, count, at) in groups.items():
+        notification = unread.get(key)
+
+        if notification:
+            notification.actor_id = actor_id
+            notification.actor_count = Notification.actor_count + count
+            notification.updated_at = at
+        else:
+            user_id, kind, message_id = key
+            new_rows.append({
+                'user_id': user_id,
+                'kind': kind,
+                'actor_id': actor_id,
+                'message_id': message_id,
+                'actor_count': count,
+                'read': False,
+                'updated_at': at,
+            })
+            new_counts[user_id] = new_counts.get(user_id, 0) + 1
+
+    if new_rows:
+        db.session.bulk_insert_mappings(Notification, new_rows)
+
+    for user_id, count in new_counts.items():
+        (User.query
+             .filter_by(id=user_id)
+             .update({User.unread_notifications:
+                      User.unread_notifications + count},
+                     synchronize_session=False))
+
+    db.session.commit()
+
+
+class NotificationQueue:
+    """Queue of notification events plus the worker thread that drains it."""
+
+    def __init__(self, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT,
+                 maxsize=QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.events = queue.Queue(maxsize)
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """Set the NOTIFICATIONS_ASYNC default for `app`."""
+
+        app.config.setdefault('NOTIFICATIONS_ASYNC', True)
+
+    def notify(self, user_id, kind, actor_id, message_id=None):
+        """Record that `actor_id` did `kind` to `user_id` (and `message_id`).
+
+        Users aren't notified about their own actions.
+        """
+
+        if user_id == actor_id:
+            return
+
+        event = (user_id, kind, actor_id, message_id, datetime.utcnow())
+
+        if not current_app.config['NOTIFICATIONS_ASYNC']:
+            deliver([event])
+            return
+
+        self._ensure_worker()
+        self.events.put(event)
+
+    def notify_mentions(self, message):
+        """Notify every existing user @mentioned in `message`."""
+
+        usernames = message.mentions()
+
+        if not usernames:
+            return
+
+        mentioned = (db.session
+                     .query(User.id)
+                     .filter(User.username.in_(usernames))
+                     .all())
+
+        for (user_id,) in mentioned:
+            self.notify(user_id, 'mention', message.user_id, message.id)
+
+    def _ensure_worker(self):
+        # Started lazily, so each forked worker process gets its own thread.
+        if self.worker and self.worker.is_alive():
+            return
+
+        with self.lock:
+            if self.worker and self.worker.is_alive():
+                return
+
+            self.worker = threading.Thread(target=self._run,
+                                           args=(current_app._get_current_object(),),
+                                           name='notifications', daemon=True)
+            self.worker.start()
+
+    def _next_batch(self):
+        events = [self.events.get()]
+        deadline = time.monotonic() + self.batch_wait
+
+        while len(events) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                events.append(self.events.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return events
+
+    def _run(self, app):
+        while True:
+            events = self._next_batch()
+
+            with app.app_context():
+                try:
+                    deliver(events)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception(
+                        "Dropped a batch of %d notification events", len(events))
+                finally:
+                    db.session.remove()
+
+
+notifications = NotificationQueue()
@@ -0,0 +1,71 @@
+"""Opaque cursors for keyset pagination.
+
+A cursor holds the sort-key values of the last row on a page; the next page
+asks for rows strictly after it. Cursors are URL-safe strings so they can go
+straight into query strings.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+# How datetimes are written inside cursors.
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(values):
+    """Encode a list of sort-key values as a URL-safe cursor string."""
+
+    raw = json.dumps(list(values), separators=(',', ':')).encode('UTF-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """Decode a cursor made by `encode_cursor`.
+
+    Returns the list of values, or None if the cursor is missing, malformed
+    or doesn't hold exactly `size` values (so a bad cursor just means
+    "start from the first page").
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError):
+        return None
+
+    if not isinstance(values, list) or len(values) != size:
+        return None
+
+    return values
+
+
+def cursor_matches(values, types):
+    """Do decoded cursor `values` have the Python `types` a query compares them with?
+
+    A cursor from another sort order, or one edited by hand, would otherwise
+    reach SQL with the wrong types; callers treat it as no cursor instead.
+    """
+
+    if values is None or len(values) != len(types):
+        return False
+
+    for value, expected in zip(values, types):
+        if not isinstance(value, expected) or isinstance(value, bool):
+            return False
+        if isinstance(value, str) and '\x00' in value:
+            return False
+
+    return True
+
+
+def cursor_time(value):
+    """Parse a datetime stored in a cursor; None if it isn't one."""
+
+    try:
+        return datetime.strptime(value, CURSOR_TIME_FORMAT)
+    except (ValueError, TypeError):
+        return None
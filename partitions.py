@@ -0,0 +1,426 @@
+"""Monthly partitions of messages, and an archive tier for cold months.
+
+Messages are split into calendar months by sort key (which is time-ordered,
+see sequencer.py). Timeline and profile queries are routed to recent months
+first: `recent_first()` runs the query over the current month, then over
+exponentially wider ranges further back, only while the page isn't full. Most pages are filled from the current
+month, so the sort only ever sees a month's worth of candidate rows.
+
+Months older than HOT_MONTHS are archived: `archive_month()` writes every
+message of the month to a packed columnar file, records it as a
+MessageArchive and deletes the rows from `messages`. Their likes and
+notifications stay, pointing at the archived ids. Purging a deleted
+account rewrites the archives holding its messages without them
+(`remove_archived()`). Profile pages that run
+out of hot messages read older ones back from the archives, newest month
+first, and `archived_messages()` finds others by id. Run archival from
+cron, e.g. daily:
+
+    python partitions.py
+
+Partitioning is done in the app rather than with Postgres table
+partitioning, since a partitioned `messages` would need the timestamp in
+its primary key, and likes and notifications reference `messages.id`. So
+it works the same on SQLite, which is how the tests and benchmarks can
+run it without Postgres.
+
+Archive file layout (all integers little-endian):
+
+    b'WPK1' | header length (uint32) | JSON header | column blocks
+
+The header has the row count and, for each column, its offset, length and
+codec. Rows are sorted by user id, then newest first, and the `users`
+column holds (user_id, row count) runs, so a user's rows are one slice of
+every column. Every block is zlib-compressed.
+"""
+
+import json
+import os
+import secrets
+import struct
+import sys
+import zlib
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from flask import current_app
+
+from models import db, Message, MessageArchive
+from sequencer import key_at, key_time
+
+# Months (counting the current one) that stay in the messages table.
+HOT_MONTHS = 12
+
+ARCHIVE_MAGIC = b'WPK1'
+
+ArchivedMessage = namedtuple('ArchivedMessage', 'id text timestamp user_id')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def month_start(when):
+    """Midnight on the first of `when`'s month."""
+
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, count):
+    """The first of the month `count` months after (or before) `month`."""
+
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def recent_first(query, limit, now=None):
+    """Get up to `limit` rows of `query`, searching recent months first.
+
+    `query` must be ordered by Message.sort_key, newest first. It's run over
+    the current month, then the month before, then the two before that, and
+    so on, until the page is full or there are no older messages.
+    """
+
+    start = month_start(now or datetime.utcnow())
+    end = None
+    span = 1
+    oldest = None
+    rows = []
+
+    while True:
+        window = query.filter(Message.sort_key >= key_at(start))
+        if end is not None:
+            window = window.filter(Message.sort_key < key_at(end))
+
+        rows.extend(window.limit(limit - len(rows)).all())
+
+        if len(rows) >= limit:
+            return rows
+
+        if oldest is None:
+            oldest = (query
+                      .order_by(None)
+                      .with_entities(db.func.min(Message.sort_key))
+                      .scalar())
+
+        if oldest is None or oldest >= key_at(start):
+            return rows
+
+        end = start
+        start = add_months(start, -span)
+        span *= 2
+
+
+##############################################################################
+# Archive files
+
+
+def _pack(values, typecode):
+    packed = array(typecode, values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return zlib.compress(packed.tobytes())
+
+
+def _unpack(block, typecode):
+    unpacked = array(typecode)
+    unpacked.frombytes(zlib.decompress(block))
+    if sys.byteorder != 'little':
+        unpacked.byteswap()
+    return unpacked
+
+
+def _micros(when):
+    return (when - EPOCH) // timedelta(microseconds=1)
+
+
+def write_archive(path, rows):
+    """Write (id, user_id, timestamp, text) rows to a packed archive file."""
+
+    # by user, newest first within each user
+    ordered = sorted(rows, key=lambda row: (row[1], -_micros(row[2]), -row[0]))
+
+    runs = []
+    for row in ordered:
+        if runs and runs[-1][0] == row[1]:
+            runs[-1][1] += 1
+        else:
+            runs.append([row[1], 1])
+
+    texts = [row[3].encode('UTF-8') for row in ordered]
+
+    blocks = [
+        ('users', 'q', _pack([value for run in runs for value in run], 'q')),
+        ('id', 'q', _pack([row[0] for row in ordered], 'q')),
+        ('timestamp', 'q', _pack([_micros(row[2]) for row in ordered], 'q')),
+        ('text_length', 'q', _pack([len(text) for text in texts], 'q')),
+        ('text', 'utf-8', zlib.compress(b''.join(texts))),
+    ]
+
+    columns = {}
+    offset = 0
+    for name, codec, block in blocks:
+        columns[name] = {'codec': codec, 'offset': offset, 'length': len(block)}
+        offset += len(block)
+
+    header = json.dumps({'rows': len(ordered), 'columns': columns}).encode('UTF-8')
+
+    partial = path + '.partial'
+    with open(partial, 'wb') as archive:
+        archive.write(ARCHIVE_MAGIC + struct.pack('<I', len(header)) + header)
+        for name, codec, block in blocks:
+            archive.write(block)
+
+    os.replace(partial, path)
+
+
+@lru_cache(maxsize=8)
+def read_archive(path):
+    """Decode an archive file into columns, and where each user's rows are.
+
+    Returns (columns, runs); runs maps user_id to (start, stop). Archives
+    never change once written, so the last few decoded are kept.
+    """
+
+    with open(path, 'rb') as archive:
+        data = archive.read()
+
+    if data[:4] != ARCHIVE_MAGIC:
+        raise ValueError(f"{path} is not a message archive")
+
+    (header_length,) = struct.unpack('<I', data[4:8])
+    header = json.loads(data[8:8 + header_length])
+    body = 8 + header_length
+
+    columns = {}
+    for name, column in header['columns'].items():
+        block = data[body + column['offset']:
+                     body + column['offset'] + column['length']]
+        if column['codec'] == 'utf-8':
+            columns[name] = zlib.decompress(block)
+        else:
+            columns[name] = _unpack(block, column['codec'])
+
+    runs = {}
+    position = 0
+    users = columns['users']
+    for i in range(0, len(users), 2):
+        runs[users[i]] = (position, position + users[i + 1])
+        position += users[i + 1]
+
+    starts = [0]
+    for length in columns['text_length']:
+        starts.append(starts[-1] + length)
+    columns['text_start'] = starts
+
+    return columns, runs
+
+
+def _archived_row(columns, user_id, i):
+    start = columns['text_start'][i]
+    text = columns['text'][start:columns['text_start'][i + 1]].decode('UTF-8')
+    timestamp = EPOCH + timedelta(microseconds=columns['timestamp'][i])
+    return ArchivedMessage(columns['id'][i], text, timestamp, user_id)
+
+
+def archive_path(archive):
+    return os.path.join(current_app.config['MESSAGE_ARCHIVE_DIR'], archive.filename)
+
+
+def archived_user_messages(user_id, limit):
+    """Get up to `limit` of a user's archived messages, newest first."""
+
+    messages = []
+
+    for archive in MessageArchive.query.order_by(MessageArchive.month.desc()):
+        columns, runs = read_archive(archive_path(archive))
+        start, stop = runs.get(user_id, (0, 0))
+
+        for i in range(start, min(stop, start + limit - len(messages))):
+            messages.append(_archived_row(columns, user_id, i))
+
+        if len(messages) >= limit:
+            break
+
+    return messages
+
+
+@lru_cache(maxsize=8)
+def archive_positions(path):
+    """Map each message id in an archive to (user_id, row)."""
+
+    columns, runs = read_archive(path)
+    return {columns['id'][i]: (user_id, i)
+            for user_id, (start, stop) in runs.items()
+            for i in range(start, stop)}
+
+
+def archived_messages(message_ids):
+    """Get the ArchivedMessages of whichever of `message_ids` are archived."""
+
+    message_ids = set(message_ids)
+
+    if not message_ids:
+        return []
+
+    archives = (MessageArchive.query
+                .filter(MessageArchive.min_id <= max(message_ids),
+                        MessageArchive.max_id >= min(message_ids)))
+
+    messages = []
+
+    for archive in archives:
+        path = archive_path(archive)
+        columns, runs = read_archive(path)
+        positions = archive_positions(path)
+
+        for message_id in message_ids & positions.keys():
+            messages.append(_archived_row(columns, *positions[message_id]))
+
+    return messages
+
+
+##############################################################################
+# Archival
+
+
+def archive_rows(archive):
+    """Get every row of `archive` as (id, user_id, timestamp, text)."""
+
+    columns, runs = read_archive(archive_path(archive))
+
+    return [(row.id, row.user_id, row.timestamp, row.text)
+            for user_id, (start, stop) in runs.items()
+            for row in (_archived_row(columns, user_id, i) for i in range(start, stop))]
+
+
+def save_archive(archive, rows):
+    """Write (id, user_id, timestamp, text) `rows` as `archive`'s file and commit.
+
+    An archive that already has a file gets a new one under a new name,
+    since read_archive() caches files as never changing; the old file is
+    removed once the new one is committed.
+    """
+
+    old_path = archive_path(archive) if archive.filename else None
+    name = f"messages-{archive.month:%Y-%m}"
+    archive.filename = f"{name}-{secrets.token_hex(4)}.wpk" if old_path else f"{name}.wpk"
+    archive.rows = len(rows)
+    archive.min_id = min(row[0] for row in rows)
+    archive.max_id = max(row[0] for row in rows)
+
+    os.makedirs(current_app.config['MESSAGE_ARCHIVE_DIR'], exist_ok=True)
+    write_archive(archive_path(archive), rows)
+
+    db.session.add(archive)
+    db.session.commit()
+
+    if old_path:
+        os.remove(old_path)
+
+
+def archived_user_ids(archive, user_id):
+    """Get the ids of `user_id`'s messages in `archive`."""
+
+    columns, runs = read_archive(archive_path(archive))
+    start, stop = runs.get(user_id, (0, 0))
+    return list(columns['id'][start:stop])
+
+
+def remove_archived(archive, message_ids):
+    """Rewrite `archive` without `message_ids` and commit; an archive left empty is dropped."""
+
+    message_ids = set(message_ids)
+    rows = [row for row in archive_rows(archive) if row[0] not in message_ids]
+
+    if rows:
+        save_archive(archive, rows)
+        return
+
+    path = archive_path(archive)
+    db.session.delete(archive)
+    db.session.commit()
+    os.remove(path)
+
+
+def archive_month(month, chunk_size=1000):
+    """Move every message from `month` into an archive file.
+
+    Safe to re-run: if it stopped after writing the file, the rows left
+    are deleted, since the file already has them. Rows the file doesn't
+    have (backdated messages, say) are added to it first.
+    """
+
+    from deletions import delete_chunk
+
+    month = month_start(month)
+    in_month = db.and_(Message.sort_key >= key_at(month),
+                       Message.sort_key < key_at(add_months(month, 1)))
+
+    # read in sort key order, a chunk at a time, rather than buffering the
+    # whole month's result set as well
+    rows = []
+    after = key_at(month) - 1
+
+    while True:
+        chunk = (db.session
+                 .query(Message.sort_key, Message.id, Message.user_id,
+                        Message.timestamp, Message.text)
+                 .filter(in_month, Message.sort_key > after)
+                 .order_by(Message.sort_key)
+                 .limit(chunk_size)
+                 .all())
+
+        rows.extend(tuple(row[1:]) for row in chunk)
+
+        if len(chunk) < chunk_size:
+            break
+        after = chunk[-1].sort_key
+
+    archive = MessageArchive.query.filter_by(month=month.date()).first()
+
+    if archive is None:
+        if not rows:
+            return None
+        archive = MessageArchive(month=month.date())
+        save_archive(archive, rows)
+    else:
+        archived = archive_positions(archive_path(archive))
+        missing = [row for row in rows if row[0] not in archived]
+        if missing:
+            save_archive(archive, archive_rows(archive) + missing)
+
+    while delete_chunk(Message.__table__, in_month, chunk_size) == chunk_size:
+        db.session.commit()
+    db.session.commit()
+
+    return archive
+
+
+def archive_cold(now=None, hot_months=HOT_MONTHS):
+    """Archive every month older than the `hot_months` most recent."""
+
+    cutoff = add_months(month_start(now or datetime.utcnow()), 1 - hot_months)
+    oldest = (db.session
+              .query(db.func.min(Message.sort_key))
+              .filter(Message.sort_key < key_at(cutoff))
+              .scalar())
+
+    archived = []
+    month = month_start(key_time(oldest)) if oldest else cutoff
+
+    while month < cutoff:
+        archive = archive_month(month)
+        if archive is not None:
+            archived.append(archive)
+        month = add_months(month, 1)
+
+    return archived
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        for archive in archive_cold():
+            print(f"archived {archive.rows} messages to {archive.filename}")
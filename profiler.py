@@ -0,0 +1,318 @@
+"""Sampling profiler for production requests.
+
+A request is profiled when it carries a signed X-Warbler-Profile header
+(see `token()`; `python profiler.py [wall|cpu]` prints one), or at random
+for PROFILE_SAMPLE_RATE of all requests. While any request is being
+profiled, one background thread per process wakes every INTERVAL seconds
+and records the stack of each profiled request's thread:
+
+- wall: each sample counts the time since the previous one, so waiting on
+  the database shows up as much as running Python;
+- cpu: each sample counts the CPU time the thread used since the previous
+  one, so waiting costs nothing.
+
+Profiles are saved as collapsed stacks ("frame;frame;frame microseconds"
+per line), which flamegraph.pl and speedscope read as they are, into
+PROFILE_DIR. The oldest are deleted past PROFILE_KEEP files or
+PROFILE_DIR_BYTES. Users whose ids are in ADMIN_USER_IDS can list and
+download them at /admin/profiles.
+
+With nothing to profile the sampler thread sleeps, and a request costs a
+header lookup (plus a random number if PROFILE_SAMPLE_RATE is set).
+"""
+
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime
+
+from flask import _request_ctx_stack, abort, current_app, g, render_template, send_from_directory
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+PROFILE_HEADER = 'X-Warbler-Profile'
+PROFILE_ENVIRON = 'HTTP_X_WARBLER_PROFILE'
+
+# Where a request's Profile is kept while it runs.
+PROFILE_KEY = 'warbler.profile'
+
+# cpu needs per-thread CPU clocks, which not every platform has
+MODES = ('wall', 'cpu') if hasattr(time, 'pthread_getcpuclockid') else ('wall',)
+
+# Seconds between samples.
+INTERVAL = 0.005
+
+# How long a signed profiling header stays valid, in seconds.
+TOKEN_MAX_AGE = 24 * 60 * 60
+
+PROFILE_KEEP = 500
+PROFILE_DIR_BYTES = 64 * 1024 * 1024
+
+# Frames past this depth (from the innermost) are left off.
+MAX_DEPTH = 100
+
+NAME_RE = re.compile(r'^(\d+)-(\d+)-([\w.]+)-(wall|cpu)\.folded$')
+
+SavedProfile = namedtuple('SavedProfile', 'name when pid endpoint mode size')
+
+# "file.py:function" for each code object seen
+_labels = {}
+
+
+def _label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f'{os.path.basename(code.co_filename)}:{code.co_name}'
+    return label
+
+
+def collapse(frame):
+    """The stack ending at `frame` as 'outermost;...;innermost'."""
+
+    labels = []
+    while frame is not None and len(labels) < MAX_DEPTH:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+
+    return ';'.join(reversed(labels))
+
+
+class Profile:
+    """Stack samples from one request's thread."""
+
+    def __init__(self, mode, thread_id):
+        self.mode = mode
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.samples = 0
+        self.clock = time.perf_counter
+
+        if mode == 'cpu':
+            cpu_clock = time.pthread_getcpuclockid(thread_id)
+            self.clock = lambda: time.clock_gettime(cpu_clock)
+
+        self.last = self.clock()
+
+    def sample(self, frame):
+        now = self.clock()
+        micros = int((now - self.last) * 1000000)
+        self.last = now
+
+        if micros > 0:
+            self.stacks[collapse(frame)] += micros
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {micros}\n' for stack, micros in self.stacks.most_common())
+
+
+class Sampler:
+    """A thread that samples the stacks of the threads being profiled."""
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def add(self, profile):
+        with self.lock:
+            self.profiles[profile.thread_id] = profile
+            self._ensure_thread()
+        self.wake.set()
+
+    def remove(self, profile):
+        with self.lock:
+            self.profiles.pop(profile.thread_id, None)
+
+    def _ensure_thread(self):
+        # Started lazily, so each forked worker process gets its own thread.
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            if not self.profiles:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+
+            with self.lock:
+                for thread_id, profile in self.profiles.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.sample(frame)
+
+
+class ProfileStore:
+    """A directory of saved profiles, oldest deleted first past its limits."""
+
+    def __init__(self, directory, keep=PROFILE_KEEP, max_bytes=PROFILE_DIR_BYTES):
+        self.directory = directory
+        self.keep = keep
+        self.max_bytes = max_bytes
+
+    def save(self, profile, endpoint):
+        """Write `profile` and trim the directory; returns the file's name."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        endpoint = re.sub(r'[^\w.]', '_', endpoint or 'none')
+        name = f'{int(time.time() * 1000):013d}-{os.getpid()}-{endpoint}-{profile.mode}.folded'
+
+        fd, partial = tempfile.mkstemp(dir=self.directory, suffix='.partial')
+        with os.fdopen(fd, 'w') as out:
+            out.write(profile.collapsed())
+        os.replace(partial, os.path.join(self.directory, name))
+
+        self.trim()
+        return name
+
+    def list(self):
+        """Get a SavedProfile per file, newest first."""
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        saved = []
+        for name in os.listdir(self.directory):
+            match = NAME_RE.match(name)
+            if not match:
+                continue
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            millis, pid, endpoint, mode = match.groups()
+            saved.append(SavedProfile(name, datetime.utcfromtimestamp(int(millis) / 1000),
+                                      int(pid), endpoint, mode, size))
+
+        return sorted(saved, key=lambda profile: profile.name, reverse=True)
+
+    def trim(self):
+        """Delete the oldest profiles past `keep` files or `max_bytes`."""
+
+        saved = self.list()
+        total = sum(profile.size for profile in saved)
+
+        while saved and (len(saved) > self.keep or total > self.max_bytes):
+            oldest = saved.pop()
+            total -= oldest.size
+            try:
+                os.remove(os.path.join(self.directory, oldest.name))
+            except FileNotFoundError:
+                pass    # another worker got to it first
+
+
+class RequestProfiler:
+    """Decides which requests to profile, and serves the saved profiles."""
+
+    def __init__(self):
+        self.sampler = Sampler()
+
+    def init_app(self, app):
+        """Add the request hooks and the /admin/profiles routes."""
+
+        app.config.setdefault('PROFILE_DIR', os.path.join(app.root_path, 'profiles'))
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_MODE', 'wall')
+        app.config.setdefault('ADMIN_USER_IDS', ())
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.add_url_rule('/admin/profiles', 'list_profiles', self.list_profiles)
+        app.add_url_rule('/admin/profiles/<name>', 'download_profile', self.download_profile)
+
+    def serializer(self, config=None):
+        config = config or current_app.config
+        return URLSafeTimedSerializer(config['SECRET_KEY'], salt='profile')
+
+    def token(self, mode='wall'):
+        """A header value that gets one request profiled in `mode`."""
+
+        return self.serializer().dumps(mode)
+
+    def store(self):
+        return ProfileStore(current_app.config['PROFILE_DIR'])
+
+    def requested_mode(self, environ, config):
+        """The mode to profile this request in, or None."""
+
+        token = environ.get(PROFILE_ENVIRON)
+        if token is not None:
+            try:
+                mode = self.serializer(config).loads(token, max_age=TOKEN_MAX_AGE)
+            except BadSignature:
+                return None
+            return mode if mode in MODES else None
+
+        rate = config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            return config['PROFILE_MODE']
+
+        return None
+
+    # These run on every request, so they look the request context up once
+    # rather than going through the request/current_app/g proxies.
+
+    def start(self):
+        ctx = _request_ctx_stack.top
+        environ = ctx.request.environ
+
+        mode = self.requested_mode(environ, ctx.app.config)
+        if mode is not None:
+            profile = environ[PROFILE_KEY] = Profile(mode, threading.get_ident())
+            self.sampler.add(profile)
+
+    def finish(self, response):
+        ctx = _request_ctx_stack.top
+        environ = ctx.request.environ
+
+        profile = environ.pop(PROFILE_KEY, None)
+        if profile is None:
+            return response
+
+        self.sampler.remove(profile)
+        if profile.samples:
+            store = ProfileStore(ctx.app.config['PROFILE_DIR'])
+            name = store.save(profile, ctx.request.endpoint)
+            if PROFILE_ENVIRON in environ:
+                response.headers[PROFILE_HEADER + '-Name'] = name
+
+        return response
+
+    def _require_admin(self):
+        if not g.user or g.user.id not in current_app.config['ADMIN_USER_IDS']:
+            abort(404)
+
+    def list_profiles(self):
+        self._require_admin()
+        return render_template('profiles.html', profiles=self.store().list(),
+                               header=PROFILE_HEADER,
+                               tokens={mode: self.token(mode) for mode in MODES})
+
+    def download_profile(self, name):
+        self._require_admin()
+        if not NAME_RE.match(name):
+            abort(404)
+        return send_from_directory(current_app.config['PROFILE_DIR'], name,
+                                   mimetype='text/plain', as_attachment=True)
+
+
+profiler = RequestProfiler()
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        mode = sys.argv[1] if len(sys.argv) > 1 else 'wall'
+        print(f"{PROFILE_HEADER}: {profiler.token(mode)}")
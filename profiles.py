@@ -0,0 +1,213 @@
+"""Profile page read model.
+
+`users_show()` needs the user's header fields, their four stats and their
+latest messages. `load_profile()` gets all of that in one statement (the
+header and counts in a one-row subquery, joined to the first page of
+messages) and caches it per user as plain tuples.
+
+Invalidation is by version: users.profile_version is loaded with the
+bundle, and any write that changes the page moves it on with `bump()`, in
+the write's own transaction, so it costs no commit of its own (new
+messages are bumped by the group-commit writer, with their group). Before
+serving a cached bundle, the current version is
+read back (by primary key, alongside whether the viewer follows the user)
+and a stale bundle is reloaded, so a bump in any process invalidates the
+copies in every other one.
+
+Either way the page costs at most two statements including the session's
+user: a cached bundle needs the version check, and a cold one is loaded
+with the viewer's follow state in the same statement.
+"""
+
+from collections import namedtuple
+from types import SimpleNamespace
+
+from sqlalchemy import text
+
+from cache import LRUCache, entry_size
+from models import db
+from partitions import archived_user_messages
+from shards import shards, MAIN
+
+PROFILE_PAGE_SIZE = 100
+
+# Byte budget and TTL (seconds) of the profile cache.
+PROFILE_CACHE_BYTES = 16 * 1024 * 1024
+PROFILE_CACHE_TTL = 60
+
+ProfileRow = namedtuple(
+    'ProfileRow',
+    'id username image_url header_image_url bio location '
+    'messages_count following_count followers_count likes_count shard '
+    'profile_version')
+
+ProfileMessage = namedtuple('ProfileMessage', 'id text timestamp')
+
+PROFILE_SQL = text("""
+    SELECT p.*, m.id AS message_id, m.text, m.timestamp
+      FROM (SELECT id, username, image_url, header_image_url, bio, location,
+                   (SELECT count(*) FROM messages
+                     WHERE messages.user_id = users.id) AS messages_count,
+                   (SELECT count(*) FROM follows
+                     WHERE follows.user_following_id = users.id) AS following_count,
+                   followers_count,
+                   (SELECT count(*) FROM likes
+                     WHERE likes.user_id = users.id) AS likes_count,
+                   shard, profile_version,
+                   EXISTS (SELECT 1 FROM follows
+                            WHERE follows.user_following_id = :viewer_id
+                              AND follows.user_being_followed_id = users.id)
+                       AS viewer_follows,
+                   EXISTS (SELECT 1 FROM message_archives) AS has_archives
+              FROM users
+             WHERE id = :user_id AND deleted_at IS NULL) p
+      LEFT JOIN (SELECT id, text, timestamp, sort_key
+                   FROM messages
+                  WHERE user_id = :user_id
+                  ORDER BY sort_key DESC
+                  LIMIT :limit) m ON 1 = 1
+     ORDER BY m.sort_key DESC
+""").columns(timestamp=db.DateTime)
+
+# Is a cached bundle current, and does the viewer follow the user?
+CURRENT_SQL = text("""
+    SELECT profile_version,
+           EXISTS (SELECT 1 FROM follows
+                    WHERE follows.user_following_id = :viewer_id
+                      AND follows.user_being_followed_id = users.id)
+               AS viewer_follows
+      FROM users
+     WHERE id = :user_id AND deleted_at IS NULL
+""")
+
+BUMP_SQL = text("UPDATE users SET profile_version = profile_version + 1 "
+                "WHERE id = ANY(:user_ids)")
+
+# The part of a profile on a user's shard, for users not on main.
+SHARD_PROFILE_SQL = text("""
+    SELECT c.*, m.id AS message_id, m.text, m.timestamp
+      FROM (SELECT (SELECT count(*) FROM messages
+                     WHERE user_id = :user_id) AS messages_count) c
+      LEFT JOIN (SELECT id, text, timestamp, sort_key
+                   FROM messages
+                  WHERE user_id = :user_id
+                  ORDER BY sort_key DESC
+                  LIMIT :limit) m ON 1 = 1
+     ORDER BY m.sort_key DESC
+""").columns(timestamp=db.DateTime)
+
+
+class Count:
+    """Stands in for a relationship list where a template only takes |length."""
+
+    def __init__(self, count):
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
+class ProfileCache:
+    """Profile bundles by user_id, each as of its header's profile_version."""
+
+    def __init__(self, max_bytes=PROFILE_CACHE_BYTES, ttl=PROFILE_CACHE_TTL):
+        self.bundles = LRUCache(max_bytes, ttl)
+
+    def bump(self, *user_ids):
+        """Invalidate these users' cached profiles in every process, once the session commits."""
+
+        db.session.execute(BUMP_SQL, {'user_ids': list(user_ids)})
+
+    def get(self, user_id):
+        """The cached bundle, which may be stale: check its profile_version."""
+
+        return self.bundles.get_many([user_id]).get(user_id)
+
+    def set(self, user_id, bundle):
+        size = sum(entry_size(part) for part in bundle[1]) + entry_size(bundle[0])
+        self.bundles.set(user_id, bundle, size)
+
+    def clear(self):
+        self.bundles.clear()
+
+
+profiles = ProfileCache()
+
+
+def fetch_profile(user_id, viewer_id=None, limit=PROFILE_PAGE_SIZE):
+    """Load (ProfileRow, messages) and whether `viewer_id` follows the user.
+
+    Returns (None, False) if there's no such (undeleted) user. Users on
+    other shards (see shards.py) take a second statement, on their shard.
+    """
+
+    rows = db.session.execute(PROFILE_SQL, {'user_id': user_id,
+                                            'viewer_id': viewer_id or 0,
+                                            'limit': limit}).fetchall()
+
+    if not rows:
+        return None, False
+
+    first = rows[0]
+    header = ProfileRow(*first[:len(ProfileRow._fields)])
+    viewer_follows = first.viewer_follows
+
+    if header.shard != MAIN:
+        rows = shards.session(header.shard).execute(SHARD_PROFILE_SQL, {'user_id': user_id,
+                                                                        'limit': limit}).fetchall()
+        header = header._replace(messages_count=rows[0].messages_count)
+
+    messages = [ProfileMessage(row.message_id, row.text, row.timestamp)
+                for row in rows if row.message_id is not None]
+
+    # older months live in the archive
+    if first.has_archives and len(messages) < limit:
+        messages += [ProfileMessage(msg.id, msg.text, msg.timestamp) for msg
+                     in archived_user_messages(user_id, limit - len(messages))]
+
+    return (header, tuple(messages)), bool(viewer_follows)
+
+
+def load_profile(user_id, viewer_id=None):
+    """Get the profile bundle for `user_id` and the viewer's follow state.
+
+    Returns (bundle, viewer_follows); bundle is None if the user doesn't
+    exist or was deleted.
+    """
+
+    bundle = profiles.get(user_id)
+
+    if bundle is not None:
+        current = db.session.execute(CURRENT_SQL, {'user_id': user_id,
+                                                   'viewer_id': viewer_id or 0}).first()
+        if current is None:
+            return None, False
+
+        if current.profile_version == bundle[0].profile_version:
+            return bundle, bool(current.viewer_follows)
+
+    # (the version comes from the same snapshot as the rest of the bundle,
+    # so even a lagging replica's copy is safe to cache)
+    bundle, viewer_follows = fetch_profile(user_id, viewer_id)
+
+    if bundle is not None:
+        profiles.set(user_id, bundle)
+
+    return bundle, viewer_follows
+
+
+def profile_user(header):
+    """Build a template-ready user from a ProfileRow."""
+
+    return SimpleNamespace(
+        id=header.id,
+        username=header.username,
+        image_url=header.image_url,
+        header_image_url=header.header_image_url,
+        bio=header.bio,
+        location=header.location,
+        messages_count=header.messages_count,
+        following_count=header.following_count,
+        followers_count=header.followers_count,
+        likes_count=header.likes_count,
+    )
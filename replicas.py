@@ -0,0 +1,141 @@
+"""Read replicas, with read-your-writes for whoever just wrote.
+
+SQLALCHEMY_REPLICA_URIS lists read-only replicas of SQLALCHEMY_DATABASE_URI
+(REPLICA_DATABASE_URLS in the environment, comma-separated). With any set,
+GET and HEAD requests read from one of them, picked at random per request.
+Everything else, and anything run outside a request (workers, scripts),
+uses the primary.
+
+Replicas lag behind the primary, so:
+
+- a successful POST (posting a message, following, liking, ...) pins its
+  user to the primary for REPLICA_PIN_SECONDS, with a time in their
+  session cookie, so the pages they're sent to next show what they did;
+- a GET that writes sends the write to the primary, and reads from the
+  primary for the rest of the request. Statements are routed by what they
+  are, not by the request: only SELECTs go to a replica, and not those
+  that lock rows or call functions that write (`is_read()`); a flush,
+  an UPDATE, or raw SQL that isn't such a SELECT is a write;
+- what's read from a replica isn't put in the process caches (see
+  `reading_replica()`), where it could be served to a pinned user.
+"""
+
+import random
+import re
+import time
+
+from flask import current_app, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, orm
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.selectable import SelectBase
+
+# Requests that read from a replica, unless their user is pinned.
+READ_METHODS = ('GET', 'HEAD')
+
+# Session key holding the time a user's pin to the primary runs out.
+PIN_KEY = '_primary_until'
+
+# Seconds a user reads from the primary after a write; longer than the
+# replicas are expected to lag.
+PIN_SECONDS = 5
+
+# Raw SQL that may go to a replica starts with SELECT...
+READ_SQL = re.compile(r'\s*(\(\s*)*SELECT\b', re.I)
+
+# ...and doesn't lock rows or call a function that writes.
+WRITING_SQL = re.compile(r'\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b'
+                         r'|\b(nextval|setval|pg_advisory\w*)\s*\(', re.I)
+
+
+def is_read(clause):
+    """Can statement `clause` run on a replica?"""
+
+    # text(...).columns(...) is a SELECT only if its SQL is
+    if isinstance(clause, SelectBase) and isinstance(getattr(clause, 'element', None), TextClause):
+        clause = clause.element
+
+    if isinstance(clause, TextClause):
+        return READ_SQL.match(clause.text) is not None and WRITING_SQL.search(clause.text) is None
+
+    return isinstance(clause, SelectBase) and getattr(clause, '_for_update_arg', None) is None
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from `replica`, when it's set, until it writes."""
+
+    replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replica is not None:
+            if not self._flushing and is_read(clause):
+                return self.replica
+
+            # from the first write on, everything goes to the primary
+            self.replica = None
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def reading_replica(scoped):
+    """Is the current session of `scoped` (db.session) reading from a replica?"""
+
+    return getattr(scoped(), 'replica', None) is not None
+
+
+class Replicas:
+    """Routes each request's reads to a replica or the primary."""
+
+    def init_app(self, app):
+        """Set the replica defaults and add the request hooks."""
+
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', ())
+        app.config.setdefault('REPLICA_PIN_SECONDS', PIN_SECONDS)
+        app.extensions['replicas'] = {}
+
+        app.before_request(self.route_reads)
+        app.after_request(self.pin_writer)
+
+    def engine(self, app, uri):
+        """The engine for replica `uri`, made on first use like the primary's."""
+
+        engines = app.extensions['replicas']
+        engine = engines.get(uri)
+
+        if engine is None:
+            engine = engines[uri] = create_engine(uri, **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+        return engine
+
+    def pinned(self):
+        return session.get(PIN_KEY, 0) > time.time()
+
+    def route_reads(self):
+        """Point this request's session at a replica, if it should read from one."""
+
+        uris = current_app.config['SQLALCHEMY_REPLICA_URIS']
+        if not uris or request.method not in READ_METHODS or self.pinned():
+            return
+
+        db = current_app.extensions['sqlalchemy'].db
+        db.session().replica = self.engine(current_app, random.choice(uris))
+
+    def pin_writer(self, response):
+        """After a successful write request, keep its user on the primary for a while."""
+
+        config = current_app.config
+        if (config['SQLALCHEMY_REPLICA_URIS'] and request.method not in READ_METHODS
+                and response.status_code < 400):
+            session[PIN_KEY] = int(time.time() + config['REPLICA_PIN_SECONDS']) + 1
+
+        return response
+
+
+replicas = Replicas()
@@ -1,8 +1,10 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from app import create_app
+from models import db, User, Message, Follows
+
+create_app()
 
 
 db.drop_all()
@@ -17,4 +19,6 @@ with open('generator/messages.csv') as messages:
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+User.refresh_followers_count()
+
 db.session.commit()
@@ -0,0 +1,192 @@
+"""Time-sortable, process-unique message keys (snowflake-style).
+
+A key is a 63-bit integer:
+
+    milliseconds since KEY_EPOCH (41 bits) | worker id (10) | sequence (12)
+
+so sorting by key sorts by time, and a single index on the key serves both
+ordering and keyset pagination without ties. `Message.sort_key` gets its
+key from the message's timestamp when the row is inserted.
+
+Each process needs its own worker id. On Postgres it claims the first free
+one by taking a session advisory lock on a connection it keeps open, so
+ids are released when the process exits; set SEQUENCER_WORKER_ID to pin
+one instead. Other databases (SQLite, i.e. one process) use worker 0.
+
+Existing rows are backfilled with `python sequencer.py`, which keys them
+in (timestamp, id) order from a sequencer with a worker id of its own, so
+backfilled keys can't collide with each other or with live ones.
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+# Keys cover 69 years from here, and can't represent anything earlier.
+KEY_EPOCH = datetime(2010, 1, 1)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Shift of the millisecond part.
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+# First argument of the advisory locks that reserve worker ids.
+WORKER_LOCK = 0x57a4b1e5
+
+# Rows updated per transaction by backfill().
+BACKFILL_CHUNK = 5000
+
+
+def millis(when):
+    """Milliseconds from KEY_EPOCH to `when`."""
+
+    return (when - KEY_EPOCH) // timedelta(milliseconds=1)
+
+
+def key_at(when):
+    """The smallest key for `when`; for range queries over key order."""
+
+    return millis(when) << TIME_SHIFT
+
+
+def key_time(key):
+    """The time (to the millisecond) a key was made for."""
+
+    return KEY_EPOCH + timedelta(milliseconds=key >> TIME_SHIFT)
+
+
+class Sequencer:
+    """Hands out keys for one process."""
+
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        self.last_ms = -1
+        self.sequence = 0
+        self.backdated = 0
+        self.lock_connection = None
+
+    def claim_worker_id(self, engine):
+        """Reserve a worker id for this process (see the module docstring)."""
+
+        if os.environ.get('SEQUENCER_WORKER_ID'):
+            return int(os.environ['SEQUENCER_WORKER_ID'])
+
+        if engine.dialect.name != 'postgresql':
+            return 0
+
+        connection = engine.connect()
+
+        for worker_id in range(MAX_WORKER_ID + 1):
+            claimed = connection.execute(
+                text("SELECT pg_try_advisory_lock(:lock, :worker_id)"),
+                lock=WORKER_LOCK, worker_id=worker_id).scalar()
+
+            if claimed:
+                # held (not returned to the pool) for the life of the process
+                self.lock_connection = connection
+                return worker_id
+
+        connection.close()
+        raise RuntimeError("All sequencer worker ids are taken")
+
+    def key_for(self, when, engine):
+        """Get a new key for a message timestamped `when`.
+
+        `engine` is only used the first time, to claim a worker id.
+
+        Keys for the latest millisecond seen so far are handed out in
+        order; after MAX_SEQUENCE of them in one millisecond, keys borrow
+        the next one. Older timestamps (backdated messages, or the clock
+        stepping back) still get unique keys, just not ordered among
+        themselves within a millisecond.
+        """
+
+        ms = millis(when)
+
+        with self.lock:
+            if self.worker_id is None:
+                self.worker_id = self.claim_worker_id(engine)
+
+            if ms > self.last_ms:
+                self.last_ms = ms
+                self.sequence = 0
+            elif ms == self.last_ms:
+                self.sequence += 1
+                if self.sequence > MAX_SEQUENCE:
+                    self.last_ms += 1
+                    self.sequence = 0
+                ms = self.last_ms
+            else:
+                self.backdated = (self.backdated + 1) & MAX_SEQUENCE
+                return self.compose(ms, self.backdated)
+
+            return self.compose(ms, self.sequence)
+
+    def compose(self, ms, sequence):
+        return (ms << TIME_SHIFT) | (self.worker_id << SEQUENCE_BITS) | sequence
+
+
+sequencer = Sequencer()
+
+
+def message_sort_key(context):
+    """Column default for Message.sort_key, from the row's timestamp."""
+
+    timestamp = context.get_current_parameters()['timestamp']
+
+    # bulk loads (seed.py) pass timestamps through as text
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+
+    return sequencer.key_for(timestamp, context.engine)
+
+
+def backfill(chunk_size=BACKFILL_CHUNK):
+    """Give every message without a sort_key one; returns how many.
+
+    Rows are keyed oldest first, so each key is newer than the last and
+    none are backdated. The keys come from a Sequencer of their own, which
+    claims a worker id no live process holds.
+    """
+
+    from models import db, Message
+
+    keys = Sequencer()
+    done = 0
+
+    while True:
+        rows = (db.session
+                .query(Message.id, Message.timestamp)
+                .filter(Message.sort_key.is_(None))
+                .order_by(Message.timestamp, Message.id)
+                .limit(chunk_size)
+                .all())
+
+        if not rows:
+            break
+
+        db.session.bulk_update_mappings(Message, [
+            {'id': message_id, 'sort_key': keys.key_for(timestamp, db.engine)}
+            for message_id, timestamp in rows])
+        db.session.commit()
+
+        done += len(rows)
+
+    if keys.lock_connection is not None:
+        keys.lock_connection.close()
+
+    return done
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        print(f"backfilled {backfill()} messages")
@@ -0,0 +1,361 @@
+"""Server-side sessions: the cookie holds only a random session id.
+
+Flask's default sessions are signed cookies: everything in the session
+(the logged-in user, flashed messages, the CSRF token) travels with every
+request, and its signature is checked each time. With SESSION_STORE set,
+the session data is kept on the server instead, in one of:
+
+- 'memory': an LRU in this process, of at most SESSION_MEMORY_SIZE
+  sessions. Only for a single process; sessions go with it.
+- 'sqlite': a SQLite file at SESSION_SQLITE_PATH, shared by every process
+  on the machine.
+- 'redis': any Redis-compatible server at SESSION_REDIS_URL, shared by
+  every machine (needs the redis package).
+
+The cookie is then just an unguessable id, and the data is stored in
+marshal's compact binary format (so session values must be plain dicts,
+lists, tuples, strings and numbers, as Flask's are).
+
+A server-side session can be dropped, which a cookie can't:
+
+- `sessions.rotate()` gives the current session a new id on its next save
+  (do_login does this, so an id planted before login is useless after);
+- `sessions.revoke_user(user_id)` logs a user out everywhere but here
+  (change_password does this).
+
+Sessions last PERMANENT_SESSION_LIFETIME from when they last changed.
+Without SESSION_STORE, sessions stay signed cookies and revoke_user() does
+nothing.
+"""
+
+import marshal
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, session
+from flask.sessions import SecureCookieSession, SessionInterface
+
+# Random bytes in a session id.
+ID_BYTES = 16
+
+# Most sessions the memory store keeps, dropping the least recently used.
+MEMORY_SESSIONS = 100_000
+
+# The SQLite store deletes expired sessions every this many saves.
+PURGE_EVERY = 1000
+
+
+def encode(data):
+    """Session data as compact bytes."""
+
+    return marshal.dumps(dict(data))
+
+
+def decode(blob):
+    """Session data back from encode(); {} if it's unreadable (say, from another Python)."""
+
+    try:
+        data = marshal.loads(blob)
+    except (EOFError, ValueError, TypeError):
+        return {}
+
+    return data if isinstance(data, dict) else {}
+
+
+##############################################################################
+# Stores: each keeps encoded sessions by id, and which ids belong to which
+# user, for revoking them together.
+
+
+class MemoryStore:
+    """Sessions in a thread-safe LRU in this process."""
+
+    def __init__(self, max_sessions=MEMORY_SESSIONS, clock=time.time):
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, sid):
+        with self.lock:
+            entry = self.entries.get(sid)
+
+            if entry is None:
+                return None
+
+            blob, user_id, expires = entry
+
+            if expires <= self.clock():
+                self._delete(sid)
+                return None
+
+            self.entries.move_to_end(sid)
+            return blob
+
+    def save(self, sid, blob, user_id, ttl):
+        with self.lock:
+            self._delete(sid)
+            self.entries[sid] = (blob, user_id, self.clock() + ttl)
+
+            if user_id is not None:
+                self.users.setdefault(user_id, set()).add(sid)
+
+            while len(self.entries) > self.max_sessions:
+                self._delete(next(iter(self.entries)))
+
+    def delete(self, sid, user_id=None):
+        with self.lock:
+            self._delete(sid)
+
+    def delete_user(self, user_id, keep=None):
+        with self.lock:
+            sids = self.users.get(user_id, set()) - {keep}
+            for sid in sids:
+                self._delete(sid)
+            return len(sids)
+
+    def _delete(self, sid):
+        entry = self.entries.pop(sid, None)
+
+        if entry is not None and entry[1] is not None:
+            sids = self.users[entry[1]]
+            sids.discard(sid)
+            if not sids:
+                del self.users[entry[1]]
+
+
+class SQLiteStore:
+    """Sessions in a SQLite file, one connection per thread."""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            user_id INTEGER,
+            expires REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_sessions_user_id ON sessions (user_id);
+    '''
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.local = threading.local()
+        self.saves = 0
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.SCHEMA)
+
+        return conn
+
+    def load(self, sid):
+        row = self.conn.execute('SELECT data FROM sessions WHERE id = ? AND expires > ?',
+                                (sid, self.clock())).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, blob, user_id, ttl):
+        self.conn.execute('INSERT OR REPLACE INTO sessions (id, data, user_id, expires) '
+                          'VALUES (?, ?, ?, ?)', (sid, blob, user_id, self.clock() + ttl))
+
+        self.saves += 1
+        if self.saves % PURGE_EVERY == 0:
+            self.conn.execute('DELETE FROM sessions WHERE expires <= ?', (self.clock(),))
+
+    def delete(self, sid, user_id=None):
+        self.conn.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+
+    def delete_user(self, user_id, keep=None):
+        return self.conn.execute('DELETE FROM sessions WHERE user_id = ? AND id IS NOT ?',
+                                 (user_id, keep)).rowcount
+
+
+class RedisStore:
+    """Sessions in a Redis-compatible server, expiring on their own.
+
+    Each session is a key, and each user has a set of their session ids.
+    """
+
+    def __init__(self, url, prefix='warbler:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, sid):
+        return f'{self.prefix}session:{sid}'
+
+    def _user_key(self, user_id):
+        return f'{self.prefix}user-sessions:{user_id}'
+
+    def load(self, sid):
+        return self.client.get(self._key(sid))
+
+    def save(self, sid, blob, user_id, ttl):
+        ttl = int(ttl)
+
+        with self.client.pipeline() as pipe:
+            pipe.set(self._key(sid), blob, ex=ttl)
+            if user_id is not None:
+                pipe.sadd(self._user_key(user_id), sid)
+                pipe.expire(self._user_key(user_id), ttl)
+            pipe.execute()
+
+    def delete(self, sid, user_id=None):
+        with self.client.pipeline() as pipe:
+            pipe.delete(self._key(sid))
+            if user_id is not None:
+                pipe.srem(self._user_key(user_id), sid)
+            pipe.execute()
+
+    def delete_user(self, user_id, keep=None):
+        user_key = self._user_key(user_id)
+        sids = {sid.decode() for sid in self.client.smembers(user_key)} - {keep}
+
+        if sids:
+            with self.client.pipeline() as pipe:
+                pipe.delete(*(self._key(sid) for sid in sids))
+                pipe.srem(user_key, *sids)
+                pipe.execute()
+
+        return len(sids)
+
+
+##############################################################################
+# Flask
+
+
+class ServerSession(SecureCookieSession):
+    """A session kept in a store under `sid`, which is None until it's first saved."""
+
+    def __init__(self, initial=None, sid=None, user_id=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.stored_user_id = user_id
+        self.rotate = False
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps sessions in `store`, with only their ids in the cookie.
+
+    `user_key` is the session key holding the logged-in user's id. When it
+    changes, the session gets a new id too.
+    """
+
+    def __init__(self, store, user_key):
+        self.store = store
+        self.user_key = user_key
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+
+        if sid:
+            blob = self.store.load(sid)
+            if blob is not None:
+                data = decode(blob)
+                return ServerSession(data, sid, data.get(self.user_key))
+
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = app.session_cookie_name
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session.modified:
+            return
+
+        user_id = session.get(self.user_key)
+        old_sid = session.sid
+
+        if old_sid and (session.rotate or user_id != session.stored_user_id):
+            self.store.delete(old_sid, session.stored_user_id)
+            session.sid = None
+
+        if not session:
+            if old_sid:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        session.sid = session.sid or secrets.token_urlsafe(ID_BYTES)
+        session.stored_user_id = user_id
+        session.rotate = False
+
+        ttl = app.permanent_session_lifetime.total_seconds()
+        self.store.save(session.sid, encode(session), user_id, ttl)
+
+        response.set_cookie(name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+class Sessions:
+    """Installs the configured session store, and revokes sessions in it."""
+
+    def init_app(self, app):
+        """Set the session defaults, and keep sessions in SESSION_STORE if it's set."""
+
+        app.config.setdefault('SESSION_STORE', None)
+        app.config.setdefault('SESSION_USER_KEY', 'curr_user')
+        app.config.setdefault('SESSION_MEMORY_SIZE', MEMORY_SESSIONS)
+
+        store = self.make_store(app.config)
+        if store is not None:
+            app.session_interface = ServerSessionInterface(store, app.config['SESSION_USER_KEY'])
+
+    def make_store(self, config):
+        kind = config['SESSION_STORE']
+
+        if not kind:
+            return None
+        if kind == 'memory':
+            return MemoryStore(config['SESSION_MEMORY_SIZE'])
+        if kind == 'sqlite':
+            return SQLiteStore(config['SESSION_SQLITE_PATH'])
+        if kind == 'redis':
+            return RedisStore(config['SESSION_REDIS_URL'])
+
+        raise ValueError(f"Unknown SESSION_STORE: {kind!r}")
+
+    def rotate(self):
+        """Give the current session a new id when it's saved."""
+
+        if isinstance(session._get_current_object(), ServerSession):
+            session.rotate = True
+            session.modified = True
+
+    def revoke_user(self, user_id):
+        """Drop every session of `user_id` except the current one, which gets a new id.
+
+        Returns how many were dropped.
+        """
+
+        current = session._get_current_object()
+
+        if not isinstance(current, ServerSession):
+            return 0
+
+        self.rotate()
+        return current_app.session_interface.store.delete_user(user_id, keep=current.sid)
+
+
+sessions = Sessions()
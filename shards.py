@@ -0,0 +1,435 @@
+"""Sharding of messages by user id.
+
+SHARDS names the shard databases besides the primary, which is always
+shard 'main' (SHARD_DATABASE_URLS in the environment: name=url,...). A
+user's messages live on the shard named by their `users.shard`; everything
+else (users, follows, likes, notifications, ...) stays on the primary, so
+follower and following lists work the same for every user. Users start on
+main, so nothing moves until an operator moves them:
+
+    python shards.py init                 # tables and id ranges on every shard
+    python shards.py move USER_ID SHARD   # rebalance one user
+    python shards.py status               # users per shard
+
+Reads of one user's messages (their profile page) go to that user's shard.
+Reads over many users, like the home timeline and the API's, are grouped
+by shard, run on every shard at once (`scatter()`) and merged newest first
+by sort key (`merge_newest()`).
+
+Message ids stay unique across shards because `init` gives each shard its
+own residue modulo ID_STRIDE; moved rows keep their ids. Sort keys are
+already unique (see sequencer.py).
+
+Single messages are looked up by id on main first and then on every
+other shard at once (`find_messages()`), since an id doesn't say where a
+message is: moved rows keep theirs. The message cache does this for its
+misses, so message pages and likes find messages wherever they are.
+
+Mentions of messages on other shards and archival still assume the
+primary; async mode hands pages that need another shard to Flask.
+"""
+
+import heapq
+import math
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from operator import itemgetter
+
+from flask import current_app
+from sqlalchemy import ForeignKeyConstraint, MetaData, create_engine, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm.attributes import set_committed_value
+
+from cache import cache
+from models import db, User, Message, Follows
+from partitions import recent_first
+from sequencer import sequencer, key_time
+
+MAIN = 'main'
+
+# Message ids on a shard are all congruent to its index modulo this, so
+# it's also the most shards there can be.
+ID_STRIDE = 64
+
+# Most shards queried at once by scatter(), per process.
+SCATTER_THREADS = 8
+
+# First argument of the advisory locks between moves and writers of a
+# user's messages.
+MOVE_LOCK = 0x5ba4d3e7
+
+# Rows copied per INSERT when moving a user.
+MOVE_BATCH = 5000
+
+# Sharded tables, and the column holding the user id they're sharded by.
+SHARDED = ((Message.__table__, 'user_id'),)
+
+# The sharded tables as created on the shards: no foreign keys, since the
+# users they point at are on the primary.
+SHARD_METADATA = MetaData()
+
+for _table, _ in SHARDED:
+    _copy = _table.tometadata(SHARD_METADATA)
+    for _constraint in [c for c in _copy.constraints if isinstance(c, ForeignKeyConstraint)]:
+        _copy.constraints.remove(_constraint)
+    for _column in _copy.columns:
+        _column.foreign_keys.clear()
+    _copy.foreign_keys.clear()
+
+_executor = ThreadPoolExecutor(SCATTER_THREADS, thread_name_prefix='shards')
+
+
+def merge_newest(row_lists, limit, key=itemgetter(0)):
+    """Merge lists of rows, each newest first by `key`, into the newest `limit`."""
+
+    return list(islice(heapq.merge(*row_lists, key=key, reverse=True), limit))
+
+
+def message_rows(session, message_ids):
+    """Load (id, text, timestamp, user_id) rows for whichever of `message_ids` are in `session`'s database."""
+
+    return (session
+            .query(Message.id, Message.text, Message.timestamp, Message.user_id)
+            .filter(Message.id.in_(message_ids))
+            .all())
+
+
+def by_shard(pairs):
+    """Group (id, shard) pairs into {shard: [ids]}."""
+
+    grouped = {}
+    for item_id, shard in pairs:
+        grouped.setdefault(shard, []).append(item_id)
+    return grouped
+
+
+class Shards:
+    """Engines, sessions and routing for the shard databases."""
+
+    def init_app(self, app):
+        """Set the SHARDS default and remove shard sessions after each request."""
+
+        app.config.setdefault('SHARDS', {})
+        app.extensions['shards'] = {'engines': {}, 'sessions': {}}
+        app.teardown_appcontext(self.remove_sessions)
+
+    def names(self):
+        """Every shard, main first; a shard's index is its place here."""
+
+        return [MAIN] + sorted(current_app.config['SHARDS'])
+
+    def engine(self, name):
+        if name == MAIN:
+            return db.engine
+
+        engines = current_app.extensions['shards']['engines']
+        engine = engines.get(name)
+
+        if engine is None:
+            url = current_app.config['SHARDS'][name]
+            engine = engines[name] = create_engine(url, **current_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+        return engine
+
+    def session(self, name):
+        """The session for shard `name`; db.session for main."""
+
+        if name == MAIN:
+            return db.session
+
+        sessions = current_app.extensions['shards']['sessions']
+        scoped = sessions.get(name)
+
+        if scoped is None:
+            scoped = sessions[name] = db.create_scoped_session({'bind': self.engine(name), 'binds': {}})
+
+        return scoped
+
+    def remove_sessions(self, exc=None):
+        for scoped in current_app.extensions['shards']['sessions'].values():
+            scoped.remove()
+
+    def scatter(self, run, args_by_shard):
+        """Call `run(session, args)` for each shard's args at once; returns {shard: result}.
+
+        Main runs on this thread, in the request's session; the others run
+        on a pool, each in its own session.
+        """
+
+        app = current_app._get_current_object()
+
+        def on_shard(name, args):
+            with app.app_context():
+                try:
+                    return run(self.session(name), args)
+                finally:
+                    self.session(name).remove()
+
+        futures = {name: _executor.submit(on_shard, name, args)
+                   for name, args in args_by_shard.items() if name != MAIN}
+
+        results = {}
+        if MAIN in args_by_shard:
+            results[MAIN] = run(db.session, args_by_shard[MAIN])
+
+        for name, future in futures.items():
+            results[name] = future.result()
+
+        return results
+
+    ##########################################################################
+    # Follows (on main)
+
+    def following(self, user):
+        """Get [(id, shard)] of the undeleted users `user` follows."""
+
+        return (db.session
+                .query(User.id, User.shard)
+                .join(Follows, Follows.user_being_followed_id == User.id)
+                .filter(Follows.user_following_id == user.id, User.deleted_at.is_(None))
+                .all())
+
+    ##########################################################################
+    # Messages
+
+    def hold_user(self, user):
+        """Keep `user` from being moved until the session's transaction ends.
+
+        Take it before writing `user`'s messages. A move in progress is
+        waited for; `user.shard` is then read again, so write to it.
+        """
+
+        db.session.execute(text("SELECT pg_advisory_xact_lock_shared(:lock, :user_id)"),
+                           {'lock': MOVE_LOCK, 'user_id': user.id})
+        shard = db.session.query(User.shard).filter_by(id=user.id).scalar()
+        set_committed_value(user, 'shard', shard)
+        return shard
+
+    def post_message(self, user, text):
+        """Add and commit a message by `user`, who isn't on main; returns it."""
+
+        session = self.session(user.shard)
+        now = datetime.utcnow()
+
+        # the sequencer claims its worker id on the primary, as every process does
+        row = {'text': text, 'user_id': user.id, 'timestamp': now,
+               'sort_key': sequencer.key_for(now, db.engine)}
+
+        table = Message.__table__
+        row['id'] = session.execute(table.insert().values(row).returning(table.c.id)).scalar()
+        session.commit()
+
+        msg = Message(**row)
+        set_committed_value(msg, 'user', user)
+        return msg
+
+    def delete_message(self, user, message_id):
+        """Delete `user`'s message `message_id` from their shard; returns whether it was there."""
+
+        session = self.session(user.shard)
+        deleted = (session.query(Message)
+                          .filter_by(id=message_id, user_id=user.id)
+                          .delete(synchronize_session=False))
+        session.commit()
+        return deleted == 1
+
+    def find_messages(self, message_ids):
+        """Get rows for whichever of `message_ids` are on a shard other than main.
+
+        Every shard is asked at once; main is left to the caller, who has
+        usually just looked there.
+        """
+
+        names = self.names()[1:]
+
+        if not names or not message_ids:
+            return []
+
+        found = self.scatter(message_rows, {name: list(message_ids) for name in names})
+        return [row for rows in found.values() for row in rows]
+
+    def get_found(self, found, message_ids):
+        """Get CachedMessages for `message_ids`, found as {shard: [(sort_key, id)]}.
+
+        What isn't cached is loaded from the shards it was found on.
+        """
+
+        shard_of = {message_id: name for name, rows in found.items() for _, message_id in rows}
+
+        def load_misses(message_ids):
+            loaded = self.scatter(message_rows, by_shard((message_id, shard_of[message_id])
+                                                 for message_id in message_ids))
+            return [row for rows in loaded.values() for row in rows]
+
+        return cache.get_messages(message_ids, load=load_misses)
+
+    def timeline_page(self, users, limit, before=None):
+        """Get the newest `limit` messages by any of `users`, [(id, shard)], older than sort key `before`.
+
+        Returns (CachedMessages, next_before): pass next_before back as
+        `before` for the next page; it's None on the last page.
+        """
+
+        def newest(session, user_ids):
+            query = (session.query(Message.sort_key, Message.id)
+                            .filter(Message.user_id.in_(user_ids))
+                            .order_by(Message.sort_key.desc()))
+
+            if before is None:
+                return recent_first(query, limit + 1)
+
+            return recent_first(query.filter(Message.sort_key < before), limit + 1,
+                                key_time(before))
+
+        found = self.scatter(newest, by_shard(users))
+        keys = merge_newest(found.values(), limit + 1)
+        next_before = keys[limit - 1][0] if len(keys) > limit else None
+
+        return self.get_found(found, [message_id for _, message_id in keys[:limit]]), next_before
+
+    def newer(self, users, after, limit):
+        """Get the oldest `limit` messages by any of `users`, [(id, shard)], newer than sort key `after`.
+
+        Returns [(sort_key, CachedMessage)], oldest first.
+        """
+
+        def oldest(session, user_ids):
+            return (session.query(Message.sort_key, Message.id)
+                           .filter(Message.user_id.in_(user_ids), Message.sort_key > after)
+                           .order_by(Message.sort_key)
+                           .limit(limit)
+                           .all())
+
+        found = self.scatter(oldest, by_shard(users))
+        keys = {message_id: sort_key
+                for sort_key, message_id in islice(heapq.merge(*found.values()), limit)}
+        messages = self.get_found(found, sorted(keys, key=keys.get))
+
+        return [(keys[msg.id], msg) for msg in messages]
+
+    def timeline(self, users, limit):
+        """Get the newest `limit` messages by any of `users`, [(id, shard)], as CachedMessages."""
+
+        return self.timeline_page(users, limit)[0]
+
+    ##########################################################################
+    # Administration
+
+    def init(self):
+        """Create the sharded tables on every shard, and give each its message ids.
+
+        Run it again after adding a shard. Every shard's next ids start past
+        the largest id on any of them, so it's safe to rerun.
+        """
+
+        names = self.names()
+        if len(names) > ID_STRIDE:
+            raise ValueError(f"At most {ID_STRIDE} shards are supported")
+
+        for name in names[1:]:
+            SHARD_METADATA.create_all(self.engine(name))
+            self._unshard_follows(name)
+
+        largest = max(self.engine(name).execute(db.select([db.func.max(Message.id)])).scalar() or 0
+                      for name in names)
+        base = math.ceil((largest + 1) / ID_STRIDE) * ID_STRIDE
+
+        for index, name in enumerate(names):
+            start = base + index
+            with self.engine(name).begin() as connection:
+                connection.execute(f"ALTER SEQUENCE messages_id_seq INCREMENT BY {ID_STRIDE} "
+                                   f"START WITH {start} RESTART WITH {start}")
+
+    def _unshard_follows(self, name):
+        """Move follows left on shard `name` by earlier versions back to main."""
+
+        engine = self.engine(name)
+        if not engine.has_table('follows'):
+            return
+
+        table = Follows.__table__
+
+        with engine.begin() as connection:
+            rows = [dict(row) for row in connection.execute(table.select())]
+            for i in range(0, len(rows), MOVE_BATCH):
+                insert = postgresql.insert(table).values(rows[i:i + MOVE_BATCH]).on_conflict_do_nothing()
+                db.session.execute(insert)
+            db.session.commit()
+
+            connection.execute('DROP TABLE follows')
+
+    def move_user(self, user_id, target):
+        """Move `user_id`'s messages to shard `target`; returns the rows moved.
+
+        Writers of the user's messages are held off (`hold_user()`) for the
+        whole move. Their rows are copied and deleted in one transaction on
+        each shard; the target commits first, then the switch on the
+        primary, then the source, so a failure part way leaves duplicates
+        behind at worst, never missing rows.
+        """
+
+        if target not in self.names():
+            raise ValueError(f"No such shard: {target}")
+
+        from profiles import BUMP_SQL
+
+        users = User.__table__
+        moved = 0
+
+        with db.engine.connect() as main:
+            switch = main.begin()
+            main.execute(text("SELECT pg_advisory_xact_lock(:lock, :user_id)"),
+                         {'lock': MOVE_LOCK, 'user_id': user_id})
+            source = main.execute(db.select([users.c.shard]).where(users.c.id == user_id)).scalar()
+            if source == target:
+                return 0
+
+            with self.engine(source).connect() as reading, self.engine(target).connect() as writing:
+                deleting, copying = reading.begin(), writing.begin()
+
+                for table, column in SHARDED:
+                    rows = reading.execute(table.select().where(table.c[column] == user_id))
+                    while True:
+                        batch = [dict(row) for row in rows.fetchmany(MOVE_BATCH)]
+                        if not batch:
+                            break
+                        insert = postgresql.insert(table).values(batch).on_conflict_do_nothing()
+                        moved += writing.execute(insert).rowcount
+
+                    reading.execute(table.delete().where(table.c[column] == user_id))
+
+                copying.commit()
+                main.execute(users.update().where(users.c.id == user_id).values(shard=target))
+                main.execute(BUMP_SQL, {'user_ids': [user_id]})
+                switch.commit()
+                deleting.commit()
+
+        return moved
+
+    def status(self):
+        """Get {shard: number of users} over every shard."""
+
+        counts = dict(db.session.query(User.shard, db.func.count()).group_by(User.shard))
+        return {name: counts.get(name, 0) for name in self.names()}
+
+
+shards = Shards()
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+
+        if command == 'init':
+            shards.init()
+            print(f"Initialized {', '.join(shards.names())}")
+        elif command == 'move':
+            user_id, target = int(sys.argv[2]), sys.argv[3]
+            print(f"Moved {shards.move_user(user_id, target)} rows of user {user_id} to {target}")
+        else:
+            for name, count in shards.status().items():
+                print(f"{name}: {count} users")
@@ -0,0 +1,173 @@
+"""In-process pub/sub for live timeline updates over Server-Sent Events.
+
+`messages_add()` publishes each new message to `broker` after it commits.
+Every open /stream/timeline connection is a Subscriber, indexed by the
+authors it follows, so publishing only touches the subscribers that care.
+
+Each subscriber has a bounded buffer. A subscriber that falls that far
+behind is evicted rather than letting its buffer grow: its stream ends, and
+the browser's EventSource reconnects with Last-Event-ID and resumes from
+the broker's replay ring (or from the DB, if it was gone long enough to
+fall off the ring).
+
+Events are identified by the message's sort key rather than its id: ids
+aren't consecutive once messages are sharded (see shards.py), and sort
+keys can be compared across every shard.
+
+Streams hold a connection open for as long as the page is, so serve them
+from an async worker (e.g. `gunicorn -k gevent`), where an idle stream is a
+parked greenlet rather than a thread. The broker is per process: run the
+stream endpoint in a single worker process, or every process must receive
+every publish.
+"""
+
+import json
+import threading
+from collections import defaultdict, deque
+from datetime import datetime
+
+from images import images
+from sequencer import key_at
+
+# Most events buffered for one subscriber before it's evicted.
+SUBSCRIBER_BUFFER = 256
+
+# How many recent events are kept for Last-Event-ID resume.
+REPLAY_SIZE = 1024
+
+# Most events sent when resuming from the DB.
+RESUME_LIMIT = 100
+
+# Seconds between keepalive comments on an idle stream.
+KEEPALIVE = 15
+
+
+def message_event(msg, sort_key):
+    """Build the (event_id, author_id, data) event for a committed message with `sort_key`."""
+
+    data = json.dumps({
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'user': {
+            'id': msg.user.id,
+            'username': msg.user.username,
+            'image_url': msg.user.image_url,
+            'thumb_url': images.url(msg.user.image_url, 'thumb'),
+        },
+    }, separators=(',', ':'))
+
+    return sort_key, msg.user_id, data
+
+
+def format_event(event_id, data):
+    """Format one SSE frame."""
+
+    return f"id: {event_id}\ndata: {data}\n\n"
+
+
+class Subscriber:
+    """One open stream: a bounded buffer of pending events."""
+
+    def __init__(self, authors, maxsize=SUBSCRIBER_BUFFER):
+        self.authors = frozenset(authors)
+        self.maxsize = maxsize
+        self.pending = deque()
+        self.ready = threading.Event()
+        self.evicted = False
+
+    def push(self, event):
+        """Buffer `event`; returns False if the buffer is full."""
+
+        if len(self.pending) >= self.maxsize:
+            return False
+
+        self.pending.append(event)
+        self.ready.set()
+        return True
+
+    def get(self, timeout=None):
+        """Wait up to `timeout` seconds for events and return all pending."""
+
+        if not self.pending:
+            self.ready.wait(timeout)
+
+        self.ready.clear()
+        events = []
+
+        while self.pending:
+            events.append(self.pending.popleft())
+
+        return events
+
+
+class Broker:
+    """Fans published events out to the subscribers following their author."""
+
+    def __init__(self, buffer=SUBSCRIBER_BUFFER, replay=REPLAY_SIZE, since=None):
+        self.buffer = buffer
+        self.lock = threading.Lock()
+        self.by_author = defaultdict(set)
+        self.recent = deque(maxlen=replay)
+        self.evictions = 0
+
+        # events after this key are all still in `recent`
+        self.floor = key_at(datetime.utcnow()) if since is None else since
+
+    def subscribe(self, authors):
+        """Open a subscription for messages by any of `authors`."""
+
+        subscriber = Subscriber(authors, self.buffer)
+
+        with self.lock:
+            for author_id in subscriber.authors:
+                self.by_author[author_id].add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self._remove(subscriber)
+
+    def _remove(self, subscriber):
+        for author_id in subscriber.authors:
+            subscribers = self.by_author.get(author_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.by_author[author_id]
+
+    def publish(self, event_id, author_id, data):
+        """Send an event to everyone following `author_id`."""
+
+        event = (event_id, author_id, data)
+
+        with self.lock:
+            if len(self.recent) == self.recent.maxlen:
+                self.floor = max(self.floor, self.recent[0][0])
+            self.recent.append(event)
+
+            for subscriber in list(self.by_author.get(author_id, ())):
+                if not subscriber.push(event):
+                    subscriber.evicted = True
+                    subscriber.ready.set()
+                    self._remove(subscriber)
+                    self.evictions += 1
+
+    def replay(self, authors, last_id):
+        """Get buffered events after `last_id` for `authors`.
+
+        Returns None if events after `last_id` may have fallen off the ring,
+        or were published before the broker started, meaning the caller has
+        to resume from the DB instead.
+        """
+
+        with self.lock:
+            if last_id < self.floor:
+                return None
+
+            return [event for event in self.recent
+                    if event[0] > last_id and event[1] in authors]
+
+
+broker = Broker()
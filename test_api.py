@@ -0,0 +1,116 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import gzip
+import json
+from datetime import datetime, timedelta
+
+from fixtures import DatabaseTestCase, make_user, make_message, make_follow
+from models import db, Message
+
+from app import app, CURR_USER_KEY
+from pagination import encode_cursor
+
+
+class ApiTestCase(DatabaseTestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        self.client = app.test_client()
+
+        viewer = make_user('viewer', bio='hi')
+        author = make_user('author')
+        stranger = make_user('stranger')
+
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+
+        make_follow(viewer, author)
+
+        start = datetime(2020, 1, 1)
+        for i in range(5):
+            make_message(author, f'author {i}', timestamp=start + timedelta(minutes=i))
+        make_message(stranger, 'stranger', timestamp=start)
+        db.session.commit()
+
+    def _login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def test_health(self):
+        res = self.client.get('/api/v1/health')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), {'status': 'ok'})
+
+    def test_timeline_pages(self):
+        '''Does the timeline page through followed users' messages, newest first?'''
+        with self.client as c:
+            self._login(c)
+
+            res = c.get('/api/v1/timeline?limit=3')
+            data = res.get_json()
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([m['text'] for m in data['messages']], ['author 4', 'author 3', 'author 2'])
+            self.assertEqual(data['messages'][0]['user'],
+                             {'id': self.author_id, 'username': 'author',
+                              'image_url': '/static/images/default-pic.png'})
+
+            res = c.get(f"/api/v1/timeline?limit=3&after={data['next']}")
+            data = res.get_json()
+
+            self.assertEqual([m['text'] for m in data['messages']], ['author 1', 'author 0'])
+            self.assertIsNone(data['next'])
+
+    def test_timeline_bad_cursor(self):
+        '''Is a cursor holding a bool treated as no cursor, rather than as sort key 1?'''
+        with self.client as c:
+            self._login(c)
+
+            res = c.get(f"/api/v1/timeline?limit=3&after={encode_cursor([True])}")
+            data = res.get_json()
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([m['text'] for m in data['messages']], ['author 4', 'author 3', 'author 2'])
+
+    def test_timeline_requires_login(self):
+        res = self.client.get('/api/v1/timeline')
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.get_json(), {'error': 'Access unauthorized.'})
+
+    def test_field_selection(self):
+        '''Does ?fields= limit what's returned?'''
+        res = self.client.get(f'/api/v1/users/{self.viewer_id}?fields=username,bio,nonsense')
+
+        self.assertEqual(res.get_json(), {'username': 'viewer', 'bio': 'hi'})
+
+        msg_id = Message.query.filter_by(text='stranger').one().id
+        res = self.client.get(f'/api/v1/messages/{msg_id}?fields=text')
+
+        self.assertEqual(res.get_json(), {'text': 'stranger'})
+
+    def test_not_found(self):
+        res = self.client.get('/api/v1/messages/0')
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.get_json(), {'error': 'Message not found.'})
+
+    def test_gzip(self):
+        '''Are larger responses gzipped when the client asks for it?'''
+        with self.client as c:
+            self._login(c)
+
+            res = c.get('/api/v1/timeline', headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            data = json.loads(gzip.decompress(res.get_data()))
+            self.assertEqual(len(data['messages']), 5)
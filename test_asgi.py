@@ -0,0 +1,157 @@
+"""Async serving mode tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+from unittest import skipIf
+
+from fixtures import CommittedTestCase, DATABASE_URL
+from models import db, User, Message, Follows, Likes
+
+from app import app, CURR_USER_KEY
+from asgi import AsyncWarbler, AsyncPostgres, Request, asyncpg
+
+
+def session_headers(user_id):
+    cookie = app.session_interface.get_signing_serializer(app).dumps({CURR_USER_KEY: user_id})
+    return [(b'cookie', f'session={cookie}'.encode())]
+
+
+def call(application, path, method='GET', user_id=None, body=b''):
+    """Run one request through an ASGI app; returns (status, headers, body)."""
+
+    query_string = b''
+    if '?' in path:
+        path, query = path.split('?', 1)
+        query_string = query.encode()
+
+    headers = []
+    if user_id is not None:
+        headers.extend(session_headers(user_id))
+    if body:
+        headers.append((b'content-type', b'application/x-www-form-urlencoded'))
+        headers.append((b'content-length', str(len(body)).encode()))
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+             'headers': headers, 'http_version': '1.1', 'scheme': 'http'}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(event):
+        sent.append(event)
+
+    async def run():
+        await application(scope, receive, send)
+        await application.database.close()
+
+    asyncio.run(run())
+
+    start = sent[0]
+    return (start['status'], dict(start['headers']),
+            b''.join(event.get('body', b'') for event in sent[1:]).decode())
+
+
+@skipIf(asyncpg is None, "asyncpg not installed")
+class AsgiTestCase(CommittedTestCase):
+    """Test the async routes against the test database."""
+
+    def setUp(self):
+        """Create sample data."""
+
+        viewer = User(username='viewer', email='viewer@test.com', password='HASHED_PASSWORD')
+        author = User(username='author', email='author@test.com', password='HASHED_PASSWORD')
+        db.session.add_all([viewer, author])
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+
+        db.session.add(Follows(user_being_followed_id=author.id, user_following_id=viewer.id))
+        msg = Message(text='async warble', user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.msg_id = msg.id
+
+    def application(self):
+        return AsyncWarbler(app, AsyncPostgres(DATABASE_URL))
+
+    def test_homepage(self):
+        '''Does the async homepage show followed users' messages?'''
+        db.session.add(Likes(user_id=self.viewer_id, message_id=self.msg_id))
+        db.session.commit()
+
+        status, headers, html = call(self.application(), '/', user_id=self.viewer_id)
+
+        self.assertEqual(status, 200)
+        self.assertIn('async warble', html)
+        self.assertIn('@author', html)
+        self.assertIn(f'/users/remove_like/{self.msg_id}', html)
+        self.assertRegex(html, rf'/users/{self.viewer_id}/following"\s*>1</a')
+
+        status, headers, html = call(self.application(), '/')
+
+        self.assertEqual(status, 200)
+        self.assertIn('New to Warbler?', html)
+
+    def test_users_show(self):
+        '''Does the async profile page show the user, counts and follow state?'''
+        status, headers, html = call(self.application(), f'/users/{self.author_id}', user_id=self.viewer_id)
+
+        self.assertEqual(status, 200)
+        self.assertIn('@author', html)
+        self.assertIn('async warble', html)
+        self.assertIn(f'/users/stop-following/{self.author_id}', html)
+
+    def test_messages_show(self):
+        status, headers, html = call(self.application(), f'/messages/{self.msg_id}')
+
+        self.assertEqual(status, 200)
+        self.assertIn('async warble', html)
+
+    def test_search(self):
+        status, headers, html = call(self.application(), '/users?q=auth')
+
+        self.assertEqual(status, 200)
+        self.assertIn('@author', html)
+        self.assertNotIn('@viewer', html)
+
+    def test_passes_through_to_flask(self):
+        '''Do routes without an async version, and missing users, go to Flask?'''
+        status, headers, html = call(self.application(), '/login')
+
+        self.assertEqual(status, 200)
+        self.assertIn('Welcome back.', html)
+
+        status, headers, html = call(self.application(), '/users/0')
+
+        self.assertEqual(status, 404)
+
+        status, headers, html = call(self.application(), '/messages/new', method='POST',
+                                     user_id=self.viewer_id, body=b'text=posted+via+asgi')
+
+        self.assertEqual(status, 302)
+        self.assertIsNotNone(Message.query.filter_by(text='posted via asgi').first())
+
+    def test_other_shards_go_to_flask(self):
+        '''Are the homepage and profile left to Flask when they need messages on another shard?'''
+        User.query.filter_by(id=self.author_id).update({'shard': 'shard1'})
+        db.session.commit()
+
+        application = self.application()
+        request = Request({'path': '/', 'headers': session_headers(self.viewer_id)})
+
+        async def run():
+            await application.ensure_connected()
+            try:
+                return (await application.homepage(request),
+                        await application.users_show(request, str(self.author_id)))
+            finally:
+                await application.database.close()
+
+        self.assertEqual(asyncio.run(run()), (None, None))
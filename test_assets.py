@@ -0,0 +1,134 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+import fixtures  # the test database and config; import it before app
+from app import app
+from assets import assets, build, brotli, minify_css, BUNDLES, MAX_AGE
+
+
+class AssetsTestCase(TestCase):
+    """Test the build and /assets/."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.out_dir = tempfile.mkdtemp()
+        cls.manifest = build(cls.out_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.out_dir)
+
+    def setUp(self):
+        self.assets_dir = app.config['ASSETS_DIR']
+        app.config['ASSETS_DIR'] = self.out_dir
+        assets.reload()
+
+        self.client = app.test_client()
+        self.css = self.manifest['files']['app.css']
+
+    def tearDown(self):
+        app.config['ASSETS_DIR'] = self.assets_dir
+        assets.reload()
+
+    def _read(self, name):
+        with open(os.path.join(self.out_dir, name), 'rb') as f:
+            return f.read()
+
+    def test_manifest(self):
+        '''Is every file in the manifest, named by a hash of its content?'''
+        files = self.manifest['files']
+
+        for name in list(BUNDLES) + ['favicon.ico', 'images/warbler-logo.png']:
+            self.assertIn(name, files)
+
+        for name, hashed in files.items():
+            root, ext = os.path.splitext(name)
+            digest = hashlib.sha256(self._read(hashed)).hexdigest()[:12]
+            self.assertEqual(hashed, f"{root}.{digest}{ext}")
+
+    def test_compressed_variants(self):
+        '''Do the precompressed variants hold the same bytes?'''
+        encoded = self.manifest['encoded']
+
+        self.assertIn('gzip', encoded[self.css])
+        for hashed, encodings in encoded.items():
+            if 'gzip' in encodings:
+                self.assertEqual(gzip.decompress(self._read(hashed + '.gz')), self._read(hashed))
+            if 'br' in encodings:
+                self.assertEqual(brotli.decompress(self._read(hashed + '.br')), self._read(hashed))
+
+    def test_css_urls_are_hashed(self):
+        '''Does the CSS bundle only reference hashed files (or data: URLs)?'''
+        css = self._read(self.css).decode('UTF-8')
+        hashed = set(self.manifest['files'].values())
+
+        urls = re.findall(r'url\(([^"\')]+)\)', css)
+        self.assertIn(self.manifest['files']['images/nav-bg.png'], urls)
+        self.assertIn(self.manifest['files']['vendor/fontawesome-6.6.0/webfonts/fa-solid-900.woff2'], urls)
+        for url in urls:
+            self.assertIn(url, hashed)
+        self.assertNotIn('/static/', css)
+
+    def test_rebuild_is_stable(self):
+        '''Does building unchanged sources give the same names?'''
+        self.assertEqual(build(self.out_dir), self.manifest)
+
+    def test_minify_css(self):
+        '''Are comments and whitespace dropped, but not strings or licences?'''
+        css = '/*! licence */\na {\n  color: red; /* why */\n}\n.b > .c { content: "x  ;  y"; }'
+
+        self.assertEqual(minify_css(css), '/*! licence */ a{color:red}.b>.c{content:"x  ;  y"}')
+
+    def test_pages_link_hashed_assets(self):
+        '''Do pages link the built bundles, and the sources without a build?'''
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertIn(f'/assets/{self.css}', html)
+        self.assertNotIn('unpkg.com', html)
+
+        app.config['ASSETS_DIR'] = os.path.join(self.out_dir, 'missing')
+        assets.reload()
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertIn('/static/stylesheets/style.css', html)
+
+    def test_serves_immutable(self):
+        '''Are hashed assets cached for a year, and plain for clients without gzip?'''
+        resp = self.client.get(f'/assets/{self.css}', headers={'Accept-Encoding': 'identity'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], f'public, max-age={MAX_AGE}, immutable')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(resp.get_data(), self._read(self.css))
+
+        resp = self.client.get('/assets/manifest.json')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_serves_gzip(self):
+        '''Is the gzip variant sent to clients that only accept gzip?'''
+        resp = self.client.get(f'/assets/{self.css}', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.get_data()), self._read(self.css))
+
+    @skipIf(brotli is None, "brotli isn't installed")
+    def test_serves_brotli(self):
+        '''Is brotli preferred when the client accepts it?'''
+        resp = self.client.get(f'/assets/{self.css}', headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.get_data()), self._read(self.css))
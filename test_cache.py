@@ -0,0 +1,173 @@
+"""Message cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from fixtures import DatabaseTestCase, make_user, make_message
+from models import db, Message
+
+from app import app, CURR_USER_KEY
+from cache import cache, entry_size, LRUCache, MessageRow
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the LRU itself."""
+
+    def test_evicts_least_recently_used(self):
+        '''Does going over the byte budget evict the entry used longest ago?'''
+        rows = {key: MessageRow(key, 'x' * 100, None, 1) for key in (1, 2, 3)}
+        lru = LRUCache(max_bytes=2 * entry_size(rows[1]))
+
+        lru.set(1, rows[1])
+        lru.set(2, rows[2])
+        lru.get_many([1])
+        lru.set(3, rows[3])
+
+        self.assertEqual(set(lru.entries), {1, 3})
+        self.assertEqual(lru.size, 2 * entry_size(rows[1]))
+
+    def test_entries_expire(self):
+        '''Are entries older than the TTL treated as misses and dropped?'''
+        clock = FakeClock()
+        lru = LRUCache(max_bytes=10000, ttl=60, clock=clock)
+        lru.set('a', ('value',))
+
+        clock.now = 59
+        self.assertEqual(lru.get_many(['a']), {'a': ('value',)})
+
+        clock.now = 60
+        self.assertEqual(lru.get_many(['a']), {})
+        self.assertEqual(len(lru), 0)
+        self.assertEqual(lru.size, 0)
+
+
+class ObjectCacheTestCase(DatabaseTestCase):
+    """Test hydration and invalidation through the routes."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        cache.clear()
+
+        self.client = app.test_client()
+
+        self.user = make_user('testuser', password='testuser')
+        self.other = make_user('otheruser', password='otheruser')
+
+        self.messages = [make_message(self.other, f'warble {i}') for i in range(5)]
+        self.user.following.append(self.other)
+        db.session.commit()
+
+        self.user_id = self.user.id
+        self.other_id = self.other.id
+        self.message_ids = [msg.id for msg in self.messages]
+
+    def _login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def _count_selects(self, fn):
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append(statement)
+
+        engine = db.get_engine(app)
+        event.listen(engine, 'before_cursor_execute', before_execute)
+        try:
+            fn()
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_execute)
+
+        return statements
+
+    def test_get_messages_loads_misses_at_once(self):
+        '''Are cache misses loaded in one query and hits not loaded at all?'''
+        with app.test_request_context():
+            first = self._count_selects(lambda: cache.get_messages(self.message_ids))
+            again = self._count_selects(lambda: cache.get_messages(self.message_ids))
+
+        # one query for the messages, one for their (single) author
+        self.assertEqual(len(first), 2)
+        self.assertEqual(again, [])
+
+    def test_get_messages_keeps_order(self):
+        '''Do hydrated messages come back in the order of the ids asked for?'''
+        ids = list(reversed(self.message_ids)) + [-1]
+
+        with app.test_request_context():
+            messages = cache.get_messages(ids)
+
+        self.assertEqual([msg.id for msg in messages], ids[:-1])
+        self.assertEqual(messages[0].user.username, 'otheruser')
+
+    def test_homepage_uses_cache(self):
+        '''Does the timeline render messages served from the cache?'''
+        with self.client as c:
+            self._login(c)
+            c.get('/')
+
+            # change a row behind the cache's back: the cached copy is served
+            Message.query.get(self.message_ids[0]).text = 'changed'
+            db.session.commit()
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('warble 0', html)
+            self.assertNotIn('changed', html)
+
+    def test_destroy_invalidates(self):
+        '''Does deleting a message drop it from the cache?'''
+        msg = Message(text='my warble', user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            self._login(c)
+            self.assertEqual(c.get(f'/messages/{msg_id}').status_code, 200)
+
+            c.post(f'/messages/{msg_id}/delete')
+
+            self.assertEqual(c.get(f'/messages/{msg_id}').status_code, 404)
+
+    def test_profile_edit_invalidates_user(self):
+        '''Does editing a profile show the new username on cached messages?'''
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.other_id
+
+            self.assertIn('@otheruser', c.get(f'/messages/{self.message_ids[0]}').get_data(as_text=True))
+
+            c.post('/users/profile', data={'username': 'renamed', 'email': 'other@test.com',
+                                           'image_url': '', 'header_image_url': '',
+                                           'bio': '', 'password': 'otheruser'})
+
+            html = c.get(f'/messages/{self.message_ids[0]}').get_data(as_text=True)
+            self.assertIn('@renamed', html)
+
+    def test_show_follow_state(self):
+        '''Does the message page know the viewer follows a cached author?'''
+        with self.client as c:
+            self._login(c)
+            html = c.get(f'/messages/{self.message_ids[0]}').get_data(as_text=True)
+
+            self.assertIn(f'/users/stop-following/{self.other_id}', html)
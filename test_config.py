@@ -0,0 +1,48 @@
+"""App factory and config tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_config.py
+
+
+import os
+from unittest import TestCase, mock
+
+from flask import url_for
+
+from fixtures import DATABASE_URL
+from app import create_app
+
+
+class CreateAppTestCase(TestCase):
+    """Test create_app() for each environment."""
+
+    def test_toolbar_only_in_development(self):
+        '''Is the debug toolbar installed in development and nowhere else?'''
+        dev = create_app('development')
+        self.assertTrue(dev.debug)
+        self.assertIn('debugtoolbar', dev.blueprints)
+
+        for env in ('production', 'testing'):
+            self.assertNotIn('debugtoolbar', create_app(env).blueprints)
+
+    def test_environment_overrides(self):
+        '''Do FLASK_ENV and setting variables pick the config?'''
+        with mock.patch.dict(os.environ, {'FLASK_ENV': 'testing', 'SECRET_KEY': 'from-env'}):
+            app = create_app()
+
+        self.assertTrue(app.testing)
+        self.assertFalse(app.config['WTF_CSRF_ENABLED'])
+        self.assertEqual(app.config['SECRET_KEY'], 'from-env')
+        self.assertEqual(app.config['BCRYPT_LOG_ROUNDS'], 4)
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'], DATABASE_URL)
+
+    def test_views_keep_their_names(self):
+        '''Are the views registered under their own endpoint names?'''
+        app = create_app('testing')
+
+        with app.test_request_context():
+            self.assertEqual(url_for('homepage'), '/')
+            self.assertEqual(url_for('users_show', user_id=1), '/users/1')
+
+        self.assertEqual(app.test_client().get('/').status_code, 200)
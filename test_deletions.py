@@ -0,0 +1,151 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletions.py
+
+
+import shutil
+import tempfile
+from datetime import datetime
+
+from fixtures import DatabaseTestCase, make_user, make_message, make_follow, make_like
+from models import db, User, Message, Follows, Likes, DeletionJob
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from deletions import run_job, run_pending
+from partitions import archive_month, archived_messages
+
+
+class DeletionsTestCase(DatabaseTestCase):
+    """Test soft deletion and the background purge."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        cache.clear()
+
+        self.client = app.test_client()
+
+        self.doomed = make_user('doomed', password='password')
+        self.friend = make_user('friend', password='password')
+
+        self.doomed_id = self.doomed.id
+        self.friend_id = self.friend.id
+
+        msgs = [make_message(self.doomed, f'doomed warble {i}') for i in range(7)]
+        friend_msg = make_message(self.friend, 'friend warble')
+        make_follow(self.doomed, self.friend)
+        make_follow(self.friend, self.doomed)
+
+        make_like(self.doomed, friend_msg)
+        make_like(self.friend, msgs[0])
+        User.refresh_followers_count()
+        db.session.commit()
+
+        self.msg_id = msgs[0].id
+
+    def _login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def _delete_doomed(self):
+        with self.client as c:
+            self._login(c, self.doomed_id)
+            resp = c.post('/users/delete')
+            self.assertEqual(resp.status_code, 302)
+
+    def test_delete_hides_account(self):
+        '''Is a deleted account hidden straight away, with its rows still there?'''
+        self._delete_doomed()
+
+        self.assertEqual(Message.query.filter_by(user_id=self.doomed_id).count(), 7)
+        self.assertEqual(User.query.get(self.friend_id).followers_count, 0)
+
+        with self.client as c:
+            self._login(c, self.friend_id)
+
+            self.assertEqual(c.get(f'/users/{self.doomed_id}').status_code, 404)
+            self.assertEqual(c.get(f'/messages/{self.msg_id}').status_code, 404)
+            self.assertNotIn('doomed warble', c.get('/').get_data(as_text=True))
+            self.assertNotIn('@doomed', c.get('/users').get_data(as_text=True))
+            self.assertNotIn('@doomed', c.get(f'/users/{self.friend_id}/followers').get_data(as_text=True))
+
+        self.assertFalse(User.authenticate('doomed', 'password'))
+
+    def test_deleted_user_is_logged_out(self):
+        '''Does a session for a deleted account stop working?'''
+        self._delete_doomed()
+
+        with self.client as c:
+            self._login(c, self.doomed_id)
+            resp = c.get('/messages/new')
+
+            self.assertEqual(resp.status_code, 302)
+
+    def test_purge_removes_rows(self):
+        '''Does running the pending jobs remove everything the user had?'''
+        self._delete_doomed()
+
+        with app.app_context():
+            self.assertEqual(run_pending(chunk_size=3), 1)
+
+        self.assertIsNone(User.query.get(self.doomed_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.doomed_id).count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+        job = DeletionJob.query.one()
+        self.assertEqual(job.stage, 'done')
+        self.assertIsNotNone(job.finished_at)
+        # likes given, follows, likes received, messages, the user
+        self.assertEqual(job.deleted_rows, 1 + 2 + 1 + 7 + 1)
+
+        with app.app_context():
+            self.assertEqual(run_pending(), 0)
+
+    def test_purge_resumes(self):
+        '''Does a job stopped part way carry on from where it was?'''
+        self._delete_doomed()
+
+        job = DeletionJob.query.one()
+        with app.app_context():
+            self.assertFalse(run_job(job, chunk_size=3, max_chunks=5))
+        self.assertEqual(job.stage, 'messages')
+
+        # a fresh worker picks the job up from the DB
+        db.session.remove()
+        job = DeletionJob.query.one()
+        self.assertEqual(job.stage, 'messages')
+        self.assertEqual(Message.query.filter_by(user_id=self.doomed_id).count(), 4)
+
+        with app.app_context():
+            self.assertTrue(run_job(job, chunk_size=3))
+        self.assertIsNone(User.query.get(self.doomed_id))
+
+    def test_purge_archived_messages(self):
+        '''Are the user's archived messages and their likes purged, and everyone else's kept?'''
+        month = datetime(2020, 1, 1)
+        doomed_old = make_message(self.doomed, 'old doomed warble', timestamp=month.replace(day=2))
+        friend_old = make_message(self.friend, 'old friend warble', timestamp=month.replace(day=3))
+        make_like(self.friend, doomed_old)
+        db.session.commit()
+        ids = {doomed_old.id, friend_old.id}
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(app.config.__setitem__, 'MESSAGE_ARCHIVE_DIR', app.config['MESSAGE_ARCHIVE_DIR'])
+        app.config['MESSAGE_ARCHIVE_DIR'] = directory
+
+        with app.app_context():
+            archive_month(month)
+
+        self._delete_doomed()
+
+        with app.app_context():
+            run_pending(chunk_size=3)
+            self.assertEqual([msg.text for msg in archived_messages(ids)], ['old friend warble'])
+
+        self.assertEqual(Likes.query.count(), 0)
@@ -0,0 +1,99 @@
+"""Group commit tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_group_commit.py
+
+
+import threading
+from datetime import datetime
+from unittest import mock
+
+from sqlalchemy.exc import IntegrityError
+
+from fixtures import CommittedTestCase, make_user
+from models import db, User, Message
+
+from app import app, CURR_USER_KEY
+import group_commit
+from group_commit import insert_group, message_writer
+from sequencer import sequencer
+
+
+class GroupCommitTestCase(CommittedTestCase):
+    """Test posting through the writer thread.
+
+    The writer commits on its own connection, so these tests commit their
+    data rather than rolling it back.
+    """
+
+    def setUp(self):
+        self.config = dict(app.config)
+        app.config['MESSAGE_GROUP_COMMIT'] = True
+
+        self.user_id = make_user('poster').id
+        db.session.commit()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        super().tearDown()
+
+    def _row(self, text, user_id):
+        now = datetime.utcnow()
+        with app.app_context():
+            key = sequencer.key_for(now, db.engine)
+        return {'text': text, 'user_id': user_id, 'timestamp': now, 'sort_key': key}
+
+    def test_concurrent_posts(self):
+        '''Are concurrent posts committed together, each request getting its own message?'''
+        app.config['MESSAGE_GROUP_WAIT'] = 0.05
+        statuses = []
+        sizes = []
+
+        def insert(rows):
+            sizes.append(len(rows))
+            return insert_group(rows)
+
+        def post(i):
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+                statuses.append(c.post('/messages/new', data={'text': f'burst {i}'}).status_code)
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(8)]
+        with mock.patch.object(group_commit, 'insert_group', insert):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(statuses, [302] * 8)
+        self.assertEqual(sum(sizes), 8)
+        self.assertLess(len(sizes), 8)
+        # the profile is bumped once per group, in the group's commit
+        self.assertEqual(User.query.get(self.user_id).profile_version, len(sizes))
+        texts = {msg.text for msg in Message.query.filter_by(user_id=self.user_id)}
+        self.assertEqual(texts, {f'burst {i}' for i in range(8)})
+
+    def test_bad_row_fails_alone(self):
+        '''Does a row that can't be inserted fail only its own caller?'''
+        rows = [self._row('good', self.user_id), self._row('orphan', 0),
+                self._row('also good', self.user_id)]
+
+        with app.app_context():
+            results = insert_group(rows)
+
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertEqual(Message.query.get(results[0]).text, 'good')
+        self.assertEqual(Message.query.get(results[2]).text, 'also good')
+        self.assertEqual(Message.query.count(), 2)
+
+    def test_post_returns_message(self):
+        '''Does post() return the committed message, attached to the session?'''
+        with app.test_request_context():
+            user = User.query.get(self.user_id)
+            msg = message_writer.post(user, 'hello')
+
+            self.assertIsNotNone(msg.id)
+            self.assertIs(msg.user, user)
+            self.assertEqual(db.session.query(Message.text).filter_by(id=msg.id).scalar(), 'hello')
@@ -0,0 +1,204 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase, mock
+
+from PIL import Image
+
+import fixtures  # the test database and config; import it before app
+from app import app
+from images import images, DiskCache, HTTPFetcher, LocalFetcher, FetchError, IMAGE_MAX_AGE
+
+AVATAR = 'https://example.com/portraits/1.jpg'
+COPY = 'https://mirror.example.org/same.jpg'
+HEADER = 'https://example.com/headers/wide.png'
+
+
+def write_image(path, size, fmt):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', size, (200, 30, 30)).save(path, fmt)
+
+
+class ImageProxyTestCase(TestCase):
+    """Test /images/ with a local fetcher."""
+
+    def setUp(self):
+        self.sources = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+
+        write_image(os.path.join(self.sources, 'example.com/portraits/1.jpg'), (800, 600), 'JPEG')
+        os.makedirs(os.path.join(self.sources, 'mirror.example.org'))
+        shutil.copy(os.path.join(self.sources, 'example.com/portraits/1.jpg'),
+                    os.path.join(self.sources, 'mirror.example.org/same.jpg'))
+        write_image(os.path.join(self.sources, 'example.com/headers/wide.png'), (3000, 1000), 'PNG')
+
+        self.fetcher = images.fetcher
+        self.config = app.config['IMAGE_CACHE_DIR']
+        images.fetcher = LocalFetcher(self.sources)
+        app.config['IMAGE_CACHE_DIR'] = self.cache_dir
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        images.fetcher = self.fetcher
+        app.config['IMAGE_CACHE_DIR'] = self.config
+        shutil.rmtree(self.sources)
+        shutil.rmtree(self.cache_dir)
+
+    def _url(self, source, size):
+        with app.test_request_context():
+            return images.url(source, size)
+
+    def _get(self, source, size, accept='image/webp,*/*'):
+        return self.client.get(self._url(source, size), headers={'Accept': accept})
+
+    def test_resizes_to_webp(self):
+        '''Is a thumb a square WebP, cached for a long time?'''
+        resp = self._get(AVATAR, 'thumb')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/webp')
+        self.assertEqual(resp.headers['Cache-Control'], f'public, max-age={IMAGE_MAX_AGE}')
+        self.assertIn('Accept', resp.headers['Vary'])
+
+        image = Image.open(io.BytesIO(resp.get_data()))
+        self.assertEqual((image.format, image.size), ('WEBP', (96, 96)))
+
+    def test_jpeg_without_webp(self):
+        '''Do browsers that don't list image/webp get a JPEG that keeps its shape?'''
+        resp = self._get(HEADER, 'hero', accept='image/png,image/*;q=0.8,*/*;q=0.5')
+
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        image = Image.open(io.BytesIO(resp.get_data()))
+        self.assertEqual((image.format, image.size), ('JPEG', (1600, 533)))
+
+    def test_fetches_once(self):
+        '''Is each source fetched once for all its sizes, and is content shared?'''
+        for size in ('thumb', 'avatar', 'thumb'):
+            self.assertEqual(self._get(AVATAR, size).status_code, 200)
+        self.assertEqual(images.fetcher.fetches, 1)
+
+        # the same picture at another URL shares the stored original
+        self._get(COPY, 'thumb')
+        originals = [name for _, _, names in os.walk(os.path.join(self.cache_dir, 'originals'))
+                     for name in names]
+        self.assertEqual(len(originals), 1)
+
+    def test_tampered_token(self):
+        '''Are unsigned URLs and unknown sizes refused?'''
+        url = self._url(AVATAR, 'thumb')
+
+        self.assertEqual(self.client.get(url[:-2] + 'xx').status_code, 404)
+        self.assertEqual(self.client.get(url.replace('/thumb/', '/huge/')).status_code, 404)
+
+    def test_unfetchable_redirects(self):
+        '''Does a missing source send the browser to the original URL?'''
+        missing = 'https://example.com/portraits/missing.jpg'
+        resp = self._get(missing, 'thumb')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, missing)
+
+    def test_templates_use_proxy(self):
+        '''Do pages link proxied images, and local paths as is?'''
+        with app.test_request_context():
+            self.assertEqual(images.url('/static/images/default-pic.png', 'thumb'),
+                             '/static/images/default-pic.png')
+            self.assertTrue(images.url(AVATAR, 'thumb').startswith('/images/thumb/'))
+
+
+class DiskCacheTestCase(TestCase):
+    """Test the size-limited LRU directory."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_evicts_least_recently_used(self):
+        '''Past the budget, are the least recently used files deleted?'''
+        disk = DiskCache(self.root, max_bytes=300)
+
+        for i, name in enumerate(['a', 'b', 'c']):
+            path = disk.put(name, b'x' * 100)
+            os.utime(path, (i, i))
+
+        # reading "a" makes "b" the least recently used
+        self.assertIsNotNone(disk.get('a'))
+        disk.put('d', b'x' * 100)
+
+        self.assertIsNone(disk.get('b'))
+        self.assertIsNotNone(disk.get('a'))
+        self.assertIsNotNone(disk.get('d'))
+        self.assertLessEqual(disk.size, 300)
+
+
+class HTTPFetcherTestCase(TestCase):
+    """Test what the real fetcher will fetch."""
+
+    def test_refuses_private_hosts(self):
+        '''Are loopback and private addresses and other schemes refused?'''
+        fetcher = HTTPFetcher()
+
+        for url in ('http://127.0.0.1/a.png', 'http://10.0.0.1/a.png',
+                    'http://[::1]/a.png', 'file:///etc/passwd'):
+            with self.assertRaises(FetchError):
+                fetcher.fetch(url)
+
+    def test_connects_to_checked_address(self):
+        '''Is the connection made to the address that was checked, not to a second lookup?'''
+        answers = iter([[(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('93.184.216.34', 0))],
+                        [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 0))]])
+        connected = []
+
+        def create_connection(address, *args, **kwargs):
+            connected.append(address)
+            raise OSError("not connecting in tests")
+
+        with mock.patch('socket.getaddrinfo', lambda *args, **kwargs: next(answers)), \
+                mock.patch('socket.create_connection', create_connection):
+            with self.assertRaises(FetchError):
+                HTTPFetcher().fetch('http://rebinding.test/a.png')
+
+        self.assertEqual(connected, [('93.184.216.34', 80)])
+
+    def test_checks_redirects(self):
+        '''Is the Host header kept, and a redirect to a private address refused?'''
+        hosts = []
+
+        class Redirecting(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hosts.append(self.headers['Host'])
+                self.send_response(302)
+                self.send_header('Location', f'http://127.0.0.1:{self.server.server_port}/secret')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Redirecting)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        class PublicTestHost(HTTPFetcher):
+            # the test server stands in for a public host
+            def resolve(self, host):
+                return '127.0.0.1' if host == 'images.test' else super().resolve(host)
+
+        with self.assertRaises(FetchError):
+            PublicTestHost().fetch(f'http://images.test:{server.server_port}/a.png')
+
+        self.assertEqual(hosts, [f'images.test:{server.server_port}'])
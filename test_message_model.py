@@ -1,36 +1,17 @@
-import os
-from unittest import TestCase
-
-from models import db, User, Message, Follows
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from fixtures import DatabaseTestCase
+from models import db, User, Message
 
 from app import app
-app.config['WTF_CSRF_ENABLED'] = False
-
-db.create_all()
 
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(DatabaseTestCase):
     """Test the Message model."""
 
     def setUp(self):
-        """Create test client, add sample data."""
-
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        db.session.commit()
+        """Create test client."""
 
+        super().setUp()
         self.client = app.test_client()
 
-    def tearDown(self):
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        db.session.commit()
-
     def _create_test_users(self):
         '''Helper method to create and return two test users in the database.'''
         u1 = User(username='testuser1', email='test1@test.com', password='password123')
@@ -2,52 +2,27 @@
 
 # run these tests like:
 #
-#    FLASK_ENV=production python -m unittest test_message_views.py
+#    python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
+# fixtures picks the test database and config, so import it before app
 
-from models import db, connect_db, Message, User
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
+from fixtures import DatabaseTestCase, make_user, make_message, make_follow, make_like
+from models import db, connect_db, Message
 
 from app import app, CURR_USER_KEY
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-
+        super().setUp()
         self.client = app.test_client()
 
-        self.testuser = User.signup(username="testuser",
-                                    email="test@test.com",
-                                    password="testuser",
-                                    image_url=None)
+        self.testuser = make_user('testuser', password='testuser')
 
         db.session.commit()
 
@@ -112,4 +87,23 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(destroy_msg.status_code, 200)
             self.assertNotIn('testing message', html)
             self.assertIn('testuser', html)
- 
\ No newline at end of file
+ 
+    def test_homepage_likes_and_stats(self):
+        '''Does the homepage mark the viewer's likes on the page, and show their stats?'''
+        author = make_user('author')
+        liked = make_message(author, 'liked warble')
+        make_message(author, 'other warble')
+        make_follow(self.testuser, author)
+        make_like(self.testuser, liked)
+        db.session.commit()
+        liked_id, user_id = liked.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            html = c.get('/').get_data(as_text=True)
+
+        self.assertIn(f'/users/remove_like/{liked_id}', html)
+        self.assertEqual(html.count('/users/remove_like/'), 1)
+        self.assertRegex(html, rf'/users/{user_id}/following"\s*>1</a')
@@ -0,0 +1,145 @@
+"""/metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+import re
+import shutil
+import tempfile
+from unittest import TestCase
+
+from fixtures import DatabaseTestCase, make_user
+from models import db
+
+from app import app
+from metrics import metrics, collect, render, ValueFile
+from rendering import render_profiler
+
+REQUESTS = 'warbler_requests_total{endpoint="%s",method="GET",status="%s"}'
+
+
+def sample(text, name):
+    """Value of the sample `name` (with its labels) in /metrics output."""
+
+    match = re.search('^' + re.escape(name) + r' (\S+)$', text, re.M)
+    return match and float(match.group(1))
+
+
+def dead_pid():
+    pid = 4000000
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return pid
+        pid += 1
+
+
+class MetricsViewTestCase(DatabaseTestCase):
+    """Test what requests record and /metrics serves."""
+
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        metrics.clear()
+        super().tearDown()
+
+    def test_counts_and_histograms(self):
+        '''Are requests counted by endpoint and status, with a latency histogram?'''
+        for i in range(3):
+            self.client.get('/')
+        self.client.get('/users/0')
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+
+        self.assertEqual(sample(text, REQUESTS % ('homepage', 200)), 3)
+        self.assertEqual(sample(text, REQUESTS % ('users_show', 404)), 1)
+        self.assertEqual(sample(text, 'warbler_request_duration_seconds_bucket{endpoint="homepage",le="+Inf"}'), 3)
+        self.assertEqual(sample(text, 'warbler_request_duration_seconds_count{endpoint="homepage"}'), 3)
+        self.assertIn('# TYPE warbler_request_duration_seconds histogram', text)
+
+    def test_statements_and_caches(self):
+        '''Are SQL statements counted per endpoint, and cache and pool numbers reported?'''
+        user_id = make_user('testuser').id
+        db.session.commit()
+
+        self.client.get('/')
+        self.client.get(f'/users/{user_id}')
+        self.client.get(f'/users/{user_id}')
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+
+        self.assertEqual(sample(text, 'warbler_db_statements_total{endpoint="homepage"}'), 0)
+        self.assertGreater(sample(text, 'warbler_db_statements_total{endpoint="users_show"}'), 0)
+        self.assertGreater(sample(text, 'warbler_cache_hits_total{cache="profiles"}'), 0)
+        self.assertIsNotNone(sample(text, 'warbler_cache_hit_ratio{cache="profiles"}'))
+        self.assertIsNotNone(sample(text, 'warbler_db_pool_checked_out'))
+
+    def test_render_histograms(self):
+        '''Are template render times served as a histogram when profiling is on?'''
+        render_profiler.enabled = True
+        self.addCleanup(setattr, render_profiler, 'enabled', app.config['TEMPLATE_PROFILE'])
+        self.addCleanup(render_profiler.clear)
+        render_profiler.clear()
+
+        self.client.get('/')
+        self.client.get('/')
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        home = 'template="home-anon.html",block=""'
+
+        self.assertIn('# TYPE warbler_template_render_seconds histogram', text)
+        self.assertEqual(sample(text, f'warbler_template_render_seconds_bucket{{{home},le="+Inf"}}'), 2)
+        self.assertEqual(sample(text, f'warbler_template_render_seconds_count{{{home}}}'), 2)
+        self.assertGreater(sample(text, f'warbler_template_render_seconds_sum{{{home}}}'), 0)
+
+
+
+class MultiProcessTestCase(TestCase):
+    """Test adding up the files of several worker processes."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _file(self, pid):
+        return ValueFile(os.path.join(self.directory, f'{pid}.db'))
+
+    def test_sums_workers(self):
+        '''Are counters summed across workers, and gauges only over running ones?'''
+        requests = ('warbler_requests_total', (('endpoint', 'homepage'), ('method', 'GET'), ('status', '200')))
+        checked_out = ('warbler_db_pool_checked_out', ())
+
+        live, dead = self._file(os.getpid()), self._file(dead_pid())
+        live.inc(requests, 2)
+        live.set(checked_out, 1)
+        dead.inc(requests, 5)
+        dead.set(checked_out, 3)
+
+        totals = collect(self.directory)
+
+        self.assertEqual(totals[requests], 7)
+        self.assertEqual(totals[checked_out], 1)
+        self.assertEqual(sample(render(totals), REQUESTS % ('homepage', 200)), 7)
+
+    def test_grows_and_reopens(self):
+        '''Does a file grow past its first size, and keep its values when reopened?'''
+        values = ValueFile(os.path.join(self.directory, '1.db'), size=256)
+        keys = [('warbler_db_statements_total', (('endpoint', f'view{i}'),)) for i in range(100)]
+        for i, key in enumerate(keys):
+            values.inc(key, i)
+        values.close()
+
+        reopened = ValueFile(os.path.join(self.directory, '1.db'))
+        reopened.inc(keys[-1])
+
+        self.assertEqual(dict(reopened.items())[keys[-1]], 100)
+        self.assertEqual(len(reopened.items()), 100)
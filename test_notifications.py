@@ -0,0 +1,115 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+from datetime import datetime
+
+from fixtures import DatabaseTestCase, make_user, make_message
+from models import db, User, Notification
+
+from app import app, CURR_USER_KEY
+from notifications import deliver
+from pagination import encode_cursor
+
+
+class NotificationsTestCase(DatabaseTestCase):
+    """Test notification delivery and the inbox."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        self.client = app.test_client()
+
+        self.users = [make_user(f'user{i}') for i in range(4)]
+        self.msg = make_message(self.users[0], 'popular warble')
+        db.session.commit()
+
+    def _login(self, c, user):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_deliver_coalesces_batch(self):
+        '''Does one batch of likes on the same message become one grouped notification?'''
+        owner_id = self.users[0].id
+        now = datetime.utcnow()
+        events = [(owner_id, 'like', user.id, self.msg.id, now) for user in self.users[1:]]
+        events.append((owner_id, 'follow', self.users[1].id, None, now))
+
+        deliver(events)
+
+        likes = Notification.query.filter_by(user_id=owner_id, kind='like').all()
+        self.assertEqual(len(likes), 1)
+        self.assertEqual(likes[0].actor_count, 3)
+        self.assertEqual(likes[0].actor_id, self.users[-1].id)
+        self.assertEqual(User.query.get(owner_id).unread_notifications, 2)
+
+    def test_deliver_merges_into_unread(self):
+        '''Do later events merge into an unread notification, and start a new one once read?'''
+        owner_id = self.users[0].id
+
+        deliver([(owner_id, 'follow', self.users[1].id, None, datetime.utcnow())])
+        deliver([(owner_id, 'follow', self.users[2].id, None, datetime.utcnow())])
+
+        follows = Notification.query.filter_by(user_id=owner_id).all()
+        self.assertEqual(len(follows), 1)
+        self.assertEqual(follows[0].actor_count, 2)
+
+        Notification.mark_all_read(owner_id)
+        db.session.commit()
+
+        deliver([(owner_id, 'follow', self.users[3].id, None, datetime.utcnow())])
+
+        self.assertEqual(Notification.query.filter_by(user_id=owner_id).count(), 2)
+        self.assertEqual(User.query.get(owner_id).unread_notifications, 1)
+
+    def test_routes_notify(self):
+        '''Do mentions, follows and likes show up in the inbox?'''
+        owner_id = self.users[0].id
+        msg_id = self.msg.id
+
+        with self.client as c:
+            self._login(c, self.users[1])
+            c.post('/messages/new', data={'text': 'hey @user0 and @nobody'})
+            c.post(f'/users/follow/{owner_id}')
+            c.post(f'/users/add_like/{msg_id}')
+
+            self._login(c, self.users[0])
+            res = c.get('/')
+            self.assertIn('<span class="badge badge-primary">3</span>', res.get_data(as_text=True))
+
+            res = c.get('/notifications')
+            html = res.get_data(as_text=True)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('mentioned you', html)
+            self.assertIn('followed you', html)
+            self.assertIn('liked your warble', html)
+            self.assertIn('hey @user0 and @nobody', html)
+
+        # visiting the inbox reads everything
+        self.assertEqual(User.query.get(owner_id).unread_notifications, 0)
+        self.assertEqual(Notification.query.filter_by(user_id=owner_id, read=False).count(), 0)
+
+    def test_inbox_bad_cursor(self):
+        '''Is a malformed inbox cursor treated as the first page?'''
+        deliver([(self.users[0].id, 'follow', self.users[1].id, None, datetime.utcnow())])
+
+        with self.client as c:
+            self._login(c, self.users[0])
+
+            for values in (['2024-01-01T00:00:00.000000', 'x'], ['2024-01-01T00:00:00.000000', [1]],
+                           [12, 'not a time']):
+                res = c.get(f'/notifications?after={encode_cursor(values)}')
+
+                self.assertEqual(res.status_code, 200, values)
+                self.assertIn('followed you', res.get_data(as_text=True))
+
+    def test_inbox_requires_login(self):
+        '''Is the inbox only for logged in users?'''
+        res = self.client.get('/notifications', follow_redirects=True)
+
+        self.assertIn('Access unauthorized.', res.get_data(as_text=True))
@@ -0,0 +1,195 @@
+"""Message partition and archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from fixtures import DatabaseTestCase, make_user, make_like
+from models import db, Message, Likes
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from partitions import (add_months, recent_first, write_archive, read_archive,
+                        archive_cold, archive_month, archived_user_messages,
+                        archived_messages, _archived_row, HOT_MONTHS)
+
+NOW = datetime(2024, 3, 15, 12, 0)
+
+
+class ArchiveFileTestCase(TestCase):
+    """Test the packed archive format."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_add_months(self):
+        '''Does month arithmetic wrap across years?'''
+        self.assertEqual(add_months(datetime(2024, 1, 1), -1), datetime(2023, 12, 1))
+        self.assertEqual(add_months(datetime(2023, 11, 1), 14), datetime(2025, 1, 1))
+
+    def test_round_trip(self):
+        '''Does an archive read back each user's rows, newest first?'''
+        rows = [(1, 7, datetime(2020, 1, 1, 9), 'first'),
+                (2, 3, datetime(2020, 1, 2), 'other user'),
+                (3, 7, datetime(2020, 1, 3, 8, 30, 0, 123456), 'sécond ✓')]
+        path = os.path.join(self.directory, 'test.wpk')
+
+        write_archive(path, rows)
+        columns, runs = read_archive(path)
+
+        self.assertEqual(set(runs), {3, 7})
+        start, stop = runs[7]
+        self.assertEqual(list(columns['id'][start:stop]), [3, 1])
+
+        newest = _archived_row(columns, 7, start)
+        self.assertEqual(newest, (3, 'sécond ✓', datetime(2020, 1, 3, 8, 30, 0, 123456), 7))
+
+
+class PartitionsTestCase(DatabaseTestCase):
+    """Test recent-first routing and archival against the DB."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        cache.clear()
+        read_archive.cache_clear()
+
+        self.directory = tempfile.mkdtemp()
+        self.old_directory = app.config['MESSAGE_ARCHIVE_DIR']
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.directory
+
+        self.client = app.test_client()
+
+        user = make_user('testuser', password='password')
+        db.session.commit()
+        self.user_id = user.id
+
+        # one message in each of these many months ago
+        self.ages = [0, 1, 5, 20, 30]
+        msgs = [Message(text=f'{age} months old', user_id=self.user_id,
+                        timestamp=add_months(NOW, -age).replace(day=10))
+                for age in self.ages]
+        db.session.add_all(msgs)
+        db.session.commit()
+        self.msg_ids = [msg.id for msg in msgs]
+
+    def tearDown(self):
+        super().tearDown()
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.old_directory
+        shutil.rmtree(self.directory)
+
+    def _query(self):
+        return (Message.query
+                .filter(Message.user_id == self.user_id)
+                .order_by(Message.timestamp.desc()))
+
+    def test_recent_first(self):
+        '''Does recent_first page through months newest first?'''
+        self.assertEqual([msg.id for msg in recent_first(self._query(), 3, NOW)],
+                         self.msg_ids[:3])
+        self.assertEqual([msg.id for msg in recent_first(self._query(), 100, NOW)],
+                         self.msg_ids)
+
+    def test_archive_cold(self):
+        '''Are old months moved out of the messages table and still readable?'''
+        with app.app_context():
+            archived = archive_cold(NOW)
+
+        self.assertEqual(len(archived), 2)
+        # everything older than HOT_MONTHS is gone from the table
+        self.assertEqual(Message.query.count(),
+                         len([age for age in self.ages if age < HOT_MONTHS]))
+
+        with app.app_context():
+            old = archived_user_messages(self.user_id, 10)
+        self.assertEqual([msg.id for msg in old], self.msg_ids[3:])
+
+        # re-running finds nothing left to archive
+        with app.app_context():
+            self.assertEqual(archive_cold(NOW), [])
+
+    def test_profile_reads_archive(self):
+        '''Do profile and message pages show archived messages?'''
+        with app.app_context():
+            archive_cold(NOW)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            html = c.get(f'/users/{self.user_id}').get_data(as_text=True)
+            for age in self.ages:
+                self.assertIn(f'{age} months old', html)
+            self.assertLess(html.index('5 months old'), html.index('20 months old'))
+
+            resp = c.get(f'/messages/{self.msg_ids[-1]}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('30 months old', resp.get_data(as_text=True))
+
+    def test_like_of_archived_message_kept(self):
+        '''Does a like on a message survive its archival, and still show on the likes page?'''
+        liker = make_user('liker', password='password')
+        make_like(liker, Message.query.get(self.msg_ids[-1]))
+        db.session.commit()
+        liker_id = liker.id
+
+        with app.app_context():
+            archive_cold(NOW)
+
+        self.assertEqual(Likes.query.filter_by(message_id=self.msg_ids[-1]).count(), 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+
+            html = c.get(f'/users/{liker_id}/likes').get_data(as_text=True)
+            self.assertIn('30 months old', html)
+
+    def test_archive_month_in_chunks(self):
+        '''Does archiving read a month a chunk at a time without missing rows?'''
+        month = add_months(NOW, -30).replace(day=1, hour=0)
+        extra = [Message(text=f'extra {i}', user_id=self.user_id,
+                         timestamp=month.replace(day=2 + i))
+                 for i in range(4)]
+        db.session.add_all(extra)
+        db.session.commit()
+        ids = {self.msg_ids[-1]} | {msg.id for msg in extra}
+
+        with app.app_context():
+            self.assertEqual(archive_month(month, chunk_size=2).rows, 5)
+
+        self.assertEqual(Message.query.filter(Message.id.in_(ids)).count(), 0)
+        with app.app_context():
+            self.assertEqual({msg.id for msg in archived_messages(ids)}, ids)
+
+    def test_archive_month_again(self):
+        '''Are rows added to an archived month archived too, rather than just deleted?'''
+        month = add_months(NOW, -30).replace(day=1, hour=0)
+
+        with app.app_context():
+            first = archive_month(month).filename
+
+        late = Message(text='late arrival', user_id=self.user_id, timestamp=month.replace(day=3))
+        db.session.add(late)
+        db.session.commit()
+        ids = {self.msg_ids[-1], late.id}
+
+        with app.app_context():
+            archive = archive_month(month)
+            self.assertEqual(archive.rows, 2)
+            self.assertNotEqual(archive.filename, first)
+            self.assertEqual({msg.id for msg in archived_messages(ids)}, ids)
+
+        self.assertEqual(Message.query.filter(Message.id.in_(ids)).count(), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, first)))
@@ -0,0 +1,170 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from flask import Response, request
+
+from fixtures import DatabaseTestCase, make_user
+from models import db
+
+from app import app, CURR_USER_KEY
+from profiler import profiler, Profile, ProfileStore, Sampler, PROFILE_HEADER, PROFILE_KEY
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def profile_thread(mode, work):
+    """Profile a thread running `work`; returns its Profile."""
+
+    sampler = Sampler(interval=0.001)
+    done = threading.Event()
+    ready = threading.Event()
+    result = {}
+
+    def run():
+        result['profile'] = Profile(mode, threading.get_ident())
+        sampler.add(result['profile'])
+        ready.set()
+        work()
+        sampler.remove(result['profile'])
+        done.set()
+
+    threading.Thread(target=run).start()
+    ready.wait()
+    done.wait()
+    return result['profile']
+
+
+class ProfileTestCase(TestCase):
+    """Test sampling on its own."""
+
+    def test_collapsed_stacks(self):
+        '''Are samples folded into "outer;inner count" lines naming the busy function?'''
+        profile = profile_thread('wall', lambda: spin(0.05))
+
+        self.assertGreater(profile.samples, 0)
+        stack, micros = profile.collapsed().splitlines()[0].rsplit(' ', 1)
+        self.assertTrue(stack.endswith('test_profiler.py:spin'))
+        self.assertIn('test_profiler.py:run;', stack)
+        self.assertGreater(int(micros), 0)
+
+    def test_cpu_ignores_waiting(self):
+        '''Does a sleeping thread take wall time but next to no CPU time?'''
+        wall = profile_thread('wall', lambda: time.sleep(0.05))
+        cpu = profile_thread('cpu', lambda: time.sleep(0.05))
+
+        self.assertGreater(sum(wall.stacks.values()), 30000)
+        self.assertLess(sum(cpu.stacks.values()), 10000)
+
+
+class ProfileStoreTestCase(TestCase):
+    """Test the bounded directory of profiles."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_keeps_newest(self):
+        '''Past its limit, are the oldest profiles deleted?'''
+        store = ProfileStore(self.directory, keep=3)
+        profile = Profile('wall', threading.get_ident())
+        profile.stacks['a;b'] = 10
+
+        names = []
+        for i in range(5):
+            names.append(store.save(profile, 'homepage'))
+            time.sleep(0.002)
+
+        self.assertEqual([saved.name for saved in store.list()], names[:1:-1])
+        self.assertEqual(store.list()[0].endpoint, 'homepage')
+
+
+class RequestProfilerTestCase(DatabaseTestCase):
+    """Test which requests are profiled, and the admin pages."""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        app.config['PROFILE_DIR'] = self.directory
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def _profiled(self, headers=None):
+        """Run the hooks around a busy request; returns (profiled?, response)."""
+
+        with app.test_request_context('/', headers=headers):
+            profiler.start()
+            profiled = PROFILE_KEY in request.environ
+            spin(0.03)
+            return profiled, profiler.finish(Response('ok'))
+
+    def test_signed_header(self):
+        '''Is a request with a signed header profiled and saved, and a forged one not?'''
+        with app.app_context():
+            token = profiler.token('cpu')
+
+        profiled, resp = self._profiled({PROFILE_HEADER: token})
+
+        self.assertTrue(profiled)
+        name = resp.headers[PROFILE_HEADER + '-Name']
+        self.assertTrue(name.endswith('-cpu.folded'))
+        self.assertIn(name, os.listdir(self.directory))
+
+        self.assertFalse(self._profiled({PROFILE_HEADER: token[:-2] + 'xx'})[0])
+
+    def test_sample_rate(self):
+        '''Is every request profiled at a rate of 1, and none at 0?'''
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        self.assertTrue(self._profiled()[0])
+
+        app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        self.assertFalse(self._profiled()[0])
+
+    def test_admin_only(self):
+        '''Can only admins list and download profiles?'''
+        admin_id, other_id = make_user('admin').id, make_user('other').id
+        db.session.commit()
+        app.config['ADMIN_USER_IDS'] = (admin_id,)
+
+        with app.app_context():
+            token = profiler.token('wall')
+        name = self._profiled({PROFILE_HEADER: token})[1].headers[PROFILE_HEADER + '-Name']
+
+        with self.client as c:
+            self.assertEqual(c.get('/admin/profiles').status_code, 404)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            self.assertEqual(c.get(f'/admin/profiles/{name}').status_code, 404)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = admin_id
+            html = c.get('/admin/profiles').get_data(as_text=True)
+            self.assertIn(name, html)
+            self.assertIn(PROFILE_HEADER, html)
+
+            resp = c.get(f'/admin/profiles/{name}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('test_profiler.py:spin', resp.get_data(as_text=True))
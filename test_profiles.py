@@ -0,0 +1,138 @@
+"""Profile read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiles.py
+
+
+from sqlalchemy import event
+
+from fixtures import DatabaseTestCase, make_user, make_message, make_follow, make_like
+from models import db
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from profiles import profiles, fetch_profile, ProfileCache
+
+
+class ProfilesTestCase(DatabaseTestCase):
+    """Test the profile bundle and users_show()."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        cache.clear()
+        profiles.clear()
+
+        self.client = app.test_client()
+
+        self.owner = make_user('owner', password='password')
+        self.viewer = make_user('viewer', password='password')
+
+        for i in range(3):
+            make_message(self.owner, f'warble {i}')
+        other = make_message(self.viewer, 'viewer warble')
+        make_follow(self.owner, self.viewer)
+        make_like(self.owner, other)
+        db.session.commit()
+
+        self.owner_id = self.owner.id
+        self.viewer_id = self.viewer.id
+
+    def _login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def _statements(self, fn):
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):
+            # the SAVEPOINTs DatabaseTestCase wraps commits in aren't the app's
+            if 'SAVEPOINT' not in statement:
+                statements.append(statement)
+
+        engine = db.get_engine(app)
+        event.listen(engine, 'before_cursor_execute', before_execute)
+        try:
+            result = fn()
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_execute)
+
+        return result, statements
+
+    def test_fetch_profile(self):
+        '''Does one bundle hold the header, counts and newest messages first?'''
+        (header, messages), viewer_follows = fetch_profile(self.owner_id, self.viewer_id)
+
+        self.assertEqual(header.username, 'owner')
+        self.assertEqual((header.messages_count, header.following_count,
+                          header.followers_count, header.likes_count), (3, 1, 0, 1))
+        self.assertEqual([msg.text for msg in messages], ['warble 2', 'warble 1', 'warble 0'])
+        self.assertFalse(viewer_follows)
+
+    def test_at_most_two_statements(self):
+        '''Does the profile page use at most two statements, cold and cached?'''
+        with self.client as c:
+            self._login(c, self.viewer_id)
+
+            for attempt in ('cold', 'cached'):
+                resp, statements = self._statements(lambda: c.get(f'/users/{self.owner_id}'))
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertLessEqual(len(statements), 2, attempt)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn('warble 2', html)
+            self.assertIn('/users/follow/', html)
+
+    def test_follows_page_statements(self):
+        '''Do the followers and following pages take their stats from the bundle, not every row?'''
+        with self.client as c:
+            self._login(c, self.viewer_id)
+
+            for page in ('followers', 'following'):
+                resp, statements = self._statements(lambda: c.get(f'/users/{self.owner_id}/{page}'))
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertLessEqual(len(statements), 4, page)
+
+            html = resp.get_data(as_text=True)
+            self.assertRegex(html, rf'/users/{self.owner_id}/following"\s*>1</a')
+            self.assertRegex(html, rf'/users/{self.owner_id}/likes">1</a')
+
+    def test_writes_invalidate(self):
+        '''Do new messages and follows show up on a cached profile?'''
+        with self.client as c:
+            self._login(c, self.viewer_id)
+            c.get(f'/users/{self.owner_id}')
+
+            c.post(f'/users/follow/{self.owner_id}')
+            html = c.get(f'/users/{self.owner_id}').get_data(as_text=True)
+            self.assertIn('Unfollow', html)
+            self.assertRegex(html, rf'/users/{self.owner_id}/followers"\s*>1</a')
+
+            self._login(c, self.owner_id)
+            c.post('/messages/new', data={'text': 'brand new warble'})
+            html = c.get(f'/users/{self.owner_id}').get_data(as_text=True)
+            self.assertIn('brand new warble', html)
+
+    def test_bump_in_another_process(self):
+        '''Does a bump made by another process invalidate this one's cached profile?'''
+        with self.client as c:
+            self._login(c, self.viewer_id)
+            c.get(f'/users/{self.owner_id}')
+
+            # another process edits the bio and bumps, with a cache of its own
+            db.session.execute("UPDATE users SET bio = 'edited elsewhere' WHERE id = :id",
+                               {'id': self.owner_id})
+            ProfileCache().bump(self.owner_id)
+            db.session.commit()
+
+            html = c.get(f'/users/{self.owner_id}').get_data(as_text=True)
+            self.assertIn('edited elsewhere', html)
+
+    def test_missing_profile(self):
+        '''Is an unknown user a 404?'''
+        resp = self.client.get('/users/0')
+        self.assertEqual(resp.status_code, 404)
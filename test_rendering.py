@@ -0,0 +1,92 @@
+"""Template bytecode cache and render profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_rendering.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from jinja2 import Environment, DictLoader
+
+import fixtures  # the test database and config; import it before app
+from app import app
+from rendering import render_profiler, AtomicBytecodeCache, ProfiledTemplate
+
+TEMPLATES = {
+    'base.html': '<p>{% block content %}{% endblock %}</p>',
+    'page.html': "{% extends 'base.html' %}{% block content %}hello {{ name }}{% endblock %}",
+}
+
+
+class BytecodeCacheTestCase(TestCase):
+    """Test templates compiled once, shared through the cache directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _environment(self):
+        return Environment(loader=DictLoader(TEMPLATES),
+                           bytecode_cache=AtomicBytecodeCache(self.directory))
+
+    def test_loads_compiled_templates(self):
+        '''Does a second environment load the templates without compiling them?'''
+        first = self._environment()
+        self.assertEqual(first.get_template('page.html').render(name='warbler'), '<p>hello warbler</p>')
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+        second = self._environment()
+
+        def compile(*args, **kwargs):
+            raise AssertionError("template was compiled again")
+
+        second.compile = compile
+        self.assertEqual(second.get_template('page.html').render(name='again'), '<p>hello again</p>')
+        self.assertFalse([name for name in os.listdir(self.directory) if name.endswith('.partial')])
+
+
+class RenderProfilerTestCase(TestCase):
+    """Test per-template and per-block timings."""
+
+    def setUp(self):
+        self.environment = Environment(loader=DictLoader(TEMPLATES))
+        self.environment.template_class = ProfiledTemplate
+        render_profiler.clear()
+
+    def tearDown(self):
+        render_profiler.enabled = app.config['TEMPLATE_PROFILE']
+        render_profiler.clear()
+
+    def test_records_templates_and_blocks(self):
+        '''Are the template, its parent and the block each timed, without changing the output?'''
+        render_profiler.enabled = True
+        html = self.environment.get_template('page.html').render(name='warbler')
+
+        self.assertEqual(html, '<p>hello warbler</p>')
+        stats = {(row.template, row.block): row for row in render_profiler.report()}
+        self.assertEqual(set(stats), {('page.html', None), ('base.html', None),
+                                      ('page.html', 'content')})
+        self.assertEqual(stats['page.html', 'content'].count, 1)
+        self.assertGreaterEqual(stats['page.html', None].total, stats['page.html', 'content'].total)
+
+    def test_disabled(self):
+        '''Is nothing recorded with profiling off?'''
+        render_profiler.enabled = False
+        self.environment.get_template('page.html').render(name='warbler')
+
+        self.assertEqual(render_profiler.report(), [])
+
+    def test_app_templates(self):
+        '''Are the app's own templates profiled?'''
+        render_profiler.enabled = True
+        resp = app.test_client().get('/')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(('home-anon.html', 'content'),
+                      {(row.template, row.block) for row in render_profiler.report()})
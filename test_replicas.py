@@ -0,0 +1,131 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+from sqlalchemy import create_engine, text
+
+from fixtures import CommittedTestCase, DATABASE_URL, create_database, make_user
+from models import db, User
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from replicas import replicas, reading_replica, is_read, PIN_KEY
+
+# A second local database standing in for a replica. It only catches up
+# with the test database when a test calls replicate(), so the time in
+# between is replication lag.
+REPLICA_URL = f'{DATABASE_URL}-replica'
+
+create_database(REPLICA_URL)
+replica_engine = create_engine(REPLICA_URL)
+db.metadata.drop_all(replica_engine)
+db.metadata.create_all(replica_engine)
+
+
+def replicate():
+    """Copy every table of the test database to the replica."""
+
+    tables = db.metadata.sorted_tables
+    names = ', '.join(f'"{table.name}"' for table in tables)
+
+    with app.app_context(), replica_engine.begin() as replica:
+        replica.execute(f'TRUNCATE {names} RESTART IDENTITY CASCADE')
+        for table in tables:
+            rows = [dict(row) for row in db.session.execute(table.select())]
+            if rows:
+                replica.execute(table.insert(), rows)
+        db.session.remove()
+
+
+class ReplicaTestCase(CommittedTestCase):
+    """Test which database requests read from."""
+
+    def setUp(self):
+        self.config = dict(app.config)
+        app.config['SQLALCHEMY_REPLICA_URIS'] = (REPLICA_URL,)
+        cache.clear()
+
+        self.writer_id = make_user('writer').id
+        self.author_id = make_user('author').id
+        db.session.commit()
+        replicate()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        super().tearDown()
+        replicate()
+
+    def _client(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def _follows_author(self, client):
+        html = client.get(f'/users/{self.writer_id}/following').get_data(as_text=True)
+        return '@author' in html
+
+    def test_lagging_reads(self):
+        '''Do GET requests read from the replica, and see writes only once replicated?'''
+        make_user('newcomer')
+        db.session.commit()
+
+        client = app.test_client()
+        self.assertNotIn('@newcomer', client.get('/users').get_data(as_text=True))
+
+        replicate()
+        self.assertIn('@newcomer', client.get('/users').get_data(as_text=True))
+
+    def test_read_your_writes(self):
+        '''After following someone, does the user read from the primary until the pin runs out?'''
+        writer = self._client(self.writer_id)
+        resp = writer.post(f'/users/follow/{self.author_id}')
+        self.assertEqual(resp.status_code, 302)
+
+        # the writer sees their follow; someone else reads the lagging replica
+        self.assertTrue(self._follows_author(writer))
+        self.assertFalse(self._follows_author(self._client(self.author_id)))
+
+        with writer.session_transaction() as sess:
+            sess[PIN_KEY] = 0
+        self.assertFalse(self._follows_author(writer))
+
+        replicate()
+        self.assertTrue(self._follows_author(writer))
+
+    def test_writes_go_to_primary(self):
+        '''Does a GET that writes send the write, and later reads, to the primary?'''
+        with app.test_request_context('/'):
+            replicas.route_reads()
+            self.assertTrue(reading_replica(db.session))
+
+            db.session.add(User(username='late', email='late@test.com', password='HASHED_PASSWORD'))
+            db.session.flush()
+
+            self.assertFalse(reading_replica(db.session))
+            self.assertIsNotNone(User.query.filter_by(username='late').first())
+            db.session.rollback()
+
+    def test_raw_sql_writes_go_to_primary(self):
+        '''Is raw SQL routed by what it is: SELECTs to the replica, writes and locks to the primary?'''
+        with app.test_request_context('/'):
+            replicas.route_reads()
+
+            db.session.execute(text("SELECT count(*) FROM users"))
+            db.session.execute(text("SELECT id FROM users").columns(id=db.Integer))
+            self.assertTrue(reading_replica(db.session))
+
+            db.session.execute(text("UPDATE users SET bio = 'raw' WHERE id = :id"), {'id': self.writer_id})
+            self.assertFalse(reading_replica(db.session))
+            db.session.commit()
+
+        self.assertEqual(User.query.get(self.writer_id).bio, 'raw')
+
+        for sql in ("SELECT id FROM users FOR UPDATE", "SELECT pg_advisory_xact_lock(1, 2)",
+                    "WITH moved AS (DELETE FROM likes RETURNING *) SELECT * FROM moved"):
+            self.assertFalse(is_read(text(sql)), sql)
+        self.assertFalse(is_read(db.select([User.id]).with_for_update()))
+        self.assertTrue(is_read(db.select([User.id])))
@@ -0,0 +1,131 @@
+"""Message key sequencer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sequencer.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from fixtures import DatabaseTestCase, make_user
+from models import db, Message
+
+from sequencer import Sequencer, key_at, key_time, backfill, MAX_SEQUENCE, TIME_SHIFT
+
+WHEN = datetime(2024, 5, 1, 12, 30, 15, 250000)
+
+
+class SequencerTestCase(TestCase):
+    """Test key generation."""
+
+    def setUp(self):
+        self.sequencer = Sequencer(worker_id=5)
+
+    def test_keys_sort_by_time(self):
+        '''Are keys increasing within and across milliseconds?'''
+        keys = [self.sequencer.key_for(WHEN, None) for i in range(3)]
+        keys.append(self.sequencer.key_for(WHEN + timedelta(milliseconds=1), None))
+
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertEqual(key_time(keys[0]), WHEN.replace(microsecond=250000))
+        self.assertGreaterEqual(keys[0], key_at(WHEN))
+
+    def test_sequence_overflow_borrows_next_ms(self):
+        '''Does running out of sequence numbers move on to the next millisecond?'''
+        keys = [self.sequencer.key_for(WHEN, None) for i in range(MAX_SEQUENCE + 2)]
+
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual(keys[-1] >> TIME_SHIFT, (keys[0] >> TIME_SHIFT) + 1)
+
+    def test_backdated_keys_are_unique(self):
+        '''Do keys for older timestamps stay unique and in their own millisecond?'''
+        self.sequencer.key_for(WHEN, None)
+        old = WHEN - timedelta(days=1)
+        keys = {self.sequencer.key_for(old, None) for i in range(100)}
+
+        self.assertEqual(len(keys), 100)
+        self.assertTrue(all(key_at(old) <= key < key_at(WHEN) for key in keys))
+
+    def test_workers_do_not_collide(self):
+        '''Do two workers produce different keys for the same instant?'''
+        other = Sequencer(worker_id=6)
+
+        self.assertNotEqual(self.sequencer.key_for(WHEN, None), other.key_for(WHEN, None))
+
+
+class MessageKeyTestCase(DatabaseTestCase):
+    """Test keys on stored messages."""
+
+    def setUp(self):
+        super().setUp()
+
+        user = make_user('testuser')
+        db.session.commit()
+        self.user_id = user.id
+
+    def test_timestamp_default_is_per_message(self):
+        '''Does each new message get the time it was created at?'''
+        first = Message(text='first', user_id=self.user_id)
+        db.session.add(first)
+        db.session.commit()
+
+        second = Message(text='second', user_id=self.user_id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertLess(first.timestamp, second.timestamp)
+        self.assertLess(first.sort_key, second.sort_key)
+
+    def test_backfill(self):
+        '''Does the backfill key existing rows by timestamp?'''
+        msgs = [Message(text=f'old {i}', user_id=self.user_id,
+                        timestamp=WHEN - timedelta(days=i))
+                for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        db.session.execute('ALTER TABLE messages ALTER COLUMN sort_key DROP NOT NULL')
+        try:
+            Message.query.update({Message.sort_key: None})
+            db.session.commit()
+
+            self.assertEqual(backfill(chunk_size=2), 3)
+
+            ordered = Message.query.order_by(Message.sort_key.desc()).all()
+            self.assertEqual([msg.text for msg in ordered], ['old 0', 'old 1', 'old 2'])
+        finally:
+            db.session.rollback()
+            db.session.execute('ALTER TABLE messages ALTER COLUMN sort_key SET NOT NULL')
+            db.session.commit()
+
+    def test_backfill_same_time(self):
+        '''Do rows with one timestamp get distinct keys, in id order, apart from live keys?'''
+        msgs = [Message(text=f'tied {i}', user_id=self.user_id, timestamp=WHEN)
+                for i in range(5)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        ids = [msg.id for msg in msgs]
+
+        db.session.execute('ALTER TABLE messages ALTER COLUMN sort_key DROP NOT NULL')
+        try:
+            Message.query.update({Message.sort_key: None})
+            db.session.commit()
+
+            self.assertEqual(backfill(chunk_size=2), 5)
+
+            keys = [key for key, in (db.session
+                                     .query(Message.sort_key)
+                                     .filter(Message.id.in_(ids))
+                                     .order_by(Message.id))]
+            self.assertEqual(keys, sorted(set(keys)))
+            self.assertEqual({key >> TIME_SHIFT for key in keys}, {key_at(WHEN) >> TIME_SHIFT})
+
+            live = Message(text='live', user_id=self.user_id, timestamp=WHEN)
+            db.session.add(live)
+            db.session.commit()
+            self.assertNotIn(live.sort_key, keys)
+        finally:
+            db.session.rollback()
+            db.session.execute('ALTER TABLE messages ALTER COLUMN sort_key SET NOT NULL')
+            db.session.commit()
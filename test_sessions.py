@@ -0,0 +1,157 @@
+"""Server-side session tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sessions.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from fixtures import DatabaseTestCase, make_user
+
+from app import app, CURR_USER_KEY
+from sessions import MemoryStore, SQLiteStore, ServerSessionInterface, encode, decode
+
+PASSWORD = 'password123'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class EncodingTestCase(TestCase):
+    def test_round_trip(self):
+        '''Does session data come back as it went in, and garbage as an empty session?'''
+        data = {CURR_USER_KEY: 12, '_flashes': [('danger', 'Access unauthorized.')], 'csrf_token': 'abc'}
+
+        self.assertEqual(decode(encode(data)), data)
+        self.assertEqual(decode(b'not a session'), {})
+
+
+class StoreTests:
+    """Tests every store passes; make_store(clock) builds the one under test."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = self.make_store(self.clock)
+
+    def test_save_load_expire(self):
+        '''Are sessions loaded until they expire?'''
+        self.store.save('a', b'data', 1, 60)
+
+        self.assertEqual(self.store.load('a'), b'data')
+        self.assertIsNone(self.store.load('b'))
+
+        self.clock.now += 61
+        self.assertIsNone(self.store.load('a'))
+
+    def test_delete_user(self):
+        '''Does deleting a user's sessions delete all but the one kept, and nobody else's?'''
+        for sid, user_id in (('a', 1), ('b', 1), ('c', 1), ('d', 2), ('e', None)):
+            self.store.save(sid, b'data', user_id, 60)
+
+        self.assertEqual(self.store.delete_user(1, keep='b'), 2)
+
+        self.assertEqual([sid for sid in 'abcde' if self.store.load(sid)], ['b', 'd', 'e'])
+
+
+class MemoryStoreTestCase(StoreTests, TestCase):
+    def make_store(self, clock):
+        return MemoryStore(clock=clock)
+
+    def test_lru(self):
+        '''Is the least recently used session dropped when the store is full?'''
+        store = MemoryStore(max_sessions=3, clock=self.clock)
+        for sid in 'abc':
+            store.save(sid, b'data', None, 60)
+
+        store.load('a')
+        store.save('d', b'data', None, 60)
+
+        self.assertEqual(len(store), 3)
+        self.assertIsNone(store.load('b'))
+        self.assertEqual(store.load('a'), b'data')
+
+
+class SQLiteStoreTestCase(StoreTests, TestCase):
+    def make_store(self, clock):
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return SQLiteStore(path, clock=clock)
+
+
+class ServerSessionViewsTestCase(DatabaseTestCase):
+    """Test logging in and out with sessions kept in a memory store."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.store = MemoryStore()
+        self.interface = app.session_interface
+        app.session_interface = ServerSessionInterface(self.store, CURR_USER_KEY)
+
+        self.user = make_user('sessionuser', password=PASSWORD)
+        self.user_id = self.user.id
+
+    def tearDown(self):
+        app.session_interface = self.interface
+        super().tearDown()
+
+    def _sid(self, client):
+        return next((cookie.value for cookie in client.cookie_jar
+                     if cookie.name == app.session_cookie_name), None)
+
+    def _login(self, client, password=PASSWORD):
+        resp = client.post('/login', data={'username': 'sessionuser', 'password': password})
+        self.assertEqual(resp.status_code, 302)
+
+    def _logged_in(self, client):
+        return '/logout' in client.get('/').get_data(as_text=True)
+
+    def test_login_rotates_id(self):
+        '''Does logging in give the session a new id, and leave only that one in the store?'''
+        client = app.test_client()
+        client.get('/users/profile')                # flashes a message: an anonymous session
+        before = self._sid(client)
+
+        self._login(client)
+        after = self._sid(client)
+
+        self.assertIsNotNone(before)
+        self.assertNotEqual(before, after)
+        self.assertIsNone(self.store.load(before))
+        self.assertEqual(decode(self.store.load(after))[CURR_USER_KEY], self.user_id)
+        self.assertTrue(self._logged_in(client))
+
+    def test_logout_drops_session(self):
+        '''Does logging out remove the session from the store?'''
+        client = app.test_client()
+        self._login(client)
+        sid = self._sid(client)
+
+        client.get('/logout')
+
+        self.assertIsNone(self.store.load(sid))
+        self.assertFalse(self._logged_in(client))
+
+    def test_change_password_revokes_other_sessions(self):
+        '''After a password change, are the user's other sessions logged out, and this one kept?'''
+        laptop, phone = app.test_client(), app.test_client()
+        self._login(laptop)
+        self._login(phone)
+
+        resp = laptop.post('/users/profile/password-change',
+                           data={'cur_password': PASSWORD, 'new_password': 'new-password',
+                                 'confirm_password': 'new-password'})
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertTrue(self._logged_in(laptop))
+        self.assertFalse(self._logged_in(phone))
+        self.assertEqual(len(self.store), 1)
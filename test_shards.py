@@ -0,0 +1,229 @@
+"""Sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+
+
+from threading import Thread
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from fixtures import CommittedTestCase, DATABASE_URL, create_database, make_user
+from models import db, User, Message, Follows, Likes
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from deletions import run_pending
+from profiles import profiles
+from shards import shards, merge_newest, SHARD_METADATA
+
+# A second local database as the only shard besides main.
+SHARD_URL = f'{DATABASE_URL}-shard1'
+
+create_database(SHARD_URL)
+shard_engine = create_engine(SHARD_URL)
+SHARD_METADATA.drop_all(shard_engine)
+SHARD_METADATA.create_all(shard_engine)
+
+
+def shard_texts():
+    return {text for (text,) in shard_engine.execute('SELECT text FROM messages')}
+
+
+class MergeTestCase(TestCase):
+    def test_merge_newest(self):
+        '''Are newest-first lists merged newest first, and cut at the limit?'''
+        merged = merge_newest([[(9, 'a'), (4, 'b')], [(7, 'c'), (5, 'd'), (1, 'e')], []], 4)
+
+        self.assertEqual([value for _, value in merged], ['a', 'c', 'd', 'b'])
+
+
+class ShardsTestCase(CommittedTestCase):
+    """Test routing messages and follows to users' shards.
+
+    Shards are written on their own connections, so these tests commit
+    their data rather than rolling it back.
+    """
+
+    def setUp(self):
+        self.config = dict(app.config)
+        app.config['SHARDS'] = {'shard1': SHARD_URL}
+        cache.clear()
+        profiles.clear()
+
+        with app.app_context():
+            shards.init()
+
+        self.viewer_id = make_user('viewer').id
+        self.local_id = make_user('local').id
+        self.remote_id = make_user('remote', shard='shard1').id
+        db.session.commit()
+
+    def tearDown(self):
+        app.config.update(self.config)
+
+        # later tests go on from past every id used here, one at a time again
+        last = max(engine.execute('SELECT last_value FROM messages_id_seq').scalar()
+                   for engine in (shard_engine, db.engine))
+
+        shard_engine.execute('TRUNCATE messages')
+        super().tearDown()
+        db.session.execute(f'ALTER SEQUENCE messages_id_seq INCREMENT BY 1 START WITH 1 RESTART WITH {last + 1}')
+        db.session.commit()
+
+    def _client(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def _post(self, user_id, text):
+        resp = self._client(user_id).post('/messages/new', data={'text': text})
+        self.assertEqual(resp.status_code, 302)
+
+    def test_timeline_merges_shards(self):
+        '''Does the home timeline gather followed users' messages from every shard, newest first?'''
+        viewer = self._client(self.viewer_id)
+        viewer.post(f'/users/follow/{self.local_id}')
+        viewer.post(f'/users/follow/{self.remote_id}')
+
+        for text in ('local 1', 'remote 1', 'local 2', 'remote 2'):
+            self._post(self.local_id if text.startswith('local') else self.remote_id, text)
+
+        self.assertEqual(shard_texts(), {'remote 1', 'remote 2'})
+        self.assertEqual({msg.text for msg in Message.query}, {'local 1', 'local 2'})
+
+        html = viewer.get('/').get_data(as_text=True)
+        positions = [html.index(text) for text in ('remote 2', 'local 2', 'remote 1', 'local 1')]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_profile_on_shard(self):
+        '''Do profile pages of a user on a shard take their messages from that shard?'''
+        remote = self._client(self.remote_id)
+        remote.post(f'/users/follow/{self.local_id}')
+        self._post(self.remote_id, 'far away warble')
+
+        # follows stay on main
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(User.query.get(self.local_id).followers_count, 1)
+
+        html = self._client(self.viewer_id).get(f'/users/{self.remote_id}').get_data(as_text=True)
+        self.assertIn('far away warble', html)
+        self.assertIn(f'/users/{self.remote_id}/following">1</a', html.replace('\n', '').replace(' ', ''))
+
+        html = remote.get(f'/users/{self.local_id}').get_data(as_text=True)
+        self.assertIn(f'/users/stop-following/{self.local_id}', html)
+
+    def test_like_message_on_shard(self):
+        '''Can a message on a shard be shown, liked and unliked?'''
+        self._post(self.remote_id, 'far away warble')
+        message_id = shard_engine.execute('SELECT id FROM messages').scalar()
+        cache.clear()
+
+        viewer = self._client(self.viewer_id)
+        self.assertIn('far away warble', viewer.get(f'/messages/{message_id}').get_data(as_text=True))
+
+        self.assertEqual(viewer.post(f'/users/add_like/{message_id}').status_code, 302)
+        self.assertEqual(Likes.query.filter_by(message_id=message_id).count(), 1)
+        self.assertIn('far away warble', viewer.get(f'/users/{self.viewer_id}/likes').get_data(as_text=True))
+
+        viewer.post(f'/users/remove_like/{message_id}')
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_unfollow_counts_once(self):
+        '''Does unfollowing twice take the follower off the count only once?'''
+        remote = self._client(self.remote_id)
+        remote.post(f'/users/follow/{self.local_id}')
+
+        for _ in range(2):
+            remote.post(f'/users/stop-following/{self.local_id}')
+
+        self.assertEqual(User.query.get(self.local_id).followers_count, 0)
+
+    def test_purge_on_shard(self):
+        '''Does purging a deleted user on a shard remove their messages there, and their likes?'''
+        remote = self._client(self.remote_id)
+        remote.post(f'/users/follow/{self.local_id}')
+        self._post(self.remote_id, 'doomed warble')
+        message_id = shard_engine.execute('SELECT id FROM messages').scalar()
+
+        viewer = self._client(self.viewer_id)
+        viewer.post(f'/users/follow/{self.remote_id}')
+        viewer.post(f'/users/add_like/{message_id}')
+
+        remote.post('/users/delete')
+        self.assertEqual(User.query.get(self.local_id).followers_count, 0)
+
+        with app.app_context():
+            self.assertEqual(run_pending(chunk_size=2), 1)
+
+        self.assertEqual(shard_texts(), set())
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertIsNone(User.query.get(self.remote_id))
+
+    def test_move_user(self):
+        '''Does moving a user take their messages to the new shard, and leave their follows?'''
+        local = self._client(self.local_id)
+        local.post(f'/users/follow/{self.viewer_id}')
+        self._post(self.local_id, 'moving warble')
+        self._post(self.viewer_id, 'staying warble')
+
+        with app.app_context():
+            moved = shards.move_user(self.local_id, 'shard1')
+
+        self.assertEqual(moved, 1)
+        self.assertEqual(User.query.get(self.local_id).shard, 'shard1')
+        self.assertEqual(shard_texts(), {'moving warble'})
+        self.assertEqual(Message.query.filter_by(user_id=self.local_id).count(), 0)
+        self.assertEqual(Follows.query.count(), 1)
+
+        cache.clear()
+        html = local.get('/').get_data(as_text=True)
+        self.assertIn('moving warble', html)
+        self.assertIn('staying warble', html)
+
+    def test_move_waits_for_writers(self):
+        '''Does a move wait for a writer holding the user, and take what they wrote?'''
+        shards.hold_user(User.query.get(self.local_id))
+
+        def move():
+            with app.app_context():
+                shards.move_user(self.local_id, 'shard1')
+
+        moving = Thread(target=move)
+        moving.start()
+        moving.join(0.2)
+        self.assertTrue(moving.is_alive())
+
+        db.session.add(Message(text='late warble', user_id=self.local_id))
+        db.session.commit()
+        moving.join()
+
+        self.assertEqual(shard_texts(), {'late warble'})
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(User.query.get(self.local_id).shard, 'shard1')
+
+    def test_readers_after_move(self):
+        '''After a move, do the following page and the API timeline still have everything?'''
+        local = self._client(self.local_id)
+        local.post(f'/users/follow/{self.remote_id}')
+        self._post(self.local_id, 'moving warble')
+        self._post(self.remote_id, 'remote warble')
+
+        with app.app_context():
+            shards.move_user(self.local_id, 'shard1')
+        cache.clear()
+
+        html = local.get(f'/users/{self.local_id}/following').get_data(as_text=True)
+        self.assertIn('@remote', html)
+
+        data = local.get('/api/v1/timeline?limit=1').get_json()
+        self.assertEqual([msg['text'] for msg in data['messages']], ['remote warble'])
+
+        data = local.get(f"/api/v1/timeline?after={data['next']}").get_json()
+        self.assertEqual([msg['text'] for msg in data['messages']], ['moving warble'])
+        self.assertEqual(data['messages'][0]['user']['username'], 'local')
+        self.assertIsNone(data['next'])
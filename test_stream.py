@@ -0,0 +1,137 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_stream.py
+
+
+from unittest import TestCase
+
+from fixtures import DatabaseTestCase, make_user, make_message, make_follow
+from models import db, Message
+
+from app import app, CURR_USER_KEY
+from stream import Broker, broker
+
+
+class BrokerTestCase(TestCase):
+    """Test the pub/sub broker on its own."""
+
+    def test_fan_out_to_followers(self):
+        '''Do subscribers only get events from authors they follow?'''
+        b = Broker()
+        follows_1 = b.subscribe({1})
+        follows_2 = b.subscribe({2})
+
+        b.publish(10, 1, 'from 1')
+
+        self.assertEqual(follows_1.get(0), [(10, 1, 'from 1')])
+        self.assertEqual(follows_2.get(0), [])
+
+    def test_slow_consumer_evicted(self):
+        '''Is a subscriber whose buffer fills up evicted and unsubscribed?'''
+        b = Broker(buffer=2)
+        slow = b.subscribe({1})
+
+        for event_id in range(3):
+            b.publish(event_id, 1, 'data')
+
+        self.assertTrue(slow.evicted)
+        self.assertEqual(b.evictions, 1)
+        self.assertNotIn(1, b.by_author)
+
+    def test_replay(self):
+        '''Does replay return missed events, or None once they've fallen off the ring?'''
+        b = Broker(replay=3, since=0)
+
+        for event_id in range(1, 6):
+            b.publish(event_id, event_id % 2, 'data')
+
+        self.assertEqual([event[0] for event in b.replay({1}, 3)], [5])
+        self.assertEqual([event[0] for event in b.replay({1}, 2)], [3, 5])
+        self.assertIsNone(b.replay({1}, 1))
+
+    def test_replay_since_start(self):
+        '''Does replay send events from before the broker started to the DB, even with gaps in the ids?'''
+        b = Broker(since=100)
+        b.publish(164, 1, 'data')
+        b.publish(228, 1, 'data')
+
+        self.assertEqual([event[0] for event in b.replay({1}, 164)], [228])
+        self.assertEqual(b.replay({1}, 228), [])
+        self.assertIsNone(b.replay({1}, 99))
+
+
+class StreamViewTestCase(DatabaseTestCase):
+    """Test the /stream/timeline endpoint."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        self.client = app.test_client()
+
+        self.viewer = make_user('viewer')
+        self.author = make_user('author')
+        make_follow(self.viewer, self.author)
+        db.session.commit()
+
+        self.viewer_id = self.viewer.id
+        self.author_id = self.author.id
+
+    def test_requires_login(self):
+        '''Is the stream only for logged in users?'''
+        res = self.client.get('/stream/timeline')
+
+        self.assertEqual(res.status_code, 401)
+
+    def test_resume_from_last_event_id(self):
+        '''Does reconnecting with Last-Event-ID replay the messages that were missed?'''
+        author_id = self.author_id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post('/messages/new', data={'text': 'missed warble'})
+
+        msg_key = Message.query.filter_by(text='missed warble').one().sort_key
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            res = c.get('/stream/timeline', headers={'Last-Event-ID': str(msg_key - 1)},
+                        buffered=False)
+            frames = iter(res.response)
+
+            self.assertEqual(res.mimetype, 'text/event-stream')
+            self.assertEqual(next(frames), b'retry: 3000\n\n')
+
+            frame = next(frames).decode()
+            self.assertIn(f'id: {msg_key}\n', frame)
+            self.assertIn('missed warble', frame)
+
+            res.close()
+
+        self.assertNotIn(author_id, broker.by_author)
+
+    def test_resume_from_db(self):
+        '''Does a Last-Event-ID from before the broker's ring resume from the DB?'''
+        msg = make_message(self.author, 'older warble')
+        db.session.commit()
+        msg_key = msg.sort_key
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            res = c.get('/stream/timeline', headers={'Last-Event-ID': '1'}, buffered=False)
+            frames = iter(res.response)
+            next(frames)
+
+            frame = next(frames).decode()
+            self.assertIn(f'id: {msg_key}\n', frame)
+            self.assertIn('older warble', frame)
+
+            res.close()
@@ -0,0 +1,162 @@
+"""Trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from fixtures import DatabaseTestCase, make_user
+from models import db, Message, TrendingSnapshot
+
+from app import app, CURR_USER_KEY
+from trending import CountMinSketch, TopK, SlidingWindow, Trending, SNAPSHOT_KEEP
+
+
+class FakeClock:
+    """Clock that only moves when told to."""
+
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TrendingStructuresTestCase(TestCase):
+    """Test the counting structures on their own."""
+
+    def test_count_min_sketch(self):
+        '''Does the sketch count keys without undercounting?'''
+        sketch = CountMinSketch(width=64, depth=4)
+
+        for i in range(100):
+            sketch.add(f'key{i % 10}')
+
+        for i in range(10):
+            self.assertGreaterEqual(sketch.estimate(f'key{i}'), 10)
+
+        sketch.clear()
+        self.assertEqual(sketch.estimate('key0'), 0)
+
+    def test_top_k_is_bounded(self):
+        '''Does TopK keep only the highest-scored candidates?'''
+        top = TopK(3)
+
+        for score in range(10):
+            top.offer(f'key{score}', score)
+
+        self.assertEqual(len(top), 3)
+        self.assertEqual(sorted(top.keys()), ['key7', 'key8', 'key9'])
+
+        # updating a candidate's score doesn't duplicate it
+        top.offer('key7', 100)
+        self.assertEqual(len(top), 3)
+
+    def test_sliding_window_expires(self):
+        '''Do counts fall out of a window once it has slid past them?'''
+        window = SlidingWindow(60, 6)
+        now = 6000.0
+
+        for _ in range(5):
+            window.add('hashtag', 'old', now)
+        window.add('hashtag', 'new', now + 30)
+
+        self.assertEqual([key for key, score in window.top('hashtag', 10, now + 30)],
+                         ['old', 'new'])
+
+        # older counts decay, then drop out entirely
+        self.assertLess(window.score('hashtag', 'old', now + 50),
+                        window.score('hashtag', 'old', now))
+        self.assertEqual(window.top('hashtag', 10, now + 65), [('new', window.score('hashtag', 'new', now + 65))])
+        self.assertEqual(window.top('hashtag', 10, now + 200), [])
+
+    def test_new_keys_displace_stale_candidates(self):
+        '''Once old hot keys have left a window, can a new key trend in it?'''
+        clock = FakeClock()
+        state = Trending(clock=clock)
+
+        for i in range(40):
+            for _ in range(20):
+                state.record('hashtag', f'old{i}')
+
+        clock.now += 3 * 60 * 60
+        for _ in range(5):
+            state.record('hashtag', 'fresh')
+
+        self.assertEqual([key for key, score in state.top('5m', 'hashtag')], ['fresh'])
+        self.assertEqual([key for key, score in state.top('1h', 'hashtag')], ['fresh'])
+
+    def test_trending_windows(self):
+        '''Does a count show in short windows only while it's recent?'''
+        clock = FakeClock()
+        state = Trending(clock=clock)
+
+        state.record('hashtag', 'warbler')
+
+        self.assertEqual([key for key, score in state.top('5m', 'hashtag')], ['warbler'])
+        self.assertEqual([key for key, score in state.top('24h', 'hashtag')], ['warbler'])
+
+        clock.now += 60 * 60
+
+        self.assertEqual(state.top('5m', 'hashtag'), [])
+        self.assertEqual([key for key, score in state.top('24h', 'hashtag')], ['warbler'])
+
+
+class TrendingViewsTestCase(DatabaseTestCase):
+    """Test trending hooks and views."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        self.client = app.test_client()
+
+        self.testuser = make_user('testuser', password='testuser')
+
+        db.session.commit()
+
+    def test_message_hashtags_and_mentions(self):
+        '''Does Message pull hashtags and mentions out of its text?'''
+        msg = Message(text='Hi @alice and @bob! #Warbler #warbler #py3 a#b me@host')
+
+        self.assertEqual(msg.hashtags(), ['py3', 'warbler'])
+        self.assertEqual(msg.mentions(), ['alice', 'bob'])
+
+    def test_posting_counts_hashtags(self):
+        '''Does posting a message make its hashtag trend?'''
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello #zzqtrend @testuser"})
+
+            res = c.get('/trending?window=5m')
+            html = res.get_data(as_text=True)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('#zzqtrend', html)
+            self.assertIn('@testuser', html)
+
+    def test_snapshot_fallback(self):
+        '''Does /trending fall back to the latest DB snapshot?'''
+        state = Trending(clock=FakeClock())
+        state.record('hashtag', 'snapshotted')
+        state.snapshot()
+
+        self.assertEqual(TrendingSnapshot.latest('1h', 'hashtag')[0][0], 'snapshotted')
+        self.assertEqual(TrendingSnapshot.latest('1h', 'mention'), [])
+
+    def test_old_snapshots_pruned(self):
+        '''Are snapshots older than SNAPSHOT_KEEP deleted when a new one is taken?'''
+        db.session.add(TrendingSnapshot(taken_at=datetime.utcnow() - timedelta(seconds=SNAPSHOT_KEEP + 60),
+                                        window='1h', kind='hashtag', key='ancient', score=1, rank=0))
+        db.session.commit()
+
+        state = Trending(clock=FakeClock())
+        state.record('hashtag', 'current')
+        state.snapshot()
+
+        self.assertEqual({row.key for row in TrendingSnapshot.query}, {'current'})
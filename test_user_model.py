@@ -5,52 +5,21 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
-
-from models import db, User, Message, Follows
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-# Now we can import app
+from fixtures import DatabaseTestCase
+from models import db, User
 
 from app import app
 
-app.config['WTF_CSRF_ENABLED'] = False
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
-        """Create test client, add sample data."""
-
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        db.session.commit()
+        """Create test client."""
 
+        super().setUp()
         self.client = app.test_client()
 
-    def tearDown(self):
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        db.session.commit()
-
     def test_user_model(self):
         """Does basic model work?"""
 
@@ -1,37 +1,21 @@
-import os
-from unittest import TestCase
+from datetime import datetime, timedelta
 
-from models import db, User, Message, Follows
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from fixtures import DatabaseTestCase, make_user, make_message
+from models import db, User, Message, Follows, Likes, FOLLOWS_PAGE_SIZE, DIRECTORY_PAGE_SIZE, LIKES_PAGE_SIZE
 
 from app import app
-app.config['WTF_CSRF_ENABLED'] = False
-
-db.create_all()
+from pagination import encode_cursor
+from deletions import run_pending
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
-        """Create test client, add sample data."""
-
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        db.session.commit()
+        """Create test client."""
 
+        super().setUp()
         self.client = app.test_client()
 
-    def tearDown(self):
-        '''Ensure all data is deleted. Clean slate.'''
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        db.session.commit()
-
     def _sign_up_users_login(self, client):
         ''' Helper Method to create 2 users and sign in user 1 '''
         plain_password = 'password123'
@@ -56,24 +40,13 @@ class UserModelTestCase(TestCase):
     
     def _add_u_to_db(self):
         ''' Helper function to add a user directly to the database'''
-        u = User(
-            email="testing@test.com",
-            username="testuser",
-            password="HASHED_PASSWORD"
-        )
-
-        db.session.add(u)
+        u = make_user('testuser', email="testing@test.com")
         db.session.commit()
 
         return u
     
     def _add_msg_to_db(self, user_id):
-        msg = Message(
-            text='test message',
-            user_id = user_id
-        )
-
-        db.session.add(msg)
+        msg = make_message(User.query.get(user_id), 'test message')
         db.session.commit()
 
         return msg
@@ -102,6 +75,77 @@ class UserModelTestCase(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertIn('@testuser1', html)
 
+    def test_list_users_sorts_and_pages(self):
+        ''' Confirms /users pages through users and can sort by newest or most followed.'''
+
+        users = [User(username=f'user{i:02}', email=f'u{i}@test.com', password='HASHED_PASSWORD')
+                 for i in range(DIRECTORY_PAGE_SIZE + 1)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        # the last user gets a follower, so ranks first by popularity
+        db.session.add(Follows(user_being_followed_id=users[-1].id, user_following_id=users[0].id))
+        db.session.commit()
+        User.refresh_followers_count()
+        db.session.commit()
+
+        # default sort is by username; the last user is pushed to page 2
+        res = self.client.get('/users')
+        html = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('@user00', html)
+        self.assertNotIn(f'@user{DIRECTORY_PAGE_SIZE:02}', html)
+        self.assertIn('after=', html)
+
+        # newest first puts the last user on page 1
+        res = self.client.get('/users?sort=newest')
+        html = res.get_data(as_text=True)
+
+        self.assertIn(f'@user{DIRECTORY_PAGE_SIZE:02}', html)
+        self.assertNotIn('@user00', html)
+
+        # most followed puts the followed user first
+        res = self.client.get('/users?sort=popular')
+        html = res.get_data(as_text=True)
+
+        self.assertLess(html.index(f'@user{DIRECTORY_PAGE_SIZE:02}'), html.index('@user01'))
+
+    def test_list_users_bad_cursor(self):
+        ''' Confirms a cursor from another sort, or a tampered one, just shows the first page.'''
+
+        make_user('user00')
+        db.session.commit()
+
+        for query in (f"sort=popular&after={encode_cursor(['user00'])}",
+                      f"sort=username&after={encode_cursor([5])}",
+                      f"sort=newest&after={encode_cursor([True])}",
+                      'after=' + encode_cursor(['nul\x00'])):
+            res = self.client.get(f'/users?{query}')
+
+            self.assertEqual(res.status_code, 200, query)
+            self.assertIn('@user00', res.get_data(as_text=True))
+
+    def test_list_users_follow_state(self):
+        ''' Confirms /users shows Unfollow only for users the logged in user follows.'''
+
+        u1, u2 = self._sign_up_users_login(self.client)
+        u2_id = u2.id
+
+        res = self.client.get('/users')
+        html = res.get_data(as_text=True)
+
+        self.assertIn(f'/users/follow/{u2_id}', html)
+        self.assertNotIn(f'/users/stop-following/{u2_id}', html)
+
+        self.client.post(f'/users/follow/{u2_id}')
+
+        res = self.client.get('/users')
+        html = res.get_data(as_text=True)
+
+        self.assertIn(f'/users/stop-following/{u2_id}', html)
+        self.assertEqual(User.query.get(u2_id).followers_count, 1)
+
     def test_users_show(self):
         ''' Confirms /users/{user_id} shows specific user page no matter if a user is logged in or not.'''
 
@@ -179,6 +223,73 @@ class UserModelTestCase(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertIn('@testuser1', html)   
 
+    def test_followers_pagination(self):
+        ''' Confirms followers are listed a page at a time, with a cursor link to the next page. A user must be logged in'''
+
+        u1, u2 = self._sign_up_users_login(self.client)
+        u2_id = u2.id
+
+        # adds one more follower than fits on a page
+        followers = [User(username=f'follower{i:02}', email=f'f{i}@test.com', password='HASHED_PASSWORD')
+                     for i in range(FOLLOWS_PAGE_SIZE + 1)]
+        db.session.add_all(followers)
+        db.session.commit()
+
+        for follower in followers:
+            db.session.add(Follows(user_being_followed_id=u2_id, user_following_id=follower.id))
+        db.session.commit()
+
+        ids = sorted(follower.id for follower in followers)
+
+        # first page stops at the page size and links to the next page
+        res = self.client.get(f'/users/{u2_id}/followers')
+        html = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(f'/users/{ids[0]}"', html)
+        self.assertNotIn(f'/users/{ids[-1]}"', html)
+        self.assertIn(f'?after={ids[-2]}', html)
+
+        # second page has the rest and no further link
+        res = self.client.get(f'/users/{u2_id}/followers?after={ids[-2]}')
+        html = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(f'/users/{ids[-1]}"', html)
+        self.assertNotIn(f'/users/{ids[0]}"', html)
+        self.assertNotIn('?after=', html)
+
+    def test_follows_mutual_badge(self):
+        ''' Confirms followers/following listings mark users who follow each other as mutual.'''
+
+        u1, u2 = self._sign_up_users_login(self.client)
+        u1_id = u1.id
+        u2_id = u2.id
+
+        # user 1 follows user 2, not yet mutual
+        self.client.post(f'/users/follow/{u2_id}')
+
+        res = self.client.get(f'/users/{u1_id}/following')
+        html = res.get_data(as_text=True)
+
+        self.assertIn('@testuser2', html)
+        self.assertNotIn('Mutual', html)
+
+        # user 2 follows back
+        db.session.add(Follows(user_being_followed_id=u1_id, user_following_id=u2_id))
+        db.session.commit()
+
+        res = self.client.get(f'/users/{u1_id}/following')
+        html = res.get_data(as_text=True)
+
+        self.assertIn('Mutual', html)
+
+        res = self.client.get(f'/users/{u1_id}/followers')
+        html = res.get_data(as_text=True)
+
+        self.assertIn('@testuser2', html)
+        self.assertIn('Mutual', html)
+
     def test_stop_following(self):
         ''' Confirms when a user can unfollow another user. A user must be logged in'''
 
@@ -249,6 +360,60 @@ class UserModelTestCase(TestCase):
         self.assertIn('@testuser2', html)
         self.assertIn('test message', html)
 
+    def test_show_likes_pagination(self):
+        ''' Confirms the likes page lists the most recent likes first, a page at a time. A user must be logged in'''
+
+        u1, u2 = self._sign_up_users_login(self.client)
+        u1_id = u1.id
+
+        msgs = [Message(text=f'liked message {i:02}', user_id=u2.id) for i in range(LIKES_PAGE_SIZE + 1)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        # likes messages in the reverse order they were posted
+        start = datetime(2024, 1, 1)
+        db.session.add_all([Likes(user_id=u1_id, message_id=msg.id, timestamp=start + timedelta(minutes=i))
+                            for i, msg in enumerate(reversed(msgs))])
+        db.session.commit()
+
+        # first page: the latest like (the oldest message) first, and a link on
+        res = self.client.get(f'/users/{u1_id}/likes')
+        html = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLess(html.index('liked message 00'), html.index('liked message 01'))
+        self.assertNotIn(f'liked message {LIKES_PAGE_SIZE:02}', html)
+        self.assertIn('btn-primary', html)
+        self.assertIn('?after=', html)
+
+        # second page has the earliest like and no further link
+        after = html.split('?after=')[1].split('"')[0]
+        res = self.client.get(f'/users/{u1_id}/likes?after={after}')
+        html = res.get_data(as_text=True)
+
+        self.assertIn(f'liked message {LIKES_PAGE_SIZE:02}', html)
+        self.assertNotIn('liked message 00', html)
+        self.assertNotIn('?after=', html)
+
+    def test_show_likes_bad_cursor(self):
+        ''' Confirms a tampered likes cursor just shows the first page, and the stats come from counts.'''
+
+        u1, u2 = self._sign_up_users_login(self.client)
+        u1_id = u1.id
+
+        msg = self._add_msg_to_db(u2.id)
+        db.session.add(Likes(user_id=u1_id, message_id=msg.id))
+        db.session.commit()
+
+        for after in (encode_cursor([5, 'x']), encode_cursor(['2024-01-01T00:00:00.000000', True]),
+                      encode_cursor(['nul\x00', 1])):
+            res = self.client.get(f'/users/{u1_id}/likes?after={after}')
+            html = res.get_data(as_text=True)
+
+            self.assertEqual(res.status_code, 200, after)
+            self.assertIn('test message', html)
+            self.assertRegex(html, rf'/users/{u1_id}/following"\s*>0</a')
+
     def test_message_like(self):
         ''' Adding a new like has already been tested in test_show_likes. Confirms /users/add_like/{message_id} does not let logged in user like own post. A user must be logged in'''
 
@@ -274,6 +439,36 @@ class UserModelTestCase(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertIn('You cannot like your own post', html)
 
+    def test_message_like_idempotent(self):
+        ''' Confirms liking a message twice keeps one like, and that other users can like the same message'''
+
+        u = self._add_u_to_db()
+        msg = self._add_msg_to_db(u.id)
+        msg_id = msg.id
+
+        # signs up users 1 and 2/ logs in user 1
+        u1, u2 = self._sign_up_users_login(self.client)
+        u1_id = u1.id
+        u2_id = u2.id
+
+        # user 1 likes the message twice
+        self.client.post(f'/users/add_like/{msg_id}')
+        res = self.client.post(f'/users/add_like/{msg_id}', follow_redirects=True)
+        html = res.get_data(as_text=True)
+
+        self.assertIn('Post already liked', html)
+        self.assertEqual(Likes.query.filter_by(message_id=msg_id).count(), 1)
+
+        # logs in user 2, who likes the same message
+        self.client.get('/logout')
+        self.client.post('/login', data={'username': 'testuser2', 'password': 'password123'})
+        res = self.client.post(f'/users/add_like/{msg_id}', follow_redirects=True)
+        html = res.get_data(as_text=True)
+
+        self.assertNotIn('Post already liked', html)
+        self.assertEqual({like.user_id for like in Likes.query.filter_by(message_id=msg_id)},
+                         {u1_id, u2_id})
+
     def test_message_remove_like(self):
         ''' Confirms /users/remove_like/{message_id} removes a like on a message. A user must be logged in'''
 
@@ -363,7 +558,13 @@ class UserModelTestCase(TestCase):
         res = self.client.post('/users/delete', follow_redirects=True)
         html = res.get_data(as_text=True)
         
-        # attempts to get user 1
+        # user 1 is hidden straight away...
+        user = User.query.filter_by(username='testuser1').first()
+        self.assertIsNotNone(user.deleted_at)
+
+        # ...and removed by the background purge
+        with app.app_context():
+            run_pending()
         user = User.query.filter_by(username='testuser1').first()
         self.assertIsNone(user)
 
@@ -0,0 +1,274 @@
+"""Trending hashtags, mentions and messages for Warbler.
+
+Counts are kept in memory in bucketed sliding windows (5m, 1h, 24h). Each
+bucket is a count-min sketch, so memory is fixed no matter how many distinct
+tags show up, and each window keeps a small heap of heavy-hitter candidates
+per kind to answer "what's trending" without scanning anything.
+
+Older buckets in a window count for less (a bucket at the far end of the
+window counts half as much as the current one), so a window's ranking leans
+toward what's hot right now.
+
+The state is periodically snapshotted to the trending_snapshots table, which
+is also what /trending falls back to after a restart.
+"""
+
+import heapq
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+
+from models import db, TrendingSnapshot
+
+# window name -> (span in seconds, number of buckets)
+WINDOWS = {
+    '5m': (5 * 60, 5),
+    '1h': (60 * 60, 12),
+    '24h': (24 * 60 * 60, 24),
+}
+
+DEFAULT_WINDOW = '1h'
+
+# What gets counted: hashtags and mentions from message text, and messages
+# themselves (by id) from likes.
+KINDS = ('hashtag', 'mention', 'message')
+
+# How many entries /trending shows per kind.
+TOP_K = 10
+
+# How often (in seconds) the in-memory state is written to the DB, and
+# how long snapshots are kept.
+SNAPSHOT_INTERVAL = 5 * 60
+SNAPSHOT_KEEP = 24 * 60 * 60
+
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+
+
+def sketch_indexes(key, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+    """Get the column `key` hashes to in each row of a width x depth sketch.
+
+    Every sketch here has the same shape, so this is computed once per
+    counted key and reused across all buckets and windows.
+    """
+
+    return [hash((row, key)) % width for row in range(depth)]
+
+
+class CountMinSketch:
+    """Fixed-size frequency estimator.
+
+    Estimates never undercount; they can overcount when keys collide in every
+    row, which with the default size is rare for the volumes a bucket sees.
+    """
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('l', bytes(8 * width)) for _ in range(depth)]
+
+    def indexes(self, key):
+        return sketch_indexes(key, self.width, self.depth)
+
+    def add(self, key, count=1, indexes=None):
+        """Add `count` to `key`."""
+
+        for row, col in zip(self.rows, indexes or self.indexes(key)):
+            row[col] += count
+
+    def estimate(self, key, indexes=None):
+        """Get the (over-)estimated count for `key`."""
+
+        return min(row[col]
+                   for row, col in zip(self.rows, indexes or self.indexes(key)))
+
+    def clear(self):
+        self.rows = [array('l', bytes(8 * self.width))
+                     for _ in range(self.depth)]
+
+
+class TopK:
+    """Bounded set of heavy-hitter candidates and their latest scores.
+
+    When full, offering a new key evicts the lowest-scored candidate. The
+    min-heap is updated lazily: stale entries are skipped when popped.
+    Scores are only comparable while they're current, so the owner calls
+    `rescore()` whenever they may have decayed.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.scores = {}
+        self.heap = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def offer(self, key, score):
+        """Record `key`'s current score, evicting the minimum if over capacity."""
+
+        self.scores[key] = score
+        heapq.heappush(self.heap, (score, key))
+
+        while len(self.scores) > self.capacity:
+            old_score, old_key = heapq.heappop(self.heap)
+            if self.scores.get(old_key) == old_score:
+                del self.scores[old_key]
+
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(score, key) for key, score in self.scores.items()]
+            heapq.heapify(self.heap)
+
+    def rescore(self, score_of):
+        """Replace every candidate's score with `score_of(key)`, dropping those now at 0."""
+
+        self.scores = {key: score for key, score in
+                       ((key, score_of(key)) for key in self.scores) if score > 0}
+        self.heap = [(score, key) for key, score in self.scores.items()]
+        heapq.heapify(self.heap)
+
+    def keys(self):
+        return list(self.scores)
+
+
+class SlidingWindow:
+    """Counts over the last `span` seconds, in `buckets` rotating sketches."""
+
+    def __init__(self, span, buckets, candidates=4 * TOP_K):
+        self.span = span
+        self.bucket_span = span / buckets
+        self.sketches = [CountMinSketch() for _ in range(buckets)]
+        # which bucket number (time // bucket_span) each slot currently holds
+        self.epochs = [None] * buckets
+        self.candidates = {kind: TopK(candidates) for kind in KINDS}
+        # the bucket number each kind's candidate scores were computed in
+        self.scored_epochs = dict.fromkeys(KINDS)
+
+    def _epoch(self, now):
+        return int(now // self.bucket_span)
+
+    def add(self, kind, key, now, count=1, indexes=None):
+        """Count `key` at time `now` and update its kind's candidates."""
+
+        epoch = self._epoch(now)
+        slot = epoch % len(self.sketches)
+
+        if self.epochs[slot] != epoch:
+            self.sketches[slot].clear()
+            self.epochs[slot] = epoch
+
+        # scores decay from one bucket to the next, so the candidates'
+        # scores from an earlier bucket would keep stale keys in and new ones out
+        if self.scored_epochs[kind] != epoch:
+            self.candidates[kind].rescore(lambda candidate: self.score(kind, candidate, now))
+            self.scored_epochs[kind] = epoch
+
+        indexes = indexes or self.sketches[slot].indexes((kind, key))
+        self.sketches[slot].add((kind, key), count, indexes)
+        self.candidates[kind].offer(key, self.score(kind, key, now, indexes))
+
+    def score(self, kind, key, now, indexes=None):
+        """Get `key`'s decayed count over the window ending at `now`."""
+
+        epoch = self._epoch(now)
+        buckets = len(self.sketches)
+        total = 0.0
+
+        for slot_epoch, sketch in zip(self.epochs, self.sketches):
+            if slot_epoch is None:
+                continue
+
+            age = epoch - slot_epoch
+            if age < buckets:
+                count = sketch.estimate((kind, key), indexes)
+                if count:
+                    total += count * 2 ** (-age / buckets)
+
+        return total
+
+    def top(self, kind, k, now):
+        """Get the `k` highest-scoring (key, score) pairs of `kind`."""
+
+        scored = [(self.score(kind, key, now), key)
+                  for key in self.candidates[kind].keys()]
+
+        return [(key, score)
+                for score, key in heapq.nlargest(k, scored) if score > 0]
+
+
+class Trending:
+    """In-memory trending state for all windows, safe to share across threads."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.windows = {name: SlidingWindow(span, buckets)
+                        for name, (span, buckets) in WINDOWS.items()}
+        self.last_snapshot = clock()
+
+    def record(self, kind, key, count=1):
+        """Count one occurrence of `key` in every window."""
+
+        now = self.clock()
+        indexes = sketch_indexes((kind, key))
+
+        with self.lock:
+            for window in self.windows.values():
+                window.add(kind, key, now, count, indexes)
+
+    def record_message(self, message):
+        """Count the hashtags and mentions in a newly posted message."""
+
+        for tag in message.hashtags():
+            self.record('hashtag', tag)
+
+        for username in message.mentions():
+            self.record('mention', username)
+
+    def record_like(self, message_id):
+        """Count a like for a message."""
+
+        self.record('message', message_id)
+
+    def top(self, window=DEFAULT_WINDOW, kind='hashtag', k=TOP_K):
+        """Get the top `k` (key, score) pairs of `kind` in `window`."""
+
+        with self.lock:
+            return self.windows[window].top(kind, k, self.clock())
+
+    def snapshot(self):
+        """Write the current top entries for every window and kind to the DB.
+
+        Snapshots older than SNAPSHOT_KEEP are deleted.
+        """
+
+        taken_at = datetime.utcnow()
+
+        for window in WINDOWS:
+            for kind in KINDS:
+                for rank, (key, score) in enumerate(self.top(window, kind)):
+                    db.session.add(TrendingSnapshot(
+                        taken_at=taken_at,
+                        window=window,
+                        kind=kind,
+                        key=str(key),
+                        score=score,
+                        rank=rank,
+                    ))
+
+        (TrendingSnapshot.query
+             .filter(TrendingSnapshot.taken_at < taken_at - timedelta(seconds=SNAPSHOT_KEEP))
+             .delete(synchronize_session=False))
+
+        db.session.commit()
+        self.last_snapshot = self.clock()
+
+    def maybe_snapshot(self):
+        """Snapshot if it's been at least SNAPSHOT_INTERVAL since the last one."""
+
+        if self.clock() - self.last_snapshot >= SNAPSHOT_INTERVAL:
+            self.snapshot()
+
+
+trending = Trending()